@@ -0,0 +1,73 @@
+"""
+Deterministic generators of synthetic data flow graphs and logs used by benchmarks
+"""
+import random
+
+from bisect import bisect
+from itertools import accumulate
+
+GROUPS = ('mysql', 'redis', 'sphinx', 'web')
+EDGES = ('select', 'insert', 'update', 'delete', 'push', 'pop', 'search', 'http')
+
+
+def get_node_name(rand, nodes, groups):
+    """
+    :type rand random.Random
+    :type nodes int
+    :type groups tuple[str]
+    :rtype: str
+    """
+    node = rand.randrange(nodes)
+    group = groups[node % len(groups)] if groups else None
+
+    return '{}:node{}'.format(group, node) if group else 'node{}'.format(node)
+
+
+def generate_edges(count, nodes=1000, groups=GROUPS, seed=42):
+    """
+    Yields edges dicts (see format_tsv_line) connecting given number of distinct nodes
+
+    :type count int
+    :type nodes int
+    :type groups tuple[str]
+    :type seed int
+    :rtype: collections.Iterable
+    """
+    rand = random.Random(seed)
+
+    for _ in range(count):
+        yield {
+            'source': get_node_name(rand, nodes, groups),
+            'edge': rand.choice(EDGES),
+            'target': get_node_name(rand, nodes, groups),
+            'value': round(rand.random(), 4),
+            'metadata': 'QPS: {:.4f}'.format(rand.random() * 100),
+        }
+
+
+def generate_logs(count, keys=10000, skew=1.1, seed=42):
+    """
+    Yields (source, URL, user agent) log tuples with Zipf-distributed (source, URL) keys
+
+    :type count int
+    :type keys int
+    :type skew float
+    :type seed int
+    :rtype: collections.Iterable
+    """
+    rand = random.Random(seed)
+
+    # cumulative Zipf weights of keys ranks
+    weights = list(accumulate(1. / (rank ** skew) for rank in range(1, keys + 1)))
+    total = weights[-1]
+
+    agents = ('curl', 'wget', 'guzzle')
+
+    for _ in range(count):
+        key = bisect(weights, rand.random() * total)
+
+        yield (
+            'web{}'.format(key % 17),
+            'http://service{}/path/{}'.format(key % 101, key),
+            agents[key % len(agents)],
+        )
@@ -0,0 +1,194 @@
+"""
+Benchmarks data_flow_graph helpers on synthetic inputs of various sizes
+
+Throughput (records / sec, the best of several runs) and peak memory usage are measured for each function
+and input size and stored in a JSON file. Results can be compared against a baseline - throughput depends
+on the machine, so the baseline is not a part of the repository, record it locally first:
+
+python benchmarks/run.py --output benchmarks/baseline.json
+python benchmarks/run.py --output results.json --baseline benchmarks/baseline.json
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+from functools import partial
+from io import StringIO
+
+# the repository root, so that benchmarks can be run without installing the package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from data_flow_graph import DataFlowGraph, format_graphviz_lines, format_tsv_lines, format_values, \
+    logs_map_and_accumulate, logs_map_and_reduce, normalize_counts, read_tsv_lines, write_graphviz_lines, \
+    write_tsv_lines, Accumulator
+
+from generators import generate_edges, generate_logs
+
+
+# writers output is discarded, so that it does not count towards the peak memory usage
+NULL_OUTPUT = open(os.devnull, 'w')
+
+
+def _map_log(log):
+    return '{}-{}'.format(log[0], log[1])
+
+
+def _reduce_logs(logs):
+    first = logs[0]
+
+    return {
+        'source': first[0],
+        'edge': 'http',
+        'target': first[1].split('/')[2],
+        'metadata': '{} requests'.format(len(logs)),
+    }
+
+
+class LogsAccumulator(Accumulator):
+    """
+    Keeps the first log entry of each group
+    """
+    def init(self, log):
+        return log
+
+    def update(self, state, log):
+        return state
+
+    def merge(self, state, other):
+        return state
+
+    def finalize(self, state, count):
+        return _reduce_logs([state])
+
+
+def _get_edges(size):
+    return list(generate_edges(size, nodes=max(10, size // 100)))
+
+
+def _get_tsv(size):
+    return ''.join(format_tsv_lines(_get_edges(size)))
+
+
+# name -> (prepare input for a given size, function to benchmark)
+BENCHMARKS = {
+    'format_tsv_lines': (_get_edges, format_tsv_lines),
+    'write_tsv_lines': (_get_edges, lambda edges: write_tsv_lines(edges, NULL_OUTPUT)),
+    'read_tsv_lines': (_get_tsv, lambda tsv: list(read_tsv_lines(StringIO(tsv)))),
+    'format_graphviz_lines': (_get_edges, format_graphviz_lines),
+    'write_graphviz_lines': (_get_edges, lambda edges: write_graphviz_lines(iter(edges), NULL_OUTPUT)),
+    'DataFlowGraph': (_get_edges, DataFlowGraph),
+    'logs_map_and_reduce': (lambda size: list(generate_logs(size)),
+                            lambda logs: logs_map_and_reduce(logs, _map_log, _reduce_logs)),
+    'logs_map_and_accumulate': (lambda size: list(generate_logs(size)),
+                                lambda logs: logs_map_and_accumulate(logs, _map_log, LogsAccumulator())),
+    'normalize_counts': (lambda size: [int(1000 / (1 + n % 1000)) for n in range(size)],
+                         lambda counts: format_values(normalize_counts(counts, floor=0.0001, window=86400)[0])),
+}
+
+
+def run_benchmark(name, size, repeat=3):
+    """
+    :type name str
+    :type size int
+    :type repeat int
+    :rtype: dict
+    """
+    (prepare, func) = BENCHMARKS[name]
+    data = prepare(size)
+
+    # throughput - the fastest of repeated runs is the least affected by the noise of other processes
+    gc.collect()
+    took = min(timeit.repeat(partial(func, data), number=1, repeat=repeat))
+
+    # peak memory (measured in a separate run as tracing slows the code down)
+    gc.collect()
+    tracemalloc.start()
+    func(data)
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'function': name,
+        'size': size,
+        'time': round(took, 6),
+        'records_per_sec': round(size / took, 1) if took else None,
+        'peak_memory': peak,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the list of regressions (throughput or peak memory worse by more than tolerance)
+
+    :type results list[dict]
+    :type baseline list[dict]
+    :type tolerance float
+    :rtype: list[str]
+    """
+    baseline = dict(((item['function'], item['size']), item) for item in baseline)
+    regressions = []
+
+    for item in results:
+        base = baseline.get((item['function'], item['size']))
+
+        if base is None:
+            continue
+
+        if item['records_per_sec'] < base['records_per_sec'] * (1 - tolerance):
+            regressions.append('{function} @ {size}: {records_per_sec:.0f} records/sec'.format(**item) +
+                               ' (baseline: {:.0f})'.format(base['records_per_sec']))
+
+        if item['peak_memory'] > base['peak_memory'] * (1 + tolerance):
+            regressions.append('{function} @ {size}: {peak_memory} bytes peak memory'.format(**item) +
+                               ' (baseline: {})'.format(base['peak_memory']))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sizes', default='100000,1000000', help='comma-separated list of input sizes')
+    parser.add_argument('--functions', default=','.join(sorted(BENCHMARKS)),
+                        help='comma-separated list of functions to benchmark')
+    parser.add_argument('--output', default='bench_results.json', help='where to store the results')
+    parser.add_argument('--baseline', help='results file recorded on the same machine to compare with')
+    parser.add_argument('--repeat', type=int, default=3, help='how many times each function is run')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown / memory increase')
+    args = parser.parse_args()
+
+    if args.baseline and not os.path.exists(args.baseline):
+        parser.error('{} does not exist, record the baseline first: run.py --output {}'.format(
+            args.baseline, args.baseline))
+
+    results = []
+
+    for name in args.functions.split(','):
+        for size in [int(size) for size in args.sizes.split(',')]:
+            result = run_benchmark(name, size, args.repeat)
+            results.append(result)
+
+            print('{function:25} {size:>10} {records_per_sec:>14.0f} records/sec {peak_memory:>14} bytes'.format(
+                **result))
+
+    with open(args.output, 'w') as fp:
+        json.dump(results, fp, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            regressions = compare(results, json.load(fp), args.tolerance)
+
+        for regression in regressions:
+            print('Regression: ' + regression)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,49 @@
 """
 Helper functions and classes used to generate data flow graphs
 """
-from collections import defaultdict, Counter, OrderedDict
+# pylint: disable=too-many-lines
+import gzip
+import hashlib
+import json
+import math
+import mmap
+import os
+import pickle
+import struct
+import sys
+import time
+
+from array import array
+from collections import Counter, OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from functools import wraps
+from heapq import heappop, heappush, merge as merge_sorted
+from itertools import chain, islice
+from multiprocessing import Pool, cpu_count
+from tempfile import TemporaryFile
+
+try:
+    from StringIO import StringIO  # Python 2
+except ImportError:
+    from io import StringIO
+
+try:
+    from sys import intern
+except ImportError:
+    pass  # Python 2 - a built-in function
+
+try:
+    import resource
+except ImportError:
+    resource = None  # not available on Windows
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # optional, speeds up normalize_counts (pip install data_flow_graph[numpy])
+
+# Python 2 does not have perf_counter
+_timer = getattr(time, 'perf_counter', time.time)
 
 
 def format_tsv_line(source, edge, target, value=None, metadata=None):
@@ -24,16 +66,600 @@ def format_tsv_line(source, edge, target, value=None, metadata=None):
     ).rstrip(' \t')
 
 
+class DataFlowGraph(object):  # pylint: disable=too-many-instance-attributes
+    """
+    Compact container for data flow graph edges
+
+    Node and edge strings are stored once in an index, edges are kept in arrays of integers
+    (string ids) and floats (values). Metadata is usually unique per edge, so it is packed into
+    a single buffer of new line terminated UTF-8 entries instead, edges keep offsets of their
+    entries.
+    Iterating over the graph yields (source, edge, target, value, metadata) tuples.
+    """
+    __slots__ = ('_strings', '_strings_index', '_sources', '_edges', '_targets', '_values',
+                 '_metadata', '_metadata_data', '_metadata_index')
+
+    # used to mark missing values and metadata
+    NO_VALUE = float('nan')
+    NO_METADATA = -1
+
+    # how many recently added metadata entries are reused by the following edges
+    METADATA_INDEX_SIZE = 10000
+
+    def __init__(self, lines=None):
+        """
+        :type lines collections.Iterable
+        """
+        self._strings = []
+        self._strings_index = {}
+
+        self._sources = array('i')
+        self._edges = array('i')
+        self._targets = array('i')
+        self._values = array('d')
+
+        self._metadata = array('i')
+        self._metadata_data = bytearray()
+        self._metadata_index = {}
+
+        if lines is not None:
+            self.add_lines(lines)
+
+    def _get_string_id(self, string):
+        """
+        :type string str
+        :rtype: int
+        """
+        string_id = self._strings_index.get(string)
+
+        if string_id is None:
+            string_id = len(self._strings)
+
+            self._strings.append(string)
+            self._strings_index[string] = string_id
+
+        return string_id
+
+    def _get_metadata_offset(self, metadata):
+        """
+        :type metadata str
+        :rtype: int
+        """
+        offset = self._metadata_index.get(metadata)
+
+        if offset is None:
+            # new lines terminate entries in the buffer (just like in TSV, metadata can not
+            # contain them)
+            if u'\n' in metadata:
+                raise ValueError('Metadata can not contain new lines: {!r}'.format(metadata))
+
+            offset = len(self._metadata_data)
+            self._metadata_data += metadata.encode('utf-8') + b'\n'
+
+            # the index is bounded - unique metadata is not kept in memory twice
+            if len(self._metadata_index) >= self.METADATA_INDEX_SIZE:
+                self._metadata_index.clear()
+
+            self._metadata_index[metadata] = offset
+
+        return offset
+
+    def add_edge(self, source, edge, target, value=None, metadata=None):
+        """
+        :type source str
+        :type edge str
+        :type target str
+        :type value float
+        :type metadata str
+        """
+        index = self._strings_index
+
+        # strings are usually indexed already, do not call _get_string_id for them
+        source_id = index[source] if source in index else self._get_string_id(source)
+        edge_id = index[edge] if edge in index else self._get_string_id(edge)
+        target_id = index[target] if target in index else self._get_string_id(target)
+
+        self._sources.append(source_id)
+        self._edges.append(edge_id)
+        self._targets.append(target_id)
+        self._values.append(value if value is not None else self.NO_VALUE)
+        self._metadata.append(self._get_metadata_offset(metadata) if metadata else self.NO_METADATA)
+
+    def add_lines(self, lines):
+        """
+        Add edges either as dicts (see format_tsv_line) or as tuples (see format_tsv_tuple)
+
+        :type lines collections.Iterable
+        """
+        for line in lines:
+            if isinstance(line, dict):
+                self.add_edge(**line)
+            else:
+                self.add_edge(*line)
+
+    def nodes(self):
+        """
+        Returns the set of all nodes (sources and targets)
+
+        :rtype: set[str]
+        """
+        strings = self._strings
+        return set(strings[node_id] for node_id in set(self._sources) | set(self._targets))
+
+    def lines(self):
+        """
+        Yields edges as dicts (see format_tsv_line)
+
+        :rtype: collections.Iterable
+        """
+        for (source, edge, target, value, metadata) in self:
+            line = {
+                'source': source,
+                'edge': edge,
+                'target': target,
+            }
+
+            if value is not None:
+                line['value'] = value
+
+            if metadata is not None:
+                line['metadata'] = metadata
+
+            yield line
+
+    def columns(self):
+        """
+        Returns the index of strings, the metadata buffer and
+        (sources, edges, targets, values, metadata offsets) arrays of edges
+
+        :rtype: tuple
+        """
+        return self._strings, self._metadata_data, \
+            (self._sources, self._edges, self._targets, self._values, self._metadata)
+
+    @classmethod
+    def from_columns(cls, strings, metadata_data, columns):
+        """
+        Creates a graph backed by a given index of strings, metadata buffer and
+        arrays (or memoryviews) of edges, see columns
+
+        :type strings list[str]
+        :type metadata_data bytes|bytearray
+        :type columns tuple[array.array|memoryview]
+        :rtype: DataFlowGraph
+        """
+        graph = cls()
+
+        graph._strings = strings
+        graph._strings_index = dict(zip(strings, range(len(strings))))
+
+        (graph._sources, graph._edges, graph._targets, graph._values, graph._metadata) = columns
+        graph._metadata_data = metadata_data
+
+        return graph
+
+    def __len__(self):
+        return len(self._sources)
+
+    def __iter__(self):
+        strings = self._strings
+        metadata_data = self._metadata_data
+
+        for source, edge, target, value, metadata in zip(
+                self._sources, self._edges, self._targets, self._values, self._metadata):
+            yield (
+                strings[source],
+                strings[edge],
+                strings[target],
+                value if not math.isnan(value) else None,  # NaN marks missing value
+                metadata_data[metadata:metadata_data.index(b'\n', metadata)].decode('utf-8')
+                if metadata != self.NO_METADATA else None,
+            )
+
+
+def format_tsv_tuple(line):
+    """
+    Render a single line for TSV file from (source, edge, target[, value[, metadata]]) tuple
+
+    :type line tuple
+    :rtype: str
+    """
+    return format_tsv_line(*line)
+
+
 def format_tsv_lines(lines):
     """
     Render a set of data into a list of TSV-formatted lines
 
-    :type lines list[dict]
+    :type lines list[dict]|DataFlowGraph
     :rtype: list[str]
     """
+    if isinstance(lines, DataFlowGraph):
+        return [format_tsv_line(*line) + '\n' for line in lines]
+
     return [format_tsv_line(**line) + '\n' for line in lines]
 
 
+def write_tsv_lines(lines, fp, chunk_size=1000):
+    """
+    Write a set of data as TSV-formatted lines to a given file-like object
+
+    Lines are rendered and written in chunks, so the whole output is never kept in memory.
+    Each line can either be a dict (see format_tsv_line) or a tuple (see format_tsv_tuple),
+    hence DataFlowGraph can be passed as well.
+
+    :type lines collections.Iterable|DataFlowGraph
+    :type fp file
+    :type chunk_size int
+    :rtype: int
+    """
+    count = 0
+    lines = iter(lines)
+
+    while True:
+        chunk = [
+            (format_tsv_line(**line) if isinstance(line, dict) else format_tsv_line(*line)) + '\n'
+            for line in islice(lines, chunk_size)
+        ]
+
+        if not chunk:
+            break
+
+        fp.write(''.join(chunk))
+        count += len(chunk)
+
+    return count
+
+
+def write_tsv_file(lines, path, compress=None, atomic=False):
+    """
+    Write a set of data as TSV-formatted lines to a given file
+
+    The file is gzipped when compress is set or when its name ends with ".gz".
+    When atomic is set, lines are written to a temporary file that then replaces the given one,
+    so readers never see a partially written file.
+
+    :type lines collections.Iterable
+    :type path str
+    :type compress bool
+    :type atomic bool
+    :rtype: int
+    """
+    if compress is None:
+        compress = path.endswith('.gz')
+
+    if atomic:
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+
+        try:
+            count = write_tsv_file(lines, temp_path, compress)
+            getattr(os, 'replace', os.rename)(temp_path, path)  # Python 2 does not have os.replace
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        return count
+
+    with (gzip.open(path, 'wt') if compress else open(path, 'w')) as fp:
+        return write_tsv_lines(lines, fp)
+
+
+def parse_tsv_line(line, as_tuple=False):
+    """
+    Parse a single line of TSV file with data flow described (the reverse of format_tsv_line)
+
+    Node and edge names are interned, so repeated strings are kept in memory only once.
+    Returns None for empty lines and comments (lines starting with #).
+
+    :type line str
+    :type as_tuple bool
+    :rtype: dict|tuple
+    """
+    line = line.rstrip('\r\n')
+
+    if line == '' or line.startswith('#'):
+        return None
+
+    parts = line.split('\t', 4)
+
+    if len(parts) < 3:
+        raise ValueError('Malformed TSV line: {}'.format(repr(line)))
+
+    source = intern(parts[0])
+    edge = intern(parts[1])
+    target = intern(parts[2])
+    value = float(parts[3]) if len(parts) > 3 and parts[3] != '' else None
+    metadata = parts[4] if len(parts) > 4 and parts[4] != '' else None
+
+    if as_tuple:
+        return source, edge, target, value, metadata
+
+    line = {
+        'source': source,
+        'edge': edge,
+        'target': target,
+    }
+
+    if value is not None:
+        line['value'] = value
+
+    if metadata is not None:
+        line['metadata'] = metadata
+
+    return line
+
+
+def read_tsv_lines(fp, as_tuples=False):
+    """
+    Lazily parse TSV-formatted lines from a given file-like object
+
+    :type fp file
+    :type as_tuples bool
+    :rtype: collections.Iterable
+    """
+    for line in fp:
+        line = parse_tsv_line(line, as_tuple=as_tuples)
+
+        if line is not None:
+            yield line
+
+
+def read_tsv_file(path, as_tuples=False):
+    """
+    Lazily parse TSV-formatted lines from a given (optionally gzipped) file
+
+    Use list(read_tsv_file(path)) to load all lines at once.
+
+    :type path str
+    :type as_tuples bool
+    :rtype: collections.Iterable
+    """
+    with (gzip.open(path, 'rt') if path.endswith('.gz') else open(path, 'r')) as fp:
+        for line in read_tsv_lines(fp, as_tuples=as_tuples):
+            yield line
+
+
+# binary format: header, strings table (UTF-8, separated with new lines - just like in TSV they
+# can not contain them), (source, edge, target) records, values (float32 unless they can not be
+# stored losslessly), metadata offsets and metadata entries (UTF-8, terminated with new lines);
+# all numbers are little-endian, string ids and metadata offsets are stored as the narrowest
+# signed integers that fit them
+BINARY_MAGIC = b'DFG\x02'
+# magic, flags, ids typecode, metadata offsets typecode, strings count, strings data size,
+# edges count, metadata data size
+BINARY_HEADER = struct.Struct('<4sIccIIII')
+BINARY_FLAG_DOUBLE_VALUES = 1
+BINARY_TYPECODES = ('b', 'h', 'i')
+
+
+def _get_binary_typecode(maximum):
+    """
+    Returns the narrowest signed integer typecode that can store values up to a given one (and -1)
+
+    :type maximum int
+    :rtype: str
+    """
+    for typecode in BINARY_TYPECODES:
+        if maximum < 2 ** (8 * struct.calcsize('<' + typecode) - 1):
+            return typecode
+
+    raise ValueError('{} does not fit the binary format'.format(maximum))
+
+
+def _get_binary_values(values):
+    """
+    Returns values as float32 array if they render the same in TSV, as float64 array otherwise
+
+    :type values array.array
+    :rtype: array.array
+    """
+    values_float = array('f', values)
+
+    for value, value_float in zip(values, values_float):
+        if not math.isnan(value) and '{:.4f}'.format(value) != '{:.4f}'.format(value_float):
+            return values
+
+    return values_float
+
+
+def _column_to_bytes(column):
+    """
+    :type column array.array
+    :rtype: bytes
+    """
+    if sys.byteorder != 'little':
+        column = array(column.typecode, column)
+        column.byteswap()
+
+    return column.tobytes() if hasattr(column, 'tobytes') else column.tostring()
+
+
+def _bytes_to_column(data, typecode):
+    """
+    Returns a zero-copy view of a given buffer (a copy on Python 2 and big-endian platforms)
+
+    :type data memoryview
+    :type typecode str
+    :rtype: memoryview|array.array
+    """
+    if sys.byteorder == 'little' and hasattr(data, 'cast'):
+        return data.cast(typecode)
+
+    column = array(typecode)
+    # Python 2 arrays do not have frombytes
+    (column.frombytes if hasattr(column, 'frombytes') else column.fromstring)(  # pylint: disable=no-member
+        data.tobytes())
+
+    if sys.byteorder != 'little':
+        column.byteswap()
+
+    return column
+
+
+def write_binary_lines(lines, fp):
+    """
+    Write a set of data in a compact binary format to a given file-like object
+    (opened in binary mode)
+
+    :type lines collections.Iterable|DataFlowGraph
+    :type fp file
+    :rtype: int
+    """
+    graph = lines if isinstance(lines, DataFlowGraph) else DataFlowGraph(lines)
+    (strings, metadata_data, (sources, edges, targets, values, metadata)) = graph.columns()
+
+    strings_data = u'\n'.join(strings).encode('utf-8')
+
+    # new lines separate strings in the table
+    if strings_data.count(b'\n') != max(len(strings) - 1, 0):
+        raise ValueError(
+            'Strings stored in the binary format can not contain new lines: {!r}'.format(
+                next(string for string in strings if u'\n' in string)))
+
+    ids_typecode = _get_binary_typecode(len(strings))
+    metadata_typecode = _get_binary_typecode(len(metadata_data))
+
+    records = array(ids_typecode, chain.from_iterable(zip(sources, edges, targets)))
+    values = _get_binary_values(values)
+
+    fp.write(BINARY_HEADER.pack(
+        BINARY_MAGIC,
+        BINARY_FLAG_DOUBLE_VALUES if values.typecode == 'd' else 0,
+        ids_typecode.encode('ascii'),
+        metadata_typecode.encode('ascii'),
+        len(strings),
+        len(strings_data),
+        len(graph),
+        len(metadata_data)
+    ))
+
+    fp.write(strings_data)
+    fp.write(_column_to_bytes(records))
+    fp.write(_column_to_bytes(values))
+    fp.write(_column_to_bytes(array(metadata_typecode, metadata)))
+    fp.write(metadata_data)
+
+    return len(graph)
+
+
+def write_binary_file(lines, path):
+    """
+    Write a set of data in a compact binary format to a given file
+
+    :type lines collections.Iterable|DataFlowGraph
+    :type path str
+    :rtype: int
+    """
+    with open(path, 'wb') as fp:
+        return write_binary_lines(lines, fp)
+
+
+_BinaryHeader = namedtuple('_BinaryHeader', [
+    'values_typecode', 'ids_typecode', 'metadata_typecode',
+    'strings_count', 'strings_size', 'edges_count', 'metadata_size'])
+
+
+def _read_binary_header(path, data):
+    """
+    Parses the header of a given binary file and checks that the file is complete
+
+    :type path str
+    :type data memoryview
+    :rtype: _BinaryHeader
+    """
+    (magic, flags, ids_typecode, metadata_typecode, strings_count, strings_size, edges_count,
+     metadata_size) = BINARY_HEADER.unpack(data[:BINARY_HEADER.size].tobytes())
+
+    # array typecodes are str (not unicode) on Python 2
+    typecodes = dict((typecode.encode('ascii'), typecode) for typecode in BINARY_TYPECODES)
+
+    header = _BinaryHeader(
+        'd' if flags & BINARY_FLAG_DOUBLE_VALUES else 'f',
+        typecodes.get(ids_typecode),
+        typecodes.get(metadata_typecode),
+        strings_count,
+        strings_size,
+        edges_count,
+        metadata_size
+    )
+
+    if magic != BINARY_MAGIC or header.ids_typecode is None or header.metadata_typecode is None:
+        raise ValueError('{} is not a data flow graph binary file'.format(path))
+
+    edge_size = sum(struct.calcsize('<' + typecode) for typecode in (
+        header.ids_typecode * 3, header.values_typecode, header.metadata_typecode))
+    expected_size = BINARY_HEADER.size + strings_size + edges_count * edge_size + metadata_size
+
+    if len(data) != expected_size:
+        raise ValueError('{} is truncated: {} bytes, {} expected'.format(
+            path, len(data), expected_size))
+
+    return header
+
+
+def read_binary_file(path):
+    """
+    Memory-maps a given binary file and returns a read-only DataFlowGraph backed by it
+
+    Only the strings table is decoded and metadata entries are copied, edges are read straight
+    from the mapped file.
+
+    :type path str
+    :rtype: DataFlowGraph
+    """
+    with open(path, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size < BINARY_HEADER.size:
+            raise ValueError('{} is not a data flow graph binary file'.format(path))
+
+        data = memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+
+    header = _read_binary_header(path, data)
+
+    offset = BINARY_HEADER.size
+    strings = data[offset:offset + header.strings_size].tobytes().decode('utf-8').split(u'\n') \
+        if header.strings_count else []
+
+    if len(strings) != header.strings_count:
+        raise ValueError('{} has {} strings, {} expected'.format(
+            path, len(strings), header.strings_count))
+
+    offset += header.strings_size
+    records_size = 3 * struct.calcsize('<' + header.ids_typecode) * header.edges_count
+    records = _bytes_to_column(data[offset:offset + records_size], header.ids_typecode)
+
+    offset += records_size
+    values_size = struct.calcsize('<' + header.values_typecode) * header.edges_count
+    values = _bytes_to_column(data[offset:offset + values_size], header.values_typecode)
+
+    offset += values_size
+    metadata_size = struct.calcsize('<' + header.metadata_typecode) * header.edges_count
+    metadata = _bytes_to_column(data[offset:offset + metadata_size], header.metadata_typecode)
+
+    offset += metadata_size
+    metadata_data = data[offset:].tobytes()
+
+    return DataFlowGraph.from_columns(
+        strings, metadata_data, (records[0::3], records[1::3], records[2::3], values, metadata))
+
+
+def convert_tsv_to_binary(tsv_path, binary_path):
+    """
+    :type tsv_path str
+    :type binary_path str
+    :rtype: int
+    """
+    return write_binary_file(DataFlowGraph(read_tsv_file(tsv_path, as_tuples=True)), binary_path)
+
+
+def convert_binary_to_tsv(binary_path, tsv_path):
+    """
+    :type binary_path str
+    :type tsv_path str
+    :rtype: int
+    """
+    return write_tsv_file(read_binary_file(binary_path), tsv_path)
+
+
 def escape_graphviz_entry(entry):
     """
     :type entry str
@@ -42,116 +668,2172 @@ def escape_graphviz_entry(entry):
     return entry.replace('"', '\\"')
 
 
-def format_graphviz_lines(lines):
+def aggregate_graphviz_edges(lines, aggregate='sum'):
     """
-    Render a .dot file with graph definition from a given set of data
+    Collapse duplicate edges (the same source, target and metadata) into a single one
+
+    Values of duplicate edges are either summed or the maximum one is taken.
+    Edges are returned in the order in which they were first seen.
+
+    :type lines collections.Iterable
+    :type aggregate str
+    :rtype: list[dict]
+    """
+    if aggregate not in ('sum', 'max'):
+        raise ValueError('Unsupported aggregate: {}'.format(aggregate))
+
+    edges = OrderedDict()
+
+    for line in lines:
+        key = (line['source'], line['target'], line.get('metadata', ''))
+        value = line.get('value')
+
+        edge = edges.get(key)
+
+        if edge is None:
+            edges[key] = dict(line)
+        elif value is not None:
+            if edge.get('value') is None:
+                edge['value'] = value
+            elif aggregate == 'sum':
+                edge['value'] += value
+            else:
+                edge['value'] = max(edge['value'], value)
+
+    return list(edges.values())
+
+
+def _get_graphviz_node_group(node):
+    """
+    Returns the group of a given node ("mysql" for "mysql:products") or None
+
+    :type node str
+    :rtype: str|None
+    """
+    return str(node).split(':', 1)[0] if ':' in node else None
+
+
+def _get_graphviz_super_nodes(lines, groups, min_node_value):
+    """
+    Returns the mapping of nodes to collapse to their super-nodes (see collapse_graphviz_groups)
 
     :type lines list[dict]
-    :rtype: str
+    :type groups bool|set|None
+    :type min_node_value float
+    :rtype: dict
     """
-    # first, prepare the unique list of all nodes (sources and targets)
-    lines_nodes = set()
+    # node -> the sum of values of its edges
+    weights = Counter()
 
     for line in lines:
-        lines_nodes.add(line['source'])
-        lines_nodes.add(line['target'])
+        for node in (line['source'], line['target']):
+            weights[node] += line.get('value') or 0
 
-    # generate a list of all nodes and their names for graphviz graph
-    nodes = OrderedDict()
+    # (group, is the whole group collapsed) -> nodes to collapse
+    collapsed = OrderedDict()
 
-    for i, node in enumerate(sorted(lines_nodes)):
-        nodes[node] = 'n{}'.format(i+1)
+    for node in sorted(weights):
+        group = _get_graphviz_node_group(node)
 
-    # print(lines_nodes, nodes)
+        if group is None:
+            continue
 
-    graph = list()
+        if groups is True or (groups is not None and group in groups):
+            collapsed.setdefault((group, True), []).append(node)
+        elif min_node_value is not None and weights[node] < min_node_value:
+            collapsed.setdefault((group, False), []).append(node)
 
-    # some basic style definition
-    # https://graphviz.gitlab.io/_pages/doc/info/lang.html
-    graph.append('digraph G {')
+    # node -> super-node
+    super_nodes = dict()
 
-    # https://graphviz.gitlab.io/_pages/doc/info/shapes.html#record
-    graph.append('\tgraph [ center=true, margin=0.75, nodesep=0.5, ranksep=0.75, rankdir=LR ];')
-    graph.append('\tnode [ shape=box, style="rounded,filled" width=0, height=0, '
-                 'fontname=Helvetica, fontsize=11 ];')
-    graph.append('\tedge [ fontname=Helvetica, fontsize=9 ];')
+    for (group, whole), nodes in collapsed.items():
+        # collapsing a single low-weight node would only hide its name
+        if not whole and len(nodes) < 2:
+            continue
 
-    # emit nodes definition
-    graph.append('\n\t// nodes')
+        name = '{}:{} {}'.format(group, len(nodes), 'nodes' if whole else 'other nodes')
 
-    # https://www.graphviz.org/doc/info/colors.html#brewer
-    group_colors = dict()
+        for node in nodes:
+            super_nodes[node] = name
 
-    for label, name in nodes.items():
-        if ':' in label:
-            (group, label) = str(label).split(':', 1)
+    return super_nodes
 
-            # register a new group for coloring
-            if group not in group_colors:
-                group_colors[group] = len(group_colors.keys()) + 1
-        else:
-            group = None
 
-        label = escape_graphviz_entry(label)
+def _merge_graphviz_super_nodes_edges(lines, super_nodes):
+    """
+    Returns [line, number of edges] pairs with edges of collapsed nodes merged
+    (see collapse_graphviz_groups)
 
-        graph.append('\t{name} [label="{label}"{group}];'.format(
-            name=name,
-            label="{}\\n{}".format(group, label) if group is not None else label,
-            group=' group="{}" colorscheme=pastel28 color={}'.format(
-                group, group_colors[group]) if group is not None else ''
-        ))
+    :type lines list[dict]
+    :type super_nodes dict
+    :rtype: list[list]
+    """
+    # (source, target) -> [merged line, number of edges], edges of other nodes are kept as they are
+    edges = OrderedDict()
 
-    # now, connect the nodes
-    graph.append('\n\t// edges')
     for line in lines:
-        label = line.get('metadata', '')
+        if line['source'] not in super_nodes and line['target'] not in super_nodes:
+            edges[len(edges)] = [line, 1]
+            continue
 
-        graph.append('\t{source} -> {target} [{label}];'.format(
-            source=nodes[line['source']],
-            target=nodes[line['target']],
-            label='label="{}"'.format(escape_graphviz_entry(label)) if label != '' else ''
-        ))
+        source = super_nodes.get(line['source'], line['source'])
+        target = super_nodes.get(line['target'], line['target'])
 
-    graph.append('}')
+        # edges between nodes of the same super-node would only be rendered as its self-loop
+        if source == target and line['source'] != line['target']:
+            continue
 
-    return '\n'.join(graph)
+        edge = edges.get((source, target))
 
+        if edge is None:
+            edges[(source, target)] = [dict(line, source=source, target=target), 1]
+            continue
 
-def logs_map_and_reduce(logs, _map, _reduce):
+        edge[1] += 1
+
+        if line.get('value') is not None:
+            edge[0]['value'] = (edge[0].get('value') or 0) + line['value']
+
+    return list(edges.values())
+
+
+def collapse_graphviz_groups(lines, groups=None, min_node_value=None, threshold=None):
     """
-    :type logs str[]
-    :type _map (list) -> str
-    :type _reduce (list) -> obj
+    Reduce the number of nodes and edges to render by collapsing groups of nodes into super-nodes
+
+    Nodes of the given groups (all groups when True) are collapsed into a single "group:N nodes"
+    node.
+    When min_node_value is set, nodes which weight (the sum of values of their edges) is below it
+    are collapsed into a "group:N other nodes" node of their group (ungrouped nodes are kept).
+    Edges between the same nodes are then merged - their values are summed and "N edges" is used
+    as metadata, edges between nodes collapsed into the same super-node are dropped.
+    Finally, edges with value below threshold are pruned (edges without a value are kept).
+
+    :type lines collections.Iterable|DataFlowGraph
+    :type groups bool|collections.Iterable
+    :type min_node_value float
+    :type threshold float
+    :rtype: list[dict]
     """
-    keys = []
-    mapped_count = Counter()
-    mapped = defaultdict(list)
+    lines = list(lines.lines() if isinstance(lines, DataFlowGraph) else lines)
+    groups = groups if groups is None or groups is True else set(groups)
 
-    # first map all entries
-    for log in logs:
-        key = _map(log)
-        mapped[key].append(log)
-        mapped_count[key] += 1
+    super_nodes = _get_graphviz_super_nodes(lines, groups, min_node_value)
+    merged = []
 
-        if key not in keys:
-            keys.append(key)
+    for (line, count) in _merge_graphviz_super_nodes_edges(lines, super_nodes):
+        if count > 1:
+            line['metadata'] = '{} edges'.format(count)
 
-    # the most common mapped item
-    top_count = mapped_count.most_common(1).pop()[1]
+        if threshold is not None and line.get('value') is not None and line['value'] < threshold:
+            continue
 
-    # now reduce mapped items
-    reduced = []
+        merged.append(line)
 
-    # keep the order under control
-    for key in keys:
-        entries = mapped[key]
-        # print(key, entries)
+    return merged
 
-        # add "value" field to each reduced item (1.0 will be assigned to the most "common" item)
-        item = _reduce(entries)
-        item['value'] = 1. * len(entries) / top_count
 
-        reduced.append(item)
+def _format_graphviz_edge_weight(value, max_value):
+    """
+    Map edge value to pen width (1 - 5) and layout weight (1 - 100)
 
-    # print(mapped)
-    return reduced
+    :type value float
+    :type max_value float
+    :rtype: str
+    """
+    ratio = 1. * value / max_value if max_value else 0
+
+    return 'penwidth={:.2f}, weight={:d}'.format(1 + 4 * ratio, int(round(1 + 99 * ratio)))
+
+
+def _read_spooled_edges(spool):
+    """
+    :type spool file
+    :rtype: collections.Iterable
+    """
+    try:
+        while True:
+            yield pickle.load(spool)
+    except EOFError:
+        pass
+    finally:
+        spool.close()
+
+
+def _spool_graphviz_edges(lines, lines_nodes):
+    """
+    Spool edges to a temporary file while collecting the set of all nodes
+
+    :type lines collections.Iterable
+    :type lines_nodes set
+    :rtype: collections.Iterable
+    """
+    spool = TemporaryFile()
+
+    for line in lines:
+        lines_nodes.add(line['source'])
+        lines_nodes.add(line['target'])
+
+        pickle.dump(line, spool, pickle.HIGHEST_PROTOCOL)
+
+    spool.seek(0)
+    return _read_spooled_edges(spool)
+
+
+def _get_graphviz_edges(lines, nodes, aggregate):
+    """
+    Returns (source, target, value, metadata, attributes) edges tuples, the set of all nodes and
+    the maximum value of edges (None when edges are not aggregated), see write_graphviz_lines
+
+    :type lines collections.Iterable|DataFlowGraph
+    :type nodes collections.Iterable
+    :type aggregate str
+    :rtype: tuple
+    """
+    max_value = None
+
+    if isinstance(lines, DataFlowGraph):
+        if aggregate is not None:
+            lines = list(lines.lines())
+        elif nodes is None:
+            nodes = lines.nodes()
+
+    if aggregate is not None:
+        lines = aggregate_graphviz_edges(lines, aggregate)
+        max_value = max([line['value'] for line in lines if line.get('value') is not None] or [0])
+
+        if nodes is None:
+            nodes = chain.from_iterable((line['source'], line['target']) for line in lines)
+
+    if nodes is not None:
+        lines_nodes = set(nodes)
+    else:
+        # first, prepare the unique list of all nodes (sources and targets)
+        lines_nodes = set()
+        lines = _spool_graphviz_edges(lines, lines_nodes)
+
+    if isinstance(lines, DataFlowGraph):
+        edges = ((source, target, value, metadata or '', None)
+                 for (source, _, target, value, metadata) in lines)
+    else:
+        edges = ((line['source'], line['target'], line.get('value'), line.get('metadata', ''),
+                  line.get('attributes'))
+                 for line in lines)
+
+    return edges, lines_nodes, max_value
+
+
+def _write_graphviz_nodes(fp, nodes, clusters):
+    """
+    Write nodes statements (in clusters of their groups when clusters is set)
+
+    :type fp file
+    :type nodes OrderedDict
+    :type clusters bool
+    """
+    # https://www.graphviz.org/doc/info/colors.html#brewer
+    group_colors = dict()
+
+    # group -> node statements to put in its cluster
+    clusters_nodes = OrderedDict()
+
+    for label, name in nodes.items():
+        if ':' in label:
+            (group, label) = str(label).split(':', 1)
+
+            # register a new group for coloring
+            if group not in group_colors:
+                group_colors[group] = len(group_colors.keys()) + 1
+        else:
+            group = None
+
+        label = escape_graphviz_entry(label)
+
+        node = '{name} [label="{label}"{group}];\n'.format(
+            name=name,
+            label="{}\\n{}".format(group, label) if group is not None else label,
+            group=' group="{}" colorscheme=pastel28 color={}'.format(
+                group, group_colors[group]) if group is not None else ''
+        )
+
+        if clusters and group is not None:
+            clusters_nodes.setdefault(group, []).append(node)
+        else:
+            fp.write('\t' + node)
+
+    # https://graphviz.gitlab.io/_pages/doc/info/lang.html#subgraphs-and-clusters
+    for i, (group, group_nodes) in enumerate(clusters_nodes.items()):
+        fp.write('\n\tsubgraph cluster_{} {{\n'.format(i + 1))
+        fp.write('\t\tlabel="{}"; style="rounded,dashed"; color=gray50; fontname=Helvetica; '
+                 'fontsize=11;\n'.format(escape_graphviz_entry(group)))
+
+        for node in group_nodes:
+            fp.write('\t\t' + node)
+
+        fp.write('\t}\n')
+
+
+def _write_graphviz_edges(fp, edges, nodes, max_value):
+    """
+    Write edges statements
+
+    :type fp file
+    :type edges collections.Iterable
+    :type nodes OrderedDict
+    :type max_value float
+    """
+    for (source, target, value, label, extra_attributes) in edges:
+        attributes = ['label="{}"'.format(escape_graphviz_entry(label))] if label != '' else []
+
+        if max_value is not None and value is not None:
+            attributes.append(_format_graphviz_edge_weight(value, max_value))
+
+        if extra_attributes:
+            attributes += [
+                '{}="{}"'.format(name, escape_graphviz_entry(str(extra_attributes[name])))
+                for name in sorted(extra_attributes)
+            ]
+
+        fp.write('\t{source} -> {target} [{attributes}];\n'.format(
+            source=nodes[source],
+            target=nodes[target],
+            attributes=', '.join(attributes)
+        ))
+
+
+def write_graphviz_lines(lines, fp, nodes=None, aggregate=None, clusters=False):
+    """
+    Write a .dot file with graph definition from a given set of data to a given file-like object
+
+    Node and edge statements are written as they are generated. When the list of nodes
+    (sources and targets) is not provided, edges are spooled to a temporary file
+    while the nodes are collected, so lines can be any iterable.
+
+    When aggregate is set ("sum" or "max") duplicate edges are collapsed
+    (see aggregate_graphviz_edges) and their values are mapped to penwidth and weight attributes.
+
+    Lines can carry additional edge attributes as an "attributes" dict (e.g. {'color': 'red'}).
+
+    When clusters is set, nodes of each group ("mysql" for "mysql:products") are put
+    in a "subgraph cluster_*" block (see collapse_graphviz_groups to render large graphs).
+
+    :type lines collections.Iterable|DataFlowGraph
+    :type fp file
+    :type nodes collections.Iterable
+    :type aggregate str
+    :type clusters bool
+    """
+    (edges, lines_nodes, max_value) = _get_graphviz_edges(lines, nodes, aggregate)
+
+    # generate a list of all nodes and their names for graphviz graph
+    nodes = OrderedDict()
+
+    for i, node in enumerate(sorted(lines_nodes)):
+        nodes[node] = 'n{}'.format(i+1)
+
+    # some basic style definition
+    # https://graphviz.gitlab.io/_pages/doc/info/lang.html
+    fp.write('digraph G {\n')
+
+    # https://graphviz.gitlab.io/_pages/doc/info/shapes.html#record
+    fp.write('\tgraph [ center=true, margin=0.75, nodesep=0.5, ranksep=0.75, rankdir=LR ];\n')
+    fp.write('\tnode [ shape=box, style="rounded,filled" width=0, height=0, '
+             'fontname=Helvetica, fontsize=11 ];\n')
+    fp.write('\tedge [ fontname=Helvetica, fontsize=9 ];\n')
+
+    # emit nodes definition
+    fp.write('\n\t// nodes\n')
+    _write_graphviz_nodes(fp, nodes, clusters)
+
+    # now, connect the nodes
+    fp.write('\n\t// edges\n')
+    _write_graphviz_edges(fp, edges, nodes, max_value)
+
+    fp.write('}\n')
+
+
+def format_graphviz_lines(lines, aggregate=None, clusters=False):
+    """
+    Render a .dot file with graph definition from a given set of data
+
+    :type lines list[dict]|DataFlowGraph
+    :type aggregate str
+    :type clusters bool
+    :rtype: str
+    """
+    graph = StringIO()
+
+    if isinstance(lines, DataFlowGraph):
+        write_graphviz_lines(lines, graph, aggregate=aggregate, clusters=clusters)
+    else:
+        # the list of nodes is known, do not spool the edges
+        nodes = chain.from_iterable((line['source'], line['target']) for line in lines)
+        write_graphviz_lines(lines, graph, nodes=nodes, aggregate=aggregate, clusters=clusters)
+
+    return graph.getvalue().rstrip('\n')
+
+
+# a single difference between two graphs, status is either "added", "removed" or "changed"
+GraphDiff = namedtuple('GraphDiff', ['status', 'source', 'edge', 'target',
+                                     'old_value', 'new_value', 'old_metadata', 'new_metadata'])
+
+# edge attributes used to render graphs diff
+GRAPH_DIFF_ATTRIBUTES = {
+    'added': {'color': 'green3', 'fontcolor': 'green4'},
+    'removed': {'color': 'red', 'fontcolor': 'red3', 'style': 'dashed'},
+    'changed': {'color': 'orange', 'fontcolor': 'orange3'},
+}
+
+
+def _get_diff_entry(line):
+    """
+    Returns ((source, edge, target), (value, metadata)) tuple for a given dict or tuple line
+
+    :type line dict|tuple
+    :rtype: tuple
+    """
+    if isinstance(line, dict):
+        return (line['source'], line['edge'], line['target']), \
+            (line.get('value'), line.get('metadata'))
+
+    line = tuple(line) + (None,) * (5 - len(line))
+    return line[:3], line[3:5]
+
+
+def _diff_edge(key, old, new, threshold, compare_metadata):
+    """
+    Compares (value, metadata) tuples of a given edge, returns None when they do not differ enough
+
+    :type key tuple
+    :type old tuple
+    :type new tuple
+    :type threshold float
+    :type compare_metadata bool
+    :rtype: GraphDiff
+    """
+    (source, edge, target) = key
+
+    if old is None:
+        return GraphDiff('added', source, edge, target, None, new[0], None, new[1])
+
+    if new is None:
+        return GraphDiff('removed', source, edge, target, old[0], None, old[1], None)
+
+    # missing values are compared as zeros
+    value_changed = abs((new[0] or 0.) - (old[0] or 0.)) > threshold
+    metadata_changed = compare_metadata and new[1] != old[1]
+
+    if value_changed or metadata_changed:
+        return GraphDiff('changed', source, edge, target, old[0], new[0], old[1], new[1])
+
+    return None
+
+
+def diff_graphs(old_lines, new_lines, threshold=0., compare_metadata=False):
+    """
+    Yields differences between two graphs (edges are keyed on source, edge and target)
+
+    Both graphs are kept in memory (a hash join). Added and changed edges are reported in the order
+    of new lines, then removed ones. An edge is changed when its value differs by more than
+    threshold (or metadata differs and compare_metadata is set). When an edge is given more than
+    once, its last line is used.
+
+    :type old_lines collections.Iterable
+    :type new_lines collections.Iterable
+    :type threshold float
+    :type compare_metadata bool
+    :rtype: collections.Iterable[GraphDiff]
+    """
+    old = OrderedDict(_get_diff_entry(line) for line in old_lines)
+    new = OrderedDict(_get_diff_entry(line) for line in new_lines)
+
+    for key, entry in new.items():
+        diff = _diff_edge(key, old.pop(key, None), entry, threshold, compare_metadata)
+
+        if diff is not None:
+            yield diff
+
+    for key, entry in old.items():
+        yield _diff_edge(key, entry, None, threshold, compare_metadata)
+
+
+def sort_graph_lines(lines, chunk_size=100000):
+    """
+    Yields (key, (value, metadata)) tuples sorted by (source, edge, target) key
+
+    Sorted chunks of chunk_size lines are spooled to temporary files and then merged, so the
+    input does not need to fit in memory. The order of lines with the same key is kept.
+
+    :type lines collections.Iterable
+    :type chunk_size int
+    :rtype: collections.Iterable
+    """
+    lines = iter(lines)
+    runs = []
+    index = 0
+
+    try:
+        while True:
+            # (key, index, entry) tuples - the index keeps the sort stable and never lets entries
+            # be compared
+            chunk = []
+
+            for line in islice(lines, chunk_size):
+                (key, entry) = _get_diff_entry(line)
+                chunk.append((key, index, entry))
+                index += 1
+
+            if not chunk:
+                break
+
+            chunk.sort()
+
+            run = TemporaryFile()
+            for item in chunk:
+                pickle.dump(item, run, protocol=pickle.HIGHEST_PROTOCOL)
+
+            run.seek(0)
+            runs.append(run)
+
+        for (key, _, entry) in merge_sorted(*[_read_spooled_edges(run) for run in runs]):
+            yield key, entry
+    finally:
+        for run in runs:
+            run.close()
+
+
+def _get_last_entries(sorted_entries):
+    """
+    Yields the last (key, entry) tuple of each key from a sorted sequence
+
+    :type sorted_entries collections.Iterable
+    :rtype: collections.Iterable
+    """
+    sorted_entries = iter(sorted_entries)
+    last = next(sorted_entries, None)
+
+    if last is None:
+        return
+
+    for item in sorted_entries:
+        if last[0] != item[0]:
+            yield last
+
+        last = item
+
+    yield last
+
+
+def diff_sorted_graphs(old_entries, new_entries, threshold=0., compare_metadata=False):
+    """
+    Streaming variant of diff_graphs for inputs sorted with sort_graph_lines
+
+    Only a single entry of each input is kept in memory, differences are yielded in the order
+    of keys.
+
+    :type old_entries collections.Iterable
+    :type new_entries collections.Iterable
+    :type threshold float
+    :type compare_metadata bool
+    :rtype: collections.Iterable[GraphDiff]
+    """
+    old_entries = _get_last_entries(old_entries)
+    new_entries = _get_last_entries(new_entries)
+
+    old = next(old_entries, None)
+    new = next(new_entries, None)
+
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            diff = _diff_edge(old[0], old[1], None, threshold, compare_metadata)
+            old = next(old_entries, None)
+        elif old is None or new[0] < old[0]:
+            diff = _diff_edge(new[0], None, new[1], threshold, compare_metadata)
+            new = next(new_entries, None)
+        else:
+            diff = _diff_edge(new[0], old[1], new[1], threshold, compare_metadata)
+            old = next(old_entries, None)
+            new = next(new_entries, None)
+
+        if diff is not None:
+            yield diff
+
+
+def diff_graph_files(old_path, new_path, threshold=0., compare_metadata=False,
+                     max_memory_size=64 * 1024 * 1024):
+    """
+    Yields differences between two (optionally gzipped) TSV files
+
+    Files up to max_memory_size bytes (in total) are compared in memory (see diff_graphs),
+    larger ones are sorted externally and merged (see diff_sorted_graphs).
+
+    :type old_path str
+    :type new_path str
+    :type threshold float
+    :type compare_metadata bool
+    :type max_memory_size int
+    :rtype: collections.Iterable[GraphDiff]
+    """
+    old_lines = read_tsv_file(old_path, as_tuples=True)
+    new_lines = read_tsv_file(new_path, as_tuples=True)
+
+    if os.path.getsize(old_path) + os.path.getsize(new_path) <= max_memory_size:
+        return diff_graphs(old_lines, new_lines, threshold, compare_metadata)
+
+    return diff_sorted_graphs(sort_graph_lines(old_lines), sort_graph_lines(new_lines),
+                              threshold, compare_metadata)
+
+
+def _format_graph_diff(diff):
+    """
+    :type diff GraphDiff
+    :rtype: str
+    """
+    if diff.status == 'added':
+        return 'added{}'.format(': {}'.format(diff.new_metadata) if diff.new_metadata else '')
+
+    if diff.status == 'removed':
+        return 'removed{}'.format(': {}'.format(diff.old_metadata) if diff.old_metadata else '')
+
+    (old_value, new_value) = (diff.old_value or 0., diff.new_value or 0.)
+    changes = ['value {:.4f} -> {:.4f} ({:+.4f})'.format(
+        old_value, new_value, new_value - old_value)]
+
+    if diff.old_metadata != diff.new_metadata:
+        changes.append('{} -> {}'.format(diff.old_metadata or '', diff.new_metadata or ''))
+
+    return 'changed: {}'.format(', '.join(changes))
+
+
+def _get_graph_diff_line(diff):
+    """
+    :type diff GraphDiff
+    :rtype: dict
+    """
+    line = {
+        'source': diff.source,
+        'edge': diff.edge,
+        'target': diff.target,
+        'metadata': _format_graph_diff(diff),
+    }
+
+    # removed edges keep their old value
+    value = diff.old_value if diff.status == 'removed' else diff.new_value
+
+    if value is not None:
+        line['value'] = value
+
+    return line
+
+
+def graph_diff_to_lines(diffs):
+    """
+    Yields TSV lines (see format_tsv_line) with the differences described in their metadata
+
+    :type diffs collections.Iterable[GraphDiff]
+    :rtype: collections.Iterable[dict]
+    """
+    for diff in diffs:
+        yield _get_graph_diff_line(diff)
+
+
+def graph_diff_to_graphviz_lines(diffs):
+    """
+    Yields lines for format_graphviz_lines with edges colored by the kind of change
+    (see GRAPH_DIFF_ATTRIBUTES)
+
+    :type diffs collections.Iterable[GraphDiff]
+    :rtype: collections.Iterable[dict]
+    """
+    for diff in diffs:
+        line = _get_graph_diff_line(diff)
+        line['attributes'] = GRAPH_DIFF_ATTRIBUTES[diff.status]
+
+        yield line
+
+
+def normalize_counts(counts, floor=None, window=None, per=1.):
+    """
+    Computes values, rates and the sort order for given counts of edges in a single pass
+
+    Returns (values, rates, order) tuple of lists:
+
+    * values - counts relative to the top one (it gets 1.0), not lower than floor (when given)
+    * rates - per * count / window, e.g. QPS or per=3600 for hourly rates
+      (None when window is not given)
+    * order - indices of counts starting with the most common one (equal counts keep their order)
+
+    NumPy is used when it's installed, the results are exactly the same without it.
+
+    :type counts list[int]
+    :type floor float
+    :type window float
+    :type per float
+    :rtype: tuple
+    """
+    if not counts:
+        return [], [] if window else None, []
+
+    if numpy is not None:
+        counts = numpy.asarray(counts, dtype=numpy.float64)
+
+        values = counts / counts.max()
+        if floor is not None:
+            numpy.maximum(values, floor, out=values)
+
+        rates = (per * counts / window).tolist() if window else None
+        order = numpy.argsort(-counts, kind='mergesort').tolist()  # a stable sort
+
+        return values.tolist(), rates, order
+
+    top_count = float(max(counts))
+
+    values = [count / top_count for count in counts]
+    if floor is not None:
+        values = [value if value >= floor else floor for value in values]
+
+    rates = [per * count / window for count in counts] if window else None
+    order = sorted(range(len(counts)), key=lambda index: -counts[index])
+
+    return values, rates, order
+
+
+def format_values(values, precision=4):
+    """
+    Renders values with a given precision (just like format_tsv_line does)
+
+    :type values list[float]
+    :type precision int
+    :rtype: list[str]
+    """
+    return list(map('{{:.{}f}}'.format(precision).format, values))
+
+
+class Accumulator(object):
+    """
+    Incremental reducer used by logs_map_and_accumulate.
+
+    Only a single, small state object is kept per mapped key. Sub-classes need to implement:
+
+    * init(log) - returns the state for the first log entry of a given key
+    * update(state, log) - returns the state updated with the next log entry of a given key
+    * merge(state, other) - returns the state combined from two partial states of a given key
+      (only required by logs_map_and_accumulate_parallel, other comes from later log entries)
+    * finalize(state, count) - returns a dict describing the edge (see format_tsv_line)
+    """
+    def init(self, log):
+        """
+        :type log obj
+        :rtype: obj
+        """
+        raise NotImplementedError()
+
+    def update(self, state, log):
+        """
+        :type state obj
+        :type log obj
+        :rtype: obj
+        """
+        raise NotImplementedError()
+
+    def merge(self, state, other):
+        """
+        :type state obj
+        :type other obj
+        :rtype: obj
+        """
+        raise NotImplementedError()
+
+    def finalize(self, state, count):
+        """
+        :type state obj
+        :type count int
+        :rtype: dict
+        """
+        raise NotImplementedError()
+
+
+class ListAccumulator(Accumulator):
+    """
+    Keeps all log entries for a given key and passes them to the list-based _reduce function
+
+    This is the compatibility path for logs_map_and_reduce
+    """
+    def __init__(self, _reduce):
+        """
+        :type _reduce (list) -> dict
+        """
+        self._reduce = _reduce
+
+    def init(self, log):
+        return [log]
+
+    def update(self, state, log):
+        state.append(log)
+        return state
+
+    def merge(self, state, other):
+        state.extend(other)
+        return state
+
+    def finalize(self, state, count):
+        return self._reduce(state)
+
+
+def _accumulate(logs, _map, accumulator):
+    """
+    Map and accumulate given logs
+
+    :type logs collections.Iterable
+    :type _map (obj) -> str
+    :type accumulator Accumulator
+    :rtype: OrderedDict
+    """
+    # key -> [state, count], the order of keys is kept
+    states = OrderedDict()
+
+    for log in logs:
+        key = _map(log)
+        entry = states.get(key)
+
+        if entry is None:
+            states[key] = [accumulator.init(log), 1]
+        else:
+            entry[0] = accumulator.update(entry[0], log)
+            entry[1] += 1
+
+    return states
+
+
+def _accumulate_chunk(args):
+    """
+    Process pool worker - returns partial states for a given chunk of logs
+
+    :type args tuple
+    :rtype: list
+    """
+    (logs, _map, accumulator) = args
+    return list(_accumulate(logs, _map, accumulator).items())
+
+
+def _finalize_states(states, accumulator):
+    """
+    :type states OrderedDict
+    :type accumulator Accumulator
+    :rtype: list[dict]
+    """
+    if not states:
+        return []
+
+    # "value" of each reduced item (1.0 will be assigned to the most "common" item)
+    (values, _, _) = normalize_counts([count for (_, count) in states.values()])
+
+    # now finalize the state of each key
+    reduced = []
+
+    for (state, count), value in zip(states.values(), values):
+        item = accumulator.finalize(state, count)
+        item['value'] = value
+
+        reduced.append(item)
+
+    return reduced
+
+
+def logs_map_and_accumulate(logs, _map, accumulator):
+    """
+    Single-pass, streaming variant of logs_map_and_reduce
+
+    Memory usage scales with the number of distinct keys, not the number of logs.
+    Items are returned in the order in which their keys were first seen.
+
+    :type logs collections.Iterable
+    :type _map (obj) -> str
+    :type accumulator Accumulator
+    :rtype: list[dict]
+    """
+    return _finalize_states(_accumulate(logs, _map, accumulator), accumulator)
+
+
+def logs_map_and_accumulate_parallel(logs, _map, accumulator, workers=None, chunk_size=50000):
+    """
+    Multi-core variant of logs_map_and_accumulate
+
+    Logs are split into chunks that are mapped and accumulated in a pool of processes.
+    Partial states are then merged (in the order of chunks) and the "value" is normalised
+    against the global top count. The result is the same as the one of logs_map_and_accumulate.
+
+    Both _map and accumulator need to be picklable (i.e. no lambdas). Inputs that fit
+    in a single chunk are processed serially.
+
+    :type logs collections.Iterable
+    :type _map (obj) -> str
+    :type accumulator Accumulator
+    :type workers int
+    :type chunk_size int
+    :rtype: list[dict]
+    """
+    workers = workers or cpu_count()
+
+    logs = iter(logs)
+    chunk = list(islice(logs, chunk_size))
+
+    # serial fallback
+    if workers == 1 or len(chunk) < chunk_size:
+        return logs_map_and_accumulate(chain(chunk, logs), _map, accumulator)
+
+    states = OrderedDict()
+
+    def merge(partial):
+        for key, (state, count) in partial:
+            entry = states.get(key)
+
+            if entry is None:
+                states[key] = [state, count]
+            else:
+                entry[0] = accumulator.merge(entry[0], state)
+                entry[1] += count
+
+    pool = Pool(workers)
+
+    try:
+        # keep a limited number of chunks in flight, results are merged in order
+        pending = deque()
+
+        while chunk:
+            pending.append(pool.apply_async(_accumulate_chunk, ((chunk, _map, accumulator),)))
+
+            if len(pending) > workers * 2:
+                merge(pending.popleft().get())
+
+            chunk = list(islice(logs, chunk_size))
+
+        while pending:
+            merge(pending.popleft().get())
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return _finalize_states(states, accumulator)
+
+
+def logs_map_and_reduce(logs, _map, _reduce):
+    """
+    :type logs str[]
+    :type _map (list) -> str
+    :type _reduce (list) -> obj
+    """
+    return logs_map_and_accumulate(logs, _map, ListAccumulator(_reduce))
+
+
+class SpaceSavingCounter(object):
+    """
+    Approximate counter of the most frequent keys with a fixed memory budget
+    (the Space-Saving algorithm)
+
+    At most capacity keys are tracked. When there is no room left for a new key, the least
+    frequent one is evicted and the new key inherits its count. Counts are therefore overestimated
+    by at most error(key) (zero for keys tracked since their first occurrence). Keys seen more
+    than total / capacity times are always tracked.
+
+    Counters can be merged, so partial results (e.g. from a pool of workers) can be combined.
+    A subset of collections.Counter interface is implemented (update, most_common, items,
+    item access).
+    """
+    def __init__(self, capacity=1000):
+        """
+        :type capacity int
+        """
+        self.capacity = capacity
+        self.total = 0
+
+        # key -> [count, error]
+        self._counts = dict()
+
+        # min-heap of (count, order, key) with a single entry per tracked key,
+        # counts only grow so entries can be stale - they're fixed when popped
+        self._heap = []
+        self._order = 0
+
+    def _push(self, key, count):
+        self._order += 1
+        heappush(self._heap, (count, self._order, key))
+
+    def _evict(self):
+        """
+        Removes the least frequent key and returns (key, count) tuple
+
+        :rtype: tuple
+        """
+        while True:
+            (count, _, key) = heappop(self._heap)
+            current = self._counts[key][0]
+
+            if current == count:
+                del self._counts[key]
+                return key, count
+
+            self._push(key, current)
+
+    def add(self, key, count=1):
+        """
+        Returns the key that was evicted to make room for a given one (None otherwise)
+
+        :type key obj
+        :type count int
+        :rtype: obj
+        """
+        self.total += count
+        entry = self._counts.get(key)
+
+        if entry is not None:
+            entry[0] += count
+            return None
+
+        evicted = None
+        error = 0
+
+        if len(self._counts) >= self.capacity:
+            (evicted, error) = self._evict()
+
+        self._counts[key] = [error + count, error]
+        self._push(key, error + count)
+
+        return evicted
+
+    def merge(self, other):
+        """
+        Combines counts from another counter, only the capacity most frequent keys are kept
+
+        :type other SpaceSavingCounter
+        """
+        other_counts = dict(other.items())
+
+        # keys not tracked by a full counter could have been seen up to its minimum count times
+        min_count = min(count for (count, _) in self._counts.values()) \
+            if len(self._counts) >= self.capacity else 0
+        other_min_count = min(other_counts.values()) if len(other_counts) >= other.capacity else 0
+
+        merged = []
+
+        for key in chain(self._counts, (key for key in other_counts if key not in self._counts)):
+            (count, error) = self._counts.get(key, (min_count, min_count))
+            (other_count, other_error) = (other_counts[key], other.error(key)) \
+                if key in other_counts else (other_min_count, other_min_count)
+
+            merged.append((key, count + other_count, error + other_error))
+
+        merged.sort(key=lambda item: item[1], reverse=True)
+
+        self.total += other.total
+        self._counts = dict((key, [count, error]) for (key, count, error) in merged[:self.capacity])
+        self._heap = []
+
+        for key, (count, _) in self._counts.items():
+            self._push(key, count)
+
+    def update(self, keys):
+        """
+        Counts keys from an iterable, a mapping of keys to counts or another SpaceSavingCounter
+
+        :type keys collections.Iterable|dict|SpaceSavingCounter
+        """
+        if isinstance(keys, SpaceSavingCounter):
+            self.merge(keys)
+        elif hasattr(keys, 'items'):
+            for key, count in keys.items():
+                self.add(key, count)
+        else:
+            for key in keys:
+                self.add(key)
+
+    def error(self, key):
+        """
+        Returns by how much the count of a given key can be overestimated
+
+        :type key obj
+        :rtype: int
+        """
+        entry = self._counts.get(key)
+        return entry[1] if entry is not None else 0
+
+    def most_common(self, n=None):
+        """
+        :type n int
+        :rtype: list[tuple]
+        """
+        items = sorted(self.items(), key=lambda item: item[1], reverse=True)
+        return items[:n] if n is not None else items
+
+    def items(self):
+        """
+        Returns (key, count) tuples of tracked keys
+
+        :rtype: list[tuple]
+        """
+        return [(key, count) for key, (count, _) in self._counts.items()]
+
+    def __getitem__(self, key):
+        entry = self._counts.get(key)
+        return entry[0] if entry is not None else 0
+
+    def __contains__(self, key):
+        return key in self._counts
+
+    def __iter__(self):
+        return iter(self._counts)
+
+    def __len__(self):
+        return len(self._counts)
+
+
+def logs_map_and_accumulate_top(logs, _map, accumulator, capacity=1000, other=None):
+    """
+    Bounded memory variant of logs_map_and_accumulate for high-cardinality keys
+
+    Only the capacity most frequent keys and their states are kept (see SpaceSavingCounter).
+    The state of an evicted key is dropped, a key that takes its place is finalized with the
+    state of its later log entries. Items are returned starting with the most frequent ones,
+    " (count error: N)" is added to the metadata of items with overestimated counts.
+
+    Provide other - a function returning the source node of a given log entry - to get the
+    count of all remaining log entries as an "other" edge of each source. Values are relative
+    to the most frequent edge, "other" ones included.
+
+    :type logs collections.Iterable
+    :type _map (obj) -> str
+    :type accumulator Accumulator
+    :type capacity int
+    :type other (obj) -> str
+    :rtype: list[dict]
+    """
+    counter = SpaceSavingCounter(capacity)
+
+    # key -> [state, source]
+    states = dict()
+
+    # source -> number of log entries
+    sources = OrderedDict()
+
+    for log in logs:
+        key = _map(log)
+        source = None
+
+        if other is not None:
+            source = other(log)
+            sources[source] = sources.get(source, 0) + 1
+
+        evicted = counter.add(key)
+        entry = states.get(key)
+
+        if entry is None:
+            states[key] = [accumulator.init(log), source]
+        else:
+            entry[0] = accumulator.update(entry[0], log)
+
+        if evicted is not None:
+            del states[evicted]
+
+    return _finalize_top_states(counter, states, accumulator, sources)
+
+
+def _finalize_top_states(counter, states, accumulator, sources):
+    """
+    Finalizes states of the most frequent keys and adds "other" edges of sources
+    (see logs_map_and_accumulate_top)
+
+    :type counter SpaceSavingCounter
+    :type states dict
+    :type accumulator Accumulator
+    :type sources OrderedDict
+    :rtype: list[dict]
+    """
+    top = counter.most_common()
+
+    if not top:
+        return []
+
+    # values of all edges ("other" ones included) are computed in bulk
+    reduced = []
+    counts = []
+
+    for key, count in top:
+        (state, source) = states[key]
+        error = counter.error(key)
+
+        item = accumulator.finalize(state, count)
+
+        if error:
+            item['metadata'] = '{} (count error: {})'.format(
+                item.get('metadata') or '', error).lstrip()
+
+        if source is not None:
+            # only the guaranteed part of the count is taken from the "other" edge
+            sources[source] -= count - error
+
+        reduced.append(item)
+        counts.append(count)
+
+    for source, count in sources.items():
+        if count > 0:
+            reduced.append({
+                'source': source,
+                'edge': 'other',
+                'target': 'other',
+                'metadata': '{} other entries'.format(count),
+            })
+            counts.append(count)
+
+    (values, _, _) = normalize_counts(counts)
+
+    for item, value in zip(reduced, values):
+        item['value'] = value
+
+    return reduced
+
+
+class HyperLogLog(object):
+    """
+    Approximate count of distinct values with a fixed memory budget
+
+    Uses 2^precision one-byte registers, the standard error is 1.04 / sqrt(2^precision)
+    (~3% for the default precision). Values are hashed with SHA-1, so sketches built
+    by different processes (or machines) can be merged and serialised with to_bytes().
+    """
+    __slots__ = ('precision', '_registers')
+
+    def __init__(self, precision=10):
+        """
+        :type precision int
+        """
+        if not 4 <= precision <= 16:
+            raise ValueError(
+                'HyperLogLog precision needs to be between 4 and 16, got {}'.format(precision))
+
+        self.precision = precision
+        self._registers = bytearray(1 << precision)
+
+    def add(self, value):
+        """
+        :type value str|bytes
+        """
+        if not isinstance(value, bytes):
+            value = u'{}'.format(value).encode('utf-8')
+
+        (value_hash,) = struct.unpack('<Q', hashlib.sha1(value).digest()[:8])
+
+        # the first bits select the register, the rank of the first set bit of the rest is stored
+        index = value_hash >> (64 - self.precision)
+        rest = value_hash & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+
+    def update(self, values):
+        """
+        :type values collections.Iterable
+        """
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        """
+        :type other HyperLogLog
+        """
+        if other.precision != self.precision:
+            raise ValueError(
+                'Can not merge HyperLogLog sketches of different precision ({} and {})'.format(
+                    self.precision, other.precision))
+
+        self._registers = bytearray(
+            max(pair) for pair in zip(self._registers, other._registers))  # pylint: disable=protected-access
+
+    def count(self):
+        """
+        :rtype: int
+        """
+        size = len(self._registers)
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(size, 0.7213 / (1 + 1.079 / size))
+
+        estimate = alpha * size * size / sum(2. ** -register for register in self._registers)
+        zeros = self._registers.count(0)
+
+        # small range correction
+        if estimate <= 2.5 * size and zeros:
+            estimate = size * math.log(1. * size / zeros)
+
+        return int(round(estimate))
+
+    def to_bytes(self):
+        """
+        :rtype: bytes
+        """
+        return bytes(bytearray([self.precision]) + self._registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        :type data bytes
+        :rtype: HyperLogLog
+        """
+        data = bytearray(data)
+        sketch = cls(precision=data[0])
+
+        if len(data) != len(sketch._registers) + 1:
+            raise ValueError('Malformed HyperLogLog sketch: {} bytes'.format(len(data)))
+
+        sketch._registers = data[1:]
+        return sketch
+
+    def __getstate__(self):
+        return self.to_bytes()
+
+    def __setstate__(self, state):
+        data = bytearray(state)
+
+        self.precision = data[0]
+        self._registers = data[1:]
+
+
+def format_distinct_count(count, label):
+    """
+    :type count int
+    :type label str
+    :rtype: str
+    """
+    return u'\u2248{} distinct {}'.format(count, label)  # "almost equal to" sign
+
+
+class DistinctCountAccumulator(Accumulator):
+    """
+    Wraps an accumulator and adds the approximate number of distinct values to the metadata
+    of its edges
+
+    _distinct returns the value (e.g. host, user or query fingerprint) to count for a given log
+    entry, "~N distinct label" is then appended to the metadata. Memory used per edge does not
+    depend on the number of distinct values (see HyperLogLog).
+    """
+    def __init__(self, accumulator, _distinct, label, precision=10):
+        """
+        :type accumulator Accumulator
+        :type _distinct (obj) -> str
+        :type label str
+        :type precision int
+        """
+        self.accumulator = accumulator
+        self._distinct = _distinct
+        self.label = label
+        self.precision = precision
+
+    def init(self, log):
+        sketch = HyperLogLog(self.precision)
+        sketch.add(self._distinct(log))
+
+        return [self.accumulator.init(log), sketch]
+
+    def update(self, state, log):
+        state[0] = self.accumulator.update(state[0], log)
+        state[1].add(self._distinct(log))
+
+        return state
+
+    def merge(self, state, other):
+        state[0] = self.accumulator.merge(state[0], other[0])
+        state[1].merge(other[1])
+
+        return state
+
+    def finalize(self, state, count):
+        item = self.accumulator.finalize(state[0], count)
+        distinct = format_distinct_count(state[1].count(), self.label)
+
+        item['metadata'] = u'{}, {}'.format(item['metadata'], distinct) \
+            if item.get('metadata') else distinct
+        return item
+
+
+class PartialAggregate(object):
+    """
+    Raw per-edge counts, sums of values and time spans that can be merged before the graph
+    is rendered
+
+    Unlike TSV lines, where values are already normalised to the local top edge, partial aggregates
+    from many hosts or runs can be combined (see merge and merge_partial_files). Values and rates
+    are computed once, by lines(). start and end tell the time span the aggregate covers
+    (used to compute rates).
+
+    Partial aggregates are stored as TSV files with the following columns:
+    source, edge, target, count, sum of values, first timestamp, last timestamp
+    """
+    HEADER = '# partial aggregate'
+
+    def __init__(self, start=None, end=None):
+        """
+        :type start float
+        :type end float
+        """
+        self.start = start
+        self.end = end
+
+        # (source, edge, target) -> [count, sum of values, first timestamp, last timestamp]
+        self._edges = OrderedDict()
+
+    @classmethod
+    def from_counts(cls, counts, start=None, end=None):
+        """
+        Creates a partial aggregate from a mapping of edges - (source, edge, target) tuples
+        or tab-separated strings - to their counts (e.g. Counter or RollingWindowCounter.counts())
+
+        :type counts dict
+        :type start float
+        :type end float
+        :rtype: PartialAggregate
+        """
+        aggregate = cls(start, end)
+
+        for key, count in counts.items():
+            (source, edge, target) = key.split('\t', 2) if isinstance(key, str) else key
+            aggregate.add(source, edge, target, count)
+
+        return aggregate
+
+    def add(self, source, edge, target, count=1, value=0., timestamp=None, last=None):  # pylint: disable=too-many-arguments
+        """
+        Adds count occurrences of an edge, last is the timestamp of the last one when count > 1
+        (timestamp is then the first one)
+
+        :type source str
+        :type edge str
+        :type target str
+        :type count int
+        :type value float
+        :type timestamp float
+        :type last float
+        """
+        key = (source, edge, target)
+        entry = self._edges.get(key)
+
+        if last is None:
+            last = timestamp
+
+        if entry is None:
+            self._edges[key] = [count, value, timestamp, last]
+            return
+
+        entry[0] += count
+        entry[1] += value
+        entry[2] = _min_timestamp(entry[2], timestamp)
+        entry[3] = _max_timestamp(entry[3], last)
+
+    def items(self):
+        """
+        Yields (source, edge, target, count, sum of values, first timestamp, last timestamp) tuples
+
+        :rtype: collections.Iterable[tuple]
+        """
+        for (source, edge, target), (count, value, first, last) in self._edges.items():
+            yield source, edge, target, count, value, first, last
+
+    def merge(self, other):
+        """
+        :type other PartialAggregate
+        """
+        self.start = _min_timestamp(self.start, other.start)
+        self.end = _max_timestamp(self.end, other.end)
+
+        for (source, edge, target, count, value, first, last) in other.items():
+            self.add(source, edge, target, count, value, first, last)
+
+    def lines(self, fn=None, window=None, per=1., floor=None):
+        """
+        Yields lines (see format_tsv_line) with values relative to the top edge
+
+        fn(count, sum of values, rate) returns the metadata of an edge,
+        rate is per * count / window.
+        The window defaults to the time span of the aggregate.
+
+        :type fn (int, float, float) -> str
+        :type window float
+        :type per float
+        :type floor float
+        :rtype: collections.Iterable[dict]
+        """
+        if window is None and self.start is not None and self.end is not None:
+            window = self.end - self.start
+
+        entries = list(self._edges.items())
+        (values, rates, _) = normalize_counts(
+            [entry[0] for (_, entry) in entries], floor, window, per)
+
+        for index, ((source, edge, target), (count, value_sum, _, _)) in enumerate(entries):
+            line = {
+                'source': source,
+                'edge': edge,
+                'target': target,
+                'value': values[index],
+            }
+
+            if fn is not None:
+                line['metadata'] = fn(count, value_sum, rates[index] if rates is not None else None)
+
+            yield line
+
+    def write(self, fp):
+        """
+        :type fp file
+        :rtype: int
+        """
+        fp.write('{}\t{}\t{}\n'.format(
+            self.HEADER, _format_timestamp(self.start), _format_timestamp(self.end)))
+
+        for (source, edge, target, count, value, first, last) in self.items():
+            fp.write('{}\t{}\t{}\t{:d}\t{!r}\t{}\t{}\n'.format(
+                source, edge, target, count, value,
+                _format_timestamp(first), _format_timestamp(last)))
+
+        return len(self._edges)
+
+    @classmethod
+    def read(cls, fp):
+        """
+        :type fp file
+        :rtype: PartialAggregate
+        """
+        aggregate = cls()
+
+        for line in fp:
+            line = line.rstrip('\r\n')
+
+            if line.startswith(cls.HEADER):
+                (_, start, end) = line.split('\t')
+                aggregate.merge(cls(_parse_timestamp(start), _parse_timestamp(end)))
+                continue
+
+            if line == '' or line.startswith('#'):
+                continue
+
+            parts = line.split('\t')
+
+            if len(parts) != 7:
+                raise ValueError('Malformed partial aggregate line: {}'.format(repr(line)))
+
+            aggregate.add(intern(parts[0]), intern(parts[1]), intern(parts[2]),
+                          int(parts[3]), float(parts[4]),
+                          _parse_timestamp(parts[5]), _parse_timestamp(parts[6]))
+
+        return aggregate
+
+    def __len__(self):
+        return len(self._edges)
+
+
+def _min_timestamp(first, second):
+    return first if second is None else second if first is None else min(first, second)
+
+
+def _max_timestamp(first, second):
+    return first if second is None else second if first is None else max(first, second)
+
+
+def _format_timestamp(timestamp):
+    return repr(float(timestamp)) if timestamp is not None else ''
+
+
+def _parse_timestamp(timestamp):
+    return float(timestamp) if timestamp != '' else None
+
+
+def write_partial_file(aggregate, path):
+    """
+    Write a partial aggregate to a given (gzipped when its name ends with ".gz") file
+
+    :type aggregate PartialAggregate
+    :type path str
+    :rtype: int
+    """
+    with (gzip.open(path, 'wt') if path.endswith('.gz') else open(path, 'w')) as fp:
+        return aggregate.write(fp)
+
+
+def read_partial_file(path):
+    """
+    :type path str
+    :rtype: PartialAggregate
+    """
+    with (gzip.open(path, 'rt') if path.endswith('.gz') else open(path, 'r')) as fp:
+        return PartialAggregate.read(fp)
+
+
+def _merge_partial_files(paths):
+    """
+    Process pool worker - reads and merges given partial aggregate files
+
+    :type paths list[str]
+    :rtype: PartialAggregate
+    """
+    merged = PartialAggregate()
+
+    for path in paths:
+        merged.merge(read_partial_file(path))
+
+    return merged
+
+
+def merge_partial_files(paths, workers=None):
+    """
+    Read and merge any number of partial aggregate files using a pool of processes
+
+    Each worker merges a contiguous group of files, so edges are kept in the order
+    in which they were first seen in the files.
+
+    :type paths list[str]
+    :type workers int
+    :rtype: PartialAggregate
+    """
+    paths = list(paths)
+    workers = min(workers or cpu_count(), len(paths))
+
+    if workers <= 1:
+        return _merge_partial_files(paths)
+
+    groups = [
+        paths[len(paths) * i // workers:len(paths) * (i + 1) // workers]
+        for i in range(workers)
+    ]
+    pool = Pool(workers)
+
+    try:
+        partials = pool.map(_merge_partial_files, groups)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    merged = partials[0]
+
+    for partial in partials[1:]:
+        merged.merge(partial)
+
+    return merged
+
+
+def logs_to_partial_aggregate(logs, _edge, _timestamp=None, _value=None):
+    """
+    Count edges of given log entries into a partial aggregate
+
+    _edge returns (source, edge, target) tuple for a log entry (or None to skip it), optional
+    _timestamp and _value return its time and the value to sum (e.g. the response size).
+
+    :type logs collections.Iterable
+    :type _edge (obj) -> tuple
+    :type _timestamp (obj) -> float
+    :type _value (obj) -> float
+    :rtype: PartialAggregate
+    """
+    aggregate = PartialAggregate()
+
+    for log in logs:
+        key = _edge(log)
+
+        if key is None:
+            continue
+
+        (source, edge, target) = key
+        timestamp = _timestamp(log) if _timestamp is not None else None
+        aggregate.add(source, edge, target, 1, _value(log) if _value is not None else 0., timestamp)
+
+        aggregate.start = _min_timestamp(aggregate.start, timestamp)
+        aggregate.end = _max_timestamp(aggregate.end, timestamp)
+
+    return aggregate
+
+
+class RollingWindowCounter(object):
+    """
+    Counts keys (e.g. edges) in fixed-size time buckets
+
+    Counts for any window up to max_window seconds (and peak rates) can then be
+    computed from the buckets. Buckets older than max_window seconds (relative
+    to the most recent timestamp seen) are evicted, so memory usage is bounded.
+
+    Set capacity to keep only approximate counts of the most frequent keys in each
+    bucket (see SpaceSavingCounter) - counts() returns SpaceSavingCounter then.
+
+    Otherwise, counts for the whole max_window are kept up to date as keys are added
+    and buckets are evicted. Set track_changes to get the keys which counts changed
+    since the last pop_changed() call - graphs can then be updated incrementally.
+    """
+    def __init__(self, bucket_size=60, max_window=86400, capacity=None, track_changes=False):
+        """
+        :type bucket_size int
+        :type max_window int
+        :type capacity int
+        :type track_changes bool
+        """
+        if capacity and track_changes:
+            raise ValueError('Changes can not be tracked for approximate counts')
+
+        self.bucket_size = bucket_size
+        self.max_window = max_window
+        self.capacity = capacity
+
+        # bucket id -> {key: count} (or SpaceSavingCounter)
+        self._buckets = dict()
+        self._last_bucket = None
+
+        # key -> count in the whole max_window
+        self._totals = dict() if not capacity else None
+
+        # keys which counts changed since the last pop_changed() call
+        self._changed = set() if track_changes else None
+
+    def _evict(self):
+        """
+        Remove buckets that are no longer in the max_window
+        """
+        oldest_bucket = self._last_bucket - self.max_window // self.bucket_size
+
+        for bucket in [bucket for bucket in self._buckets if bucket <= oldest_bucket]:
+            counts = self._buckets.pop(bucket)
+
+            if self._totals is None:
+                continue
+
+            for key, count in counts.items():
+                total = self._totals[key] - count
+
+                if total:
+                    self._totals[key] = total
+                else:
+                    del self._totals[key]
+
+            if self._changed is not None:
+                self._changed.update(counts)
+
+    def advance(self, timestamp):
+        """
+        Move the window forward (e.g. to the current time when no keys are added)
+        and evict old buckets
+
+        :type timestamp float
+        """
+        bucket = int(timestamp // self.bucket_size)
+
+        if self._last_bucket is None or bucket > self._last_bucket:
+            self._last_bucket = bucket
+            self._evict()
+
+    def add(self, key, timestamp, count=1):
+        """
+        :type key str
+        :type timestamp float
+        :type count int
+        """
+        bucket = int(timestamp // self.bucket_size)
+        self.advance(timestamp)
+
+        if bucket <= self._last_bucket - self.max_window // self.bucket_size:
+            # too old, outside of the window
+            return
+
+        counts = self._buckets.get(bucket)
+
+        if counts is None:
+            counts = self._buckets[bucket] = \
+                SpaceSavingCounter(self.capacity) if self.capacity else dict()
+
+        if self.capacity:
+            counts.add(key, count)
+            return
+
+        counts[key] = counts.get(key, 0) + count
+        self._totals[key] = self._totals.get(key, 0) + count
+
+        if self._changed is not None:
+            self._changed.add(key)
+
+    def pop_changed(self):
+        """
+        Returns the set of keys which counts (in the whole max_window) changed since the last call
+
+        :rtype: set
+        """
+        if self._changed is None:
+            raise ValueError('RollingWindowCounter needs to be created with track_changes=True')
+
+        (changed, self._changed) = (self._changed, set())
+        return changed
+
+    def _get_buckets(self, window, now):
+        """
+        :type window int
+        :type now float
+        :rtype: list[dict]
+        """
+        if self._last_bucket is None:
+            return []
+
+        window = window or self.max_window
+        last_bucket = int(now // self.bucket_size) if now is not None else self._last_bucket
+        oldest_bucket = last_bucket - window // self.bucket_size
+
+        return [
+            self._buckets[bucket]
+            for bucket in sorted(self._buckets)
+            if oldest_bucket < bucket <= last_bucket
+        ]
+
+    def counts(self, window=None, now=None):
+        """
+        Returns per-key counts for the last window seconds (up to the most recent timestamp or now)
+
+        :type window int
+        :type now float
+        :rtype: collections.Counter|SpaceSavingCounter
+        """
+        # counts for the whole window are kept up to date
+        if self._totals is not None and now is None and \
+                (window is None or window >= self.max_window):
+            return Counter(self._totals)
+
+        counts = SpaceSavingCounter(self.capacity) if self.capacity else Counter()
+
+        for bucket in self._get_buckets(window, now):
+            counts.update(bucket)
+
+        return counts
+
+    def total(self, key):
+        """
+        Returns the count of a given key in the whole max_window (without copying all counts)
+
+        :type key str
+        :rtype: int
+        """
+        if self._totals is None:
+            raise ValueError('Totals are not kept for approximate counts')
+
+        return self._totals.get(key, 0)
+
+    def rates(self, window=None, now=None):
+        """
+        Returns per-key average rates (per second) for the last window seconds
+
+        :type window int
+        :type now float
+        :rtype: dict
+        """
+        window = window or self.max_window
+
+        return dict(
+            (key, 1. * count / window)
+            for key, count in self.counts(window, now).items()
+        )
+
+    def peak_rates(self, window=None, now=None):
+        """
+        Returns per-key peak rates (per second, in a single bucket) for the last window seconds
+
+        :type window int
+        :type now float
+        :rtype: dict
+        """
+        peaks = dict()
+
+        for bucket in self._get_buckets(window, now):
+            for key, count in bucket.items():
+                if count > peaks.get(key, 0):
+                    peaks[key] = count
+
+        return dict(
+            (key, 1. * count / self.bucket_size)
+            for key, count in peaks.items()
+        )
+
+
+class LRUCache(object):
+    """
+    Dict-like cache that keeps up to maxsize most recently used items
+
+    Cache hits and misses are counted.
+    """
+    def __init__(self, maxsize=10000):
+        """
+        :type maxsize int
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        :type key obj
+        :type default obj
+        :rtype: obj
+        """
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        # mark as the most recently used one
+        self._items[key] = value
+        self.hits += 1
+
+        return value
+
+    def __setitem__(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+
+        if len(self._items) > self.maxsize:
+            # remove the least recently used one
+            self._items.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def hit_rate(self):
+        """
+        :rtype: float
+        """
+        total = self.hits + self.misses
+        return 1. * self.hits / total if total else 0.
+
+
+class PipelineStage(object):  # pylint: disable=too-few-public-methods
+    """
+    Timings and records counts of a single pipeline stage
+    """
+    __slots__ = ('name', 'time', 'calls', 'records_in', 'records_out')
+
+    def __init__(self, name):
+        """
+        :type name str
+        """
+        self.name = name
+        self.time = 0.
+        self.calls = 0
+        self.records_in = 0
+        self.records_out = 0
+
+    def as_dict(self):
+        """
+        :rtype: dict
+        """
+        return OrderedDict([
+            ('stage', self.name),
+            ('time', round(self.time, 6)),
+            ('calls', self.calls),
+            ('records_in', self.records_in),
+            ('records_out', self.records_out),
+            ('records_per_sec',
+             round(max(self.records_in, self.records_out) / self.time, 1) if self.time else None),
+        ])
+
+
+class _NoopStage(object):
+    """
+    Stand-in for PipelineStage used when instrumentation is disabled
+    """
+    __slots__ = ('records_in', 'records_out')
+
+    def __init__(self):
+        self.records_in = 0
+        self.records_out = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class Instrumentation(object):
+    """
+    Collects per-stage timings, records counts, cache hit rates and peak RSS of a pipeline
+
+    Stages register themselves via stage() context manager, timed() decorator or iterate() wrapper.
+    When disabled, all of them are no-ops.
+    """
+    def __init__(self, enabled=True):
+        """
+        :type enabled bool
+        """
+        self.enabled = enabled
+        self.stages = OrderedDict()
+        self.caches = OrderedDict()
+
+    def _get_stage(self, name):
+        """
+        :type name str
+        :rtype: PipelineStage
+        """
+        stage = self.stages.get(name)
+
+        if stage is None:
+            stage = self.stages[name] = PipelineStage(name)
+
+        return stage
+
+    @contextmanager
+    def _timed_stage(self, name):
+        stage = self._get_stage(name)
+        start = _timer()
+
+        try:
+            yield stage
+        finally:
+            stage.time += _timer() - start
+            stage.calls += 1
+
+    def stage(self, name):
+        """
+        Context manager that times a given stage, records counts can be updated on the yielded
+        object
+
+        with instrumentation.stage('output') as stage:
+            stage.records_out += write_tsv_lines(lines, fp)
+
+        :type name str
+        """
+        if not self.enabled:
+            return _NoopStage()
+
+        return self._timed_stage(name)
+
+    def timed(self, name):
+        """
+        Decorator that times calls of a given function as a stage
+
+        Each call is counted as a record in, each result that is not None as a record out.
+
+        :type name str
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+
+                with self._timed_stage(name) as stage:
+                    stage.records_in += 1
+                    res = func(*args, **kwargs)
+
+                    if res is not None:
+                        stage.records_out += 1
+
+                    return res
+
+            return wrapper
+
+        return decorator
+
+    def iterate(self, name, iterable):
+        """
+        Wraps the iterable, time spent on getting items from it is counted towards a given stage
+
+        :type name str
+        :type iterable collections.Iterable
+        :rtype: collections.Iterable
+        """
+        if not self.enabled:
+            return iterable
+
+        return self._iterate(self._get_stage(name), iter(iterable))
+
+    @staticmethod
+    def _iterate(stage, iterator):
+        stage.calls += 1
+
+        while True:
+            start = _timer()
+
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                stage.time += _timer() - start
+
+            stage.records_out += 1
+            yield item
+
+    def add_cache(self, name, cache):
+        """
+        Register cache (e.g. LRUCache) - its hits and misses will be reported
+
+        :type name str
+        :type cache LRUCache
+        """
+        if self.enabled:
+            self.caches[name] = cache
+
+    def summary(self):
+        """
+        :rtype: dict
+        """
+        return OrderedDict([
+            ('stages', [stage.as_dict() for stage in self.stages.values()]),
+            ('caches', [
+                OrderedDict([
+                    ('cache', name),
+                    ('hits', cache.hits),
+                    ('misses', cache.misses),
+                    ('hit_rate', round(cache.hit_rate, 4)),
+                ])
+                for name, cache in self.caches.items()
+            ]),
+            ('peak_rss', get_peak_rss()),
+        ])
+
+    def format_json(self):
+        """
+        :rtype: str
+        """
+        return json.dumps(self.summary())
+
+    def format_tsv_comments(self):
+        """
+        Summary as a list of TSV comment lines, to be written as a header before the data
+
+        :rtype: list[str]
+        """
+        summary = self.summary()
+        lines = []
+
+        for stage in summary['stages']:
+            lines.append('# stage {stage}: {time:.3f} sec, {records_in} records in, '
+                         '{records_out} records out, '
+                         '{records_per_sec} records/sec\n'.format(**stage))
+
+        for cache in summary['caches']:
+            lines.append('# cache {cache}: {hits} hits, {misses} misses, '
+                         '{hit_rate:.2%} hit rate\n'.format(**cache))
+
+        if summary['peak_rss'] is not None:
+            lines.append('# peak RSS: {:.1f} MiB\n'.format(summary['peak_rss'] / 1024. / 1024))
+
+        return lines
+
+
+def get_peak_rss():
+    """
+    Returns the peak resident set size of the current process in bytes (None when not available)
+
+    :rtype: int
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
@@ -40,6 +40,10 @@ setup(
     ],
     py_modules=["data_flow_graph"],
     extras_require={
+        # speeds up normalize_counts
+        'numpy': [
+            'numpy',
+        ],
         'dev': [
             'coverage==4.5.2',
             'pylint>=1.9.2, <=2.1.1',  # 2.x branch is for Python 3
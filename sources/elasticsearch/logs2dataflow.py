@@ -4,17 +4,34 @@ This script demonstates how to transform SQL logs fetched from elasticsearch int
 """
 from __future__ import print_function
 
+import calendar
 import collections
+import os
 import time
 import logging
 import re
+import sys
+import threading
 
 from datetime import datetime
 from dateutil import tz
 
+try:
+	from Queue import Queue, Full  # Python 2
+except ImportError:
+	from queue import Queue, Full
+
+try:
+	from StringIO import StringIO  # Python 2
+except ImportError:
+	from io import StringIO
+
 import sqlparse
 from elasticsearch import Elasticsearch
 
+from data_flow_graph import Instrumentation, LRUCache, PartialAggregate, RollingWindowCounter, SpaceSavingCounter, \
+	format_values, normalize_counts, write_partial_file, write_tsv_lines
+
 logging.basicConfig(
 	level=logging.INFO,
 	format='%(asctime)s %(name)-35s %(levelname)-8s %(message)s',
@@ -23,6 +40,45 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# the time window the graph is built for (in seconds)
+WINDOW = 86400
+
+# counts are kept in time buckets of this size (in seconds)
+BUCKET_SIZE = 60
+
+# set DATAFLOW_TOP_K to keep approximate counts of only that many most frequent edges per bucket
+# (bounded memory for high-cardinality entries), see SpaceSavingCounter
+TOP_K = int(os.environ.get('DATAFLOW_TOP_K', 0)) or None
+
+# set DATAFLOW_PARTIALS to a directory to store raw counts of each graph section there (see PartialAggregate),
+# partial aggregates from many hosts / runs can then be merged with sources/partials/merge-partials.py
+PARTIALS_DIR = os.environ.get('DATAFLOW_PARTIALS')
+
+# Elasticsearch to fetch logs from (point ES_HOST / ES_PORT to a local stub when testing)
+ES_HOST = os.environ.get('ES_HOST', '127.0.0.1')
+ES_PORT = int(os.environ.get('ES_PORT', 59200))
+
+# legacy - "@timestamp gt since" paging (Elasticsearch 2.x)
+# pit - point-in-time with search_after paging (Elasticsearch 7.10+)
+# sliced - pit paging with ES_SLICES slices fetched concurrently
+ES_FETCH_MODE = os.environ.get('ES_FETCH_MODE', 'legacy')
+ES_SLICES = int(os.environ.get('ES_SLICES', 4))
+
+# fields of log messages that are used to build the graph
+SQL_SOURCE_FIELDS = ['@timestamp', '@message', '@fields.database.name', '@fields.http_method',
+	'@context.exception.trace', '@context.method']
+HOST_SOURCE_FIELDS = ['@timestamp', '@source_host']
+
+# count redis / s3 operations using Elasticsearch composite aggregations (Elasticsearch 7.2+)
+ES_PUSHDOWN = os.environ.get('ES_PUSHDOWN') == '1'
+
+# set DATAFLOW_STATS=1 to get per-stage timings, records counts and cache hit rates
+instrumentation = Instrumentation(enabled=os.environ.get('DATAFLOW_STATS') == '1')
+
+
+def get_es():
+	return Elasticsearch(host=ES_HOST, port=ES_PORT, timeout=120)
+
 
 def format_index_name(ts, prefix='syslog-ng_'):
 	tz_info = tz.tzutc()
@@ -42,6 +98,13 @@ def es_get_timestamp_filer(since=None):
         } if since is not None else {}
 
 
+def parse_timestamp(value):
+	"""
+	Parse the UTC timestamp from Elasticsearch (e.g. 2014-07-09T08:37:18.000Z) into UNIX timestamp
+	"""
+	return calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+
+
 def format_timestamp(ts):
         """
         Format the UTC timestamp for Elasticsearch
@@ -56,16 +119,13 @@ def get_log_messages(query, extra=None, now=None, limit=10000, batch=10000, retu
 	logger = logging.getLogger('get_log_messages')
 
 	# connect to es
-	es = Elasticsearch(host='127.0.0.1', port=59200, timeout=120)
+	es = get_es()
 
 	# take logs from the last day and today (last 24h)
 	if now is None:
 		now = int(time.time())
 
-	indices = ','.join([
-		format_index_name(now - 86400),
-		format_index_name(now)
-	])
+	indices = get_indices(now)
 
 	# search
 	body = {
@@ -82,7 +142,7 @@ def get_log_messages(query, extra=None, now=None, limit=10000, batch=10000, retu
 		body.update(extra)
 
 	items = 0
-	since = format_timestamp(now-86400)
+	since = format_timestamp(now - WINDOW)
 
 	logger.info('Querying for "{}" since {} (limit set to {}, will query in batches of {} items)'.format(query, since, limit, batch))
 
@@ -116,6 +176,162 @@ def get_log_messages(query, extra=None, now=None, limit=10000, batch=10000, retu
 	logger.info('Limit of {} results reached, returned {} results so far'.format(limit, items))
 
 
+def get_indices(now):
+	# take logs from the last day and today (last 24h)
+	return ','.join([
+		format_index_name(now - 86400),
+		format_index_name(now)
+	])
+
+
+def open_point_in_time(es, indices, keep_alive='5m'):
+	# @see https://www.elastic.co/guide/en/elasticsearch/reference/current/point-in-time-api.html
+	res = es.transport.perform_request('POST', '/{}/_pit'.format(indices), params={'keep_alive': keep_alive})
+	return res['id']
+
+
+def close_point_in_time(es, pit_id):
+	es.transport.perform_request('DELETE', '/_pit', body={'id': pit_id})
+
+
+def get_log_messages_after(es, pit_id, query, since, batch=10000, source_fields=None, slice_id=None, slices=None, keep_alive='5m'):
+	"""
+	Page through log messages using point-in-time and search_after
+
+	Hits are sorted by @timestamp with _shard_doc as a tiebreaker, so hits sharing the same timestamp are never skipped.
+	@see https://www.elastic.co/guide/en/elasticsearch/reference/current/paginate-search-results.html#search-after
+	"""
+	body = {
+		"query": {
+			"bool": {
+				"must": {
+					"query_string": {
+						"query": query,
+					}
+				},
+				"filter": es_get_timestamp_filer(since),
+			}
+		},
+		"size": batch,
+		"sort": [{"@timestamp": "asc"}, {"_shard_doc": "asc"}],
+		"pit": {"id": pit_id, "keep_alive": keep_alive},
+		"track_total_hits": False,
+	}
+
+	if source_fields is not None:
+		body["_source"] = source_fields
+
+	# @see https://www.elastic.co/guide/en/elasticsearch/reference/current/paginate-search-results.html#slice-scroll
+	if slices is not None:
+		body["slice"] = {"id": slice_id, "max": slices}
+
+	while True:
+		res = es.search(body=body)
+		hits = res['hits']['hits']
+
+		if not hits:
+			return
+
+		for hit in hits:
+			yield hit['_source']
+
+		body["search_after"] = hits[-1]['sort']
+		body["pit"]["id"] = res.get('pit_id', body["pit"]["id"])
+
+
+def get_log_messages_pit(query, now=None, batch=10000, source_fields=None, slices=None, es=None):
+	"""
+	Yield all log messages from the last WINDOW seconds using point-in-time and search_after paging
+
+	When slices is set, the point-in-time is split into as many slices that are fetched concurrently
+	(the order of yielded messages is not kept then).
+	"""
+	logger = logging.getLogger('get_log_messages_pit')
+
+	es = es or get_es()
+
+	if now is None:
+		now = int(time.time())
+
+	since = format_timestamp(now - WINDOW)
+	pit_id = open_point_in_time(es, get_indices(now))
+
+	logger.info('Querying for "{}" since {} (in batches of {} items, {} slices)'.format(query, since, batch, slices))
+
+	# set when the generator is closed (or fails), fetching threads stop then
+	stop = threading.Event()
+	threads = []
+
+	try:
+		if not slices:
+			for hit in get_log_messages_after(es, pit_id, query, since, batch, source_fields):
+				yield hit
+			return
+
+		results = Queue(maxsize=batch * slices)
+		errors = []
+		done = object()
+
+		def put(item):
+			# do not block forever on a full queue that is no longer consumed
+			while not stop.is_set():
+				try:
+					results.put(item, timeout=0.1)
+					return True
+				except Full:
+					pass
+
+			return False
+
+		def fetch_slice(slice_id):
+			try:
+				for hit in get_log_messages_after(es, pit_id, query, since, batch, source_fields, slice_id, slices):
+					if not put(hit):
+						return
+			except Exception as ex:  # re-raised in the main thread
+				errors.append(ex)
+			finally:
+				put(done)
+
+		threads = [threading.Thread(target=fetch_slice, args=(slice_id,)) for slice_id in range(slices)]
+
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+
+		running = slices
+		while running > 0:
+			hit = results.get()
+
+			if hit is done:
+				running -= 1
+			else:
+				yield hit
+
+		if errors:
+			raise errors[0]
+	finally:
+		# the point-in-time is closed once all threads stopped paging through it
+		stop.set()
+
+		for thread in threads:
+			thread.join()
+
+		close_point_in_time(es, pit_id)
+
+
+def fetch_log_messages(query, source_fields=None):
+	"""
+	Yield all matching log messages using ES_FETCH_MODE
+	"""
+	if ES_FETCH_MODE == 'pit':
+		return get_log_messages_pit(query, source_fields=source_fields)
+	elif ES_FETCH_MODE == 'sliced':
+		return get_log_messages_pit(query, source_fields=source_fields, slices=ES_SLICES)
+	else:
+		return get_log_messages(query, extra={"_source": source_fields} if source_fields else None, limit=None)
+
+
 def get_log_aggregate(query, group_by, stats_field):
 	# @see https://www.elastic.co/guide/en/elasticsearch/reference/2.0/search-aggregations.html
 	# @see https://www.elastic.co/guide/en/elasticsearch/reference/2.0/search-aggregations-metrics-stats-aggregation.html
@@ -149,7 +365,169 @@ def get_log_aggregate(query, group_by, stats_field):
 	return buckets, stats
 
 
-def get_query_metadata(query):
+def get_log_composite_aggregate(query, group_by, sum_field=None, bucket_size=None, now=None, batch=1000, es=None):
+	"""
+	Group log messages by given fields and count them (and sum sum_field) in Elasticsearch
+
+	group_by is a list of (name, field) tuples. Yields (key, doc_count, sum) tuples, where key is a dict
+	with bucket values for each name. All buckets are fetched by paging through after_key.
+
+	When bucket_size is set, messages are grouped by time buckets of that many seconds as well
+	(key['bucket'] is the bucket start in milliseconds).
+
+	@see https://www.elastic.co/guide/en/elasticsearch/reference/current/search-aggregations-bucket-composite-aggregation.html
+	"""
+	es = es or get_es()
+
+	if now is None:
+		now = int(time.time())
+
+	composite = {
+		"size": batch,
+		"sources": [{name: {"terms": {"field": field}}} for (name, field) in group_by]
+	}
+
+	if bucket_size is not None:
+		composite["sources"].append(
+			{"bucket": {"date_histogram": {"field": "@timestamp", "fixed_interval": "{}s".format(bucket_size)}}})
+
+	body = {
+		"size": 0,
+		"query": {
+			"bool": {
+				"must": {
+					"query_string": {
+						"query": query,
+					}
+				},
+				"filter": es_get_timestamp_filer(format_timestamp(now - WINDOW)),
+			}
+		},
+		"aggregations": {
+			"edges": {
+				"composite": composite,
+			}
+		}
+	}
+
+	if sum_field is not None:
+		body["aggregations"]["edges"]["aggregations"] = {"sum": {"sum": {"field": sum_field}}}
+
+	while True:
+		res = es.search(index=get_indices(now), body=body)
+		agg = res['aggregations']['edges']
+
+		for bucket in agg['buckets']:
+			yield bucket['key'], bucket['doc_count'], bucket['sum']['value'] if sum_field is not None else None
+
+		if not agg['buckets'] or 'after_key' not in agg:
+			return
+
+		composite["after"] = agg['after_key']
+
+
+def get_edges_aggregate(query, group_by, to_edge, sum_field=None, batch=1000):
+	"""
+	Push "group by (source, edge, target) and count / sum" down to Elasticsearch
+
+	to_edge maps the bucket key (see get_log_composite_aggregate) to (source, edge, target) tuple.
+	Yields (source, edge, target, count, sum, peak rate) tuples (buckets that map to the same edge are combined).
+	Just like RollingWindowCounter.peak_rates does, the peak rate is the per-second rate in the busiest time bucket.
+	"""
+	# edge -> [count, sum, time bucket -> count]
+	edges = collections.OrderedDict()
+
+	for (key, count, total) in get_log_composite_aggregate(query, group_by, sum_field, BUCKET_SIZE, batch=batch):
+		entry = edges.setdefault(to_edge(key), [0, None, collections.Counter()])
+
+		entry[0] += count
+		entry[1] = entry[1] + total if entry[1] is not None else total
+		entry[2][key['bucket']] += count
+
+	for ((source, edge, target), (count, total, buckets)) in edges.items():
+		yield source, edge, target, count, total, 1. * max(buckets.values()) / BUCKET_SIZE
+
+
+def edges_to_lines(fn, edges, name=None):
+	"""
+	Turn (source, edge, target, count, sum, peak rate) tuples into (source, edge, target, value, metadata) lines
+
+	fn(count, sum, peak rate) returns the metadata
+	"""
+	edges = list(edges)
+
+	if PARTIALS_DIR and name:
+		now = time.time()
+		aggregate = PartialAggregate(start=now - WINDOW, end=now)
+
+		for (source, edge, target, count, total, _) in edges:
+			aggregate.add(source, edge, target, count, total or 0.)
+
+		write_partial(aggregate, name)
+
+	(values, _, _) = normalize_counts([count for (_, _, _, count, _, _) in edges], floor=0.0001)
+
+	return sorted(
+		(source, edge, target, values[index], fn(count, total, peak))
+		for index, (source, edge, target, count, total, peak) in enumerate(edges)
+	)
+
+
+# used to normalise queries into fingerprints - string literals and numbers (the lookahead makes it fail fast) and IN-lists
+SQL_LITERALS_RE = re.compile(r"""(?=['"\d])(?:'[^'\\]*(?:\\.[^'\\]*)*'|"[^"\\]*(?:\\.[^"\\]*)*"|\b\d+(?:\.\d+)?\b)""")
+SQL_IN_LIST_RE = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+
+# FROM foo, INTO foo, JOIN foo, UPDATE foo, DESCRIBE foo followed by an optional alias and a list of other tables
+# (FROM foo AS f, bar b), the leading character class (instead of \b) lets the regex engine skip to keywords quickly
+SQL_ALIAS = r'(?:\s+(?:AS\s+)?(?!(?:JOIN|INNER|LEFT|RIGHT|OUTER|CROSS|STRAIGHT_JOIN|NATURAL|WHERE|SET|ON|USING|GROUP|ORDER|LIMIT|HAVING|UNION|FOR|VALUES|VALUE|SELECT|USE|FORCE|IGNORE|PARTITION|LOCK)\b)\w+)?'
+SQL_TABLES_RE = re.compile(r'[\s(](?:FROM|INTO|JOIN|UPDATE|DESCRIBE)\s+`?(\w+)`?' + SQL_ALIAS + r'((?:\s*,\s*`?\w+`?' + SQL_ALIAS + r')*)')
+SQL_TABLES_LIST_RE = re.compile(r',\s*`?(\w+)')
+
+# digits of cache keys are replaced with zeros (see get_query_key)
+try:
+	SQL_KEY_DIGITS = bytes.maketrans(b'0123456789', b'0000000000')
+except AttributeError:
+	from string import maketrans  # Python 2
+	SQL_KEY_DIGITS = maketrans('0123456789', '0000000000')
+
+# query key -> (kind, tables) for queries differing with literals only
+QUERY_METADATA_CACHE = LRUCache(maxsize=10000)
+
+
+def get_query_fingerprint(query):
+	"""
+	Normalise the query into a canonical template, e.g.
+
+	SELECT * FROM products WHERE id IN (1, 2, 3) AND name = 'foo'
+	SELECT * FROM products WHERE id IN (?) AND name = ?
+	"""
+	query = SQL_LITERALS_RE.sub('?', query)
+	query = SQL_IN_LIST_RE.sub('IN (?)', query)
+
+	return ' '.join(query.split())
+
+
+def get_query_key(query):
+	"""
+	Returns a cache key that is the same for queries differing with numbers and string literals only, e.g.
+
+	SELECT * FROM products WHERE id = 123 AND name = 'foo'
+	SELECT * FROM products WHERE id = 0 AND name =
+
+	It is several times cheaper to get than the fingerprint - string methods are used instead of regular expressions.
+	None is returned for queries with escaped or double-quoted strings (literals can not be skipped this way then).
+	"""
+	if '\\' in query or '"' in query:
+		return None
+
+	# skip the content of single-quoted strings and collapse numbers into a single zero
+	# (spaces around the query keep the leading and trailing ones)
+	key = (' ' + ''.join(query.split("'")[::2]) + ' ').encode('utf-8').translate(SQL_KEY_DIGITS)
+
+	return b'0'.join(filter(None, key.split(b'0')))
+
+
+def parse_query_metadata(query):
 	# @see https://pypi.python.org/pypi/sqlparse
 	res = None #  sqlparse.parse(query)
 	if res:
@@ -165,30 +543,40 @@ def get_query_metadata(query):
 
 	kind = query.split(' ')[0]
 
-	try:
-		# SELECT FROM, INSERT INTO
-		matches = re.search(r'(FROM|INTO) (\w+)', query)
-		return (kind, (matches.group(2),))
-	except:
-		pass
+	# SELECT FROM, INSERT INTO, UPDATE foo SET ..., DESCRIBE foo (the first table is the one that is written to),
+	# ON DUPLICATE KEY UPDATE lists columns, not tables
+	query = ' ' + query.partition(' ON DUPLICATE KEY UPDATE ')[0]
+	tables = []
 
-	try:
-		# UPDATE foo SET ...
-		matches = re.search(r'(\w+) SET', query) if 'UPDATE' in query else None
-		return (kind, (matches.group(1),))
-	except:
-		pass
+	for (table, tables_list) in SQL_TABLES_RE.findall(query):
+		for table in [table] + SQL_TABLES_LIST_RE.findall(tables_list):
+			if table not in tables:
+				tables.append(table)
+
+	if not tables:
+		return None
+
+	return (kind, tuple(tables))
 
-	try:
-		# DESCRIBE foo
-		matches = re.search(r'DESCRIBE (\w+)', query)
-		return (kind, (matches.group(1),))
-	except:
-		pass
 
-	return None
+def get_query_metadata(query):
+	"""
+	Returns (kind, tables) tuple for a given query, results are cached by the query key (see get_query_key)
+	"""
+	key = get_query_key(query)
+	meta = QUERY_METADATA_CACHE.get(key, False) if key is not None else False
+
+	if meta is False:
+		meta = parse_query_metadata(get_query_fingerprint(query))
+
+		# numbers are collapsed in keys, so products_1 and products_2 tables would share them - do not cache these
+		if key is not None and (meta is None or not re.search(r'\d', ''.join(meta[1]))):
+			QUERY_METADATA_CACHE[key] = meta
 
+	return meta
 
+
+@instrumentation.timed('extract_metadata')
 def extract_metadata(message):
 	query = re.sub(r'^SQL ', '', message.get('@message'))
 	meta = get_query_metadata(query)
@@ -197,8 +585,7 @@ def extract_metadata(message):
 		# logger.info('extract_metadata failed: {} - {}'.format(query[:120].encode('utf8'), meta));
 		return None
 
-	(kind, table) = meta
-	table = table[0]  # TODO: handle more tables
+	(kind, tables) = meta
 
 	# sphinx or mysql?
 	db = message.get('@fields').get('database').get('name')
@@ -218,118 +605,241 @@ def extract_metadata(message):
 	return dict(
 		db=db if db == 'sphinx' else 'mysql',
 		kind=kind,  # SELECT
-		table=table,  # products
+		tables=tables,  # (products, )
 		method=method,
-		web_request='http_method' in message.get('@fields', {})
+		web_request='http_method' in message.get('@fields', {}),
+		timestamp=parse_timestamp(message.get('@timestamp'))
 	)
 
 
-def build_flow_entry(meta):
-	table = '{}:{}'.format(meta.get('db'),meta.get('table'))
+def build_flow_entries(meta):
 	(cls, edge) = meta.get('method').split('::')
-	reads = meta.get('kind') not in ['INSERT', 'UPDATE', 'DELETE']
-
-	# code -> method -> DB table (if the code writes to DB)
-	# DB -> method -> code (if the code reads to DB)
-	return "{source}\t{edge}\t{target}".format(
-		source=table if reads else cls,
-		edge=edge,
-		target=cls if reads else table
-	)
+	writes = meta.get('kind') in ['INSERT', 'UPDATE', 'DELETE', 'REPLACE']
 
-def unique(fn, iterable):
-	# for stats and weighting entries
-	c = collections.Counter(iterable)
-	max_value = c.most_common(1)[0][1]
-
-	def format_item(item):
-		cnt = c[item]
+	entries = []
 
-		weight = 1. * cnt / max_value
-		if weight < 0.0001:
-			weight = 0.0001
+	for (i, table) in enumerate(meta.get('tables')):
+		table = '{}:{}'.format(meta.get('db'), table)
 
-		metadata = fn(item, cnt) if fn else ''
+		# code -> method -> DB table (if the code writes to DB - the first table of the query)
+		# DB -> method -> code (if the code reads to DB - e.g. INSERT INTO ... SELECT FROM or UPDATE ... JOIN)
+		if writes and i == 0:
+			entries.append("{source}\t{edge}\t{target}".format(source=cls, edge=edge, target=table))
+		else:
+			entries.append("{source}\t{edge}\t{target}".format(source=table, edge=edge, target=cls))
 
-		return item + "\t{:.4f}\t{}".format(weight, metadata).rstrip()
+	return entries
 
-	return sorted(map(format_item, iterable))
+def count_in_window(entries):
+	"""
+	Count (entry, timestamp) tuples in time buckets
+	"""
+	counter = RollingWindowCounter(bucket_size=BUCKET_SIZE, max_window=WINDOW, capacity=TOP_K)
 
-# take SQL logs from elasticsearch
-sql_logs = get_log_messages(query='@message: /SQL.*/', limit=None)  # None - return ALL matching messages
+	for (entry, ts) in entries:
+		counter.add(entry, ts)
 
-logger.info('Generating metadata...')
-meta = map(extract_metadata, sql_logs)
-meta = filter(lambda item: item is not None, meta)
+	return counter
 
-logger.info('Building dataflow entries for {} queries...'.format(len(meta)))
-entries = map(build_flow_entry, meta)
-
-logger.info('Building TSV file with nodes and edges from {} entries...'.format(len(entries)))
-graph = unique(
-	lambda entry, cnt: 'QPS: {:.4f}'.format(1. * cnt / 86400),  # calculate QPS
-	entries
-)
 
-logger.info('Printing out TSV file with {} edges...'.format(len(graph)))
+def write_partial(aggregate, name):
+	"""
+	Store a partial aggregate of a given graph section in PARTIALS_DIR
+	"""
+	path = os.path.join(PARTIALS_DIR, '{}.partial.tsv'.format(name))
 
-print('# SQL log entries analyzed: {}'.format(len(meta)))
-print("\n".join(set(graph)))
+	count = write_partial_file(aggregate, path)
+	logger.info('Partial aggregate with {} entries stored in {}'.format(count, path))
 
-# prepare flow data for redis operations
-logger.info("Building dataflow entries for redis pushes...")
-pushes = map(
-	lambda entry: '{source}\t{edge}\t{target}'.format(
-		source='bots:{}'.format(entry.get('@source_host').split('.')[0]), edge='push', target='redis:products'),
-	get_log_messages(query='program: "elecena.bots" AND @message: "bot::send"',limit=None)
-)
 
-pops = map(
-	lambda entry: '{source}\t{edge}\t{target}'.format(
-		target='mq/request.php', edge='pop', source='redis:products'),
-	get_log_messages(query='program: "uportal.bots-worker" AND @message: "Message taken from the queue"',limit=None)
-)
+def unique(fn, counter, window=WINDOW, per=1., name=None):
+	"""
+	Returns TSV lines for entries counted in a given window
 
-graph = unique(
-	lambda entry, cnt: '{:.1f} messages/hour'.format(1. * cnt / 24),
-	pops + pushes
-)
+	fn(entry, rate, peak rate) returns the metadata, rates are per given number of seconds (e.g. 3600 for hourly rates)
+	"""
+	# for stats and weighting entries
+	c = counter.counts(window)
+	peaks = counter.peak_rates(window)
+
+	if PARTIALS_DIR and name:
+		now = time.time()
+		write_partial(PartialAggregate.from_counts(c, start=now - window, end=now), name)
+
+	# weights and rates of all entries are computed in bulk
+	items = list(c)
+	(weights, rates, _) = normalize_counts([c[item] for item in items], floor=0.0001, window=window, per=per)
+	weights = format_values(weights)
+
+	def format_item(index):
+		item = items[index]
+		metadata = fn(item, rates[index], per * peaks[item]) if fn else ''
+
+		# approximate counts (see TOP_K) can be overestimated
+		error = c.error(item) if isinstance(c, SpaceSavingCounter) else 0
+		if error:
+			metadata = '{} (count error: {})'.format(metadata, error).lstrip()
+
+		return item + "\t{}\t{}".format(weights[index], metadata).rstrip()
+
+	return sorted(map(format_item, range(len(items))))
+
+def print_graph():
+	instrumentation.add_cache('query metadata', QUERY_METADATA_CACHE)
+
+	# take SQL logs from elasticsearch
+	sql_logs = instrumentation.iterate('fetch SQL logs',
+		fetch_log_messages(query='@message: /SQL.*/', source_fields=SQL_SOURCE_FIELDS))
+
+	logger.info('Generating metadata...')
+	meta = map(extract_metadata, sql_logs)
+	meta = filter(lambda item: item is not None, meta)
+
+	logger.info('Query metadata cache: {} entries, {} hits, {} misses'.format(
+		len(QUERY_METADATA_CACHE), QUERY_METADATA_CACHE.hits, QUERY_METADATA_CACHE.misses))
+
+	with instrumentation.stage('aggregate SQL entries') as stage:
+		logger.info('Building dataflow entries for {} queries...'.format(len(meta)))
+		entries = [
+			(entry, item['timestamp'])
+			for item in meta
+			for entry in build_flow_entries(item)
+		]
+
+		logger.info('Building TSV file with nodes and edges from {} entries...'.format(len(entries)))
+		graph = unique(
+			lambda entry, qps, peak: 'QPS: {:.4f}, peak QPS: {:.4f}'.format(qps, peak),
+			count_in_window(entries),
+			name='sql'
+		)
+
+		stage.records_in += len(meta)
+		stage.records_out += len(graph)
+
+	logger.info('Printing out TSV file with {} edges...'.format(len(graph)))
+
+	print('# SQL log entries analyzed: {}'.format(len(meta)))
+	print("\n".join(set(graph)))
+
+	# prepare flow data for redis operations
+	logger.info("Building dataflow entries for redis pushes...")
+
+	if ES_PUSHDOWN:
+		pushes = get_edges_aggregate(
+			query='program: "elecena.bots" AND @message: "bot::send"',
+			group_by=[('host', '@source_host')],
+			to_edge=lambda key: ('bots:{}'.format(key['host'].split('.')[0]), 'push', 'redis:products')
+		)
+
+		pops = get_edges_aggregate(
+			query='program: "uportal.bots-worker" AND @message: "Message taken from the queue"',
+			group_by=[('program', 'program')],
+			to_edge=lambda key: ('redis:products', 'pop', 'mq/request.php')
+		)
+
+		print('# Redis log entries')
+		write_tsv_lines(edges_to_lines(
+			lambda cnt, _, peak: '{:.1f} messages/hour, peak {:.1f} messages/hour'.format(3600. * cnt / WINDOW, 3600. * peak),
+			list(pops) + list(pushes),
+			name='redis'
+		), sys.stdout)
+	else:
+		pushes = map(
+			lambda entry: ('{source}\t{edge}\t{target}'.format(
+				source='bots:{}'.format(entry.get('@source_host').split('.')[0]), edge='push', target='redis:products'),
+				parse_timestamp(entry.get('@timestamp'))),
+			fetch_log_messages(query='program: "elecena.bots" AND @message: "bot::send"', source_fields=HOST_SOURCE_FIELDS)
+		)
+
+		pops = map(
+			lambda entry: ('{source}\t{edge}\t{target}'.format(
+				target='mq/request.php', edge='pop', source='redis:products'),
+				parse_timestamp(entry.get('@timestamp'))),
+			fetch_log_messages(query='program: "uportal.bots-worker" AND @message: "Message taken from the queue"', source_fields=HOST_SOURCE_FIELDS)
+		)
+
+		graph = unique(
+			lambda entry, rate, peak: '{:.1f} messages/hour, peak {:.1f} messages/hour'.format(rate, peak),
+			count_in_window(pops + pushes),
+			per=3600.,
+			name='redis'
+		)
+
+		print('# Redis log entries')
+		print("\n".join(set(graph)))
+
+	# prepare HTTP traffic stats for bots
+	logger.info("Building dataflow entries for bots HTTP traffic...")
+	hosts_buckets, bytes_transfered  = get_log_aggregate(
+		query='program: "elecena.bots" AND @message: "bot::send_http_request" AND severity: "info"',
+		group_by='@source_host', stats_field='@context.stats.size_download'
+	)
 
-print('# Redis log entries')
-print("\n".join(set(graph)))
+	graph = []
+	max_count = max(hosts_buckets.values())
+	bytes_per_req = 1. * bytes_transfered['sum'] / bytes_transfered['count']
+
+	for host, count in hosts_buckets.iteritems():
+		graph.append('{source}\t{edge}\t{target}\t{value:.4f}\t{metadata}'.format(
+			source='web:shops', edge='http fetch', target='bots:{}'.format(host), value=1.0 * count / max_count,
+			metadata='{reqs:.0f} requests/hour, {gibs:.2f} GiB/hour'.format(reqs=3600. * count / WINDOW, gibs=3600. * bytes_per_req * count / 1024 / 1024 / 1024 / WINDOW)
+		))
+
+	print('# bots HTTP traffic')
+	print("\n".join(set(graph)))
+
+	# prepare flow data for s3 operations
+	logger.info("Building dataflow entries for s3 operations...")
+
+	if ES_PUSHDOWN:
+		s3_uploads = get_edges_aggregate(
+			query='program: "nano.ImageBot" AND @message: "Image stored"',
+			group_by=[('program', 'program')],
+			to_edge=lambda key: ('ImageBot', 'upload', 's3:s.elecena.pl')
+		)
+
+		print('# s3 operations')
+		write_tsv_lines(edges_to_lines(
+			lambda cnt, _, peak: '{:.1f} requests/hour, peak {:.1f} requests/hour'.format(3600. * cnt / WINDOW, 3600. * peak),
+			s3_uploads,
+			name='s3'
+		), sys.stdout)
+	else:
+		s3_uploads = map(
+			lambda entry: ('{source}\t{edge}\t{target}'.format(
+				source='ImageBot', edge='upload', target='s3:s.elecena.pl'),
+				parse_timestamp(entry.get('@timestamp'))),
+			fetch_log_messages(query='program: "nano.ImageBot" AND @message: "Image stored"', source_fields=HOST_SOURCE_FIELDS)
+		)
+
+		graph = unique(
+			lambda entry, rate, peak: '{:.1f} requests/hour, peak {:.1f} requests/hour'.format(rate, peak),
+			count_in_window(s3_uploads),
+			per=3600.,
+			name='s3'
+		)
+
+		print('# s3 operations')
+		print("\n".join(set(graph)))
+
+
+def main():
+	if not instrumentation.enabled:
+		print_graph()
+		return
+
+	# the pipeline stats are emitted as a comment header, buffer the output until they're known
+	(stdout, sys.stdout) = (sys.stdout, StringIO())
 
-# prepare HTTP traffic stats for bots
-logger.info("Building dataflow entries for bots HTTP traffic...")
-hosts_buckets, bytes_transfered  = get_log_aggregate(
-	query='program: "elecena.bots" AND @message: "bot::send_http_request" AND severity: "info"',
-	group_by='@source_host', stats_field='@context.stats.size_download'
-)
+	try:
+		print_graph()
+	finally:
+		(output, sys.stdout) = (sys.stdout.getvalue(), stdout)
 
-graph = []
-max_count = max(hosts_buckets.values())
-bytes_per_req = 1. * bytes_transfered['sum'] / bytes_transfered['count']
-
-for host, count in hosts_buckets.iteritems():
-	graph.append('{source}\t{edge}\t{target}\t{value:.4f}\t{metadata}'.format(
-		source='web:shops', edge='http fetch', target='bots:{}'.format(host), value=1.0 * count / max_count,
-		metadata='{reqs:.0f} requests/hour, {gibs:.2f} GiB/hour'.format(reqs=1. * count / 24, gibs=bytes_per_req * count / 1024 / 1024 / 1024 / 24)
-	))
-
-print('# bots HTTP traffic')
-print("\n".join(set(graph)))
-
-# prepare flow data for s3 operations
-logger.info("Building dataflow entries for s3 operations...")
-s3_uploads = map(
-	lambda entry: '{source}\t{edge}\t{target}'.format(
-		source='ImageBot', edge='upload', target='s3:s.elecena.pl'),
-	get_log_messages(query='program: "nano.ImageBot" AND @message: "Image stored"',limit=None)
-)
+	logger.info('Pipeline stats: {}'.format(instrumentation.format_json()))
+	sys.stdout.write(''.join(instrumentation.format_tsv_comments()))
+	sys.stdout.write(output)
 
-graph = unique(
-	lambda entry, cnt: '{:.1f} requests/hour'.format(1. * cnt / 24),
-	s3_uploads
-)
 
-print('# s3 operations')
-print("\n".join(set(graph)))
+if __name__ == "__main__":
+	main()
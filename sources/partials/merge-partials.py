@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+This script merges partial aggregates (raw per-edge counts) from many hosts or runs into a single TSV file
+
+Values are normalised to the top edge and rates are computed once - after all partials are merged -
+so the result is the same as the one of a single run over all the data. Partials keep counts only,
+peak rates (e.g. "peak QPS" of logs2dataflow.py) are not stored in them and can not be reported.
+"""
+from __future__ import print_function
+
+import argparse
+import logging
+import sys
+
+from data_flow_graph import merge_partial_files, write_tsv_file, write_tsv_lines
+
+logging.basicConfig(
+	level=logging.INFO,
+	format='%(asctime)s %(name)-25s %(levelname)-8s %(message)s',
+	datefmt="%Y-%m-%d %H:%M:%S"
+)
+
+logger = logging.getLogger('merge-partials')
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Merges partial aggregates into a single TSV file')
+	parser.add_argument('paths', metavar='PARTIAL', nargs='+', help='partial aggregate files (optionally gzipped)')
+	parser.add_argument('--output', metavar='PATH', help='TSV file to write (stdout by default)')
+	parser.add_argument('--workers', type=int, help='number of processes reading the files (default: CPU count)')
+	parser.add_argument('--window', type=float,
+		help='seconds to compute rates for (default: the time span covered by partials)')
+	parser.add_argument('--floor', type=float, default=0.0001,
+		help='the minimal value of an edge, the same as used by logs2dataflow.py (default: %(default)s, 0 to disable)')
+	parser.add_argument('--per', type=float, default=1., help='rates unit in seconds, e.g. 3600 for hourly rates')
+	parser.add_argument('--metadata', default='QPS: {rate:.4f}',
+		help='edges metadata, {count}, {sum} and {rate} are replaced (default: %(default)s)')
+	args = parser.parse_args()
+
+	merged = merge_partial_files(args.paths, workers=args.workers)
+	logger.info('Merged %d partial aggregates into %d edges', len(args.paths), len(merged))
+
+	if args.window is None and (merged.start is None or merged.end is None):
+		logger.warning('Partials do not cover any time span, use --window to compute rates')
+
+	def format_metadata(count, value_sum, rate):
+		return args.metadata.format(count=count, sum=value_sum, rate=rate if rate is not None else 0.)
+
+	# the most frequent edges first
+	lines = sorted(merged.lines(format_metadata, window=args.window, per=args.per, floor=args.floor or None),
+		key=lambda line: -line['value'])
+
+	if args.output:
+		write_tsv_file(lines, args.output, atomic=True)
+	else:
+		write_tsv_lines(lines, sys.stdout)
+
+
+if __name__ == "__main__":
+	main()
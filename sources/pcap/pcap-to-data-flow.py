@@ -1,11 +1,17 @@
+import json
 import logging
+import os
 import re
+import struct
 import sys
+import time
 
-from collections import Counter  # https://docs.python.org/2/library/collections.html#collections.Counter
-from socket import gethostbyaddr, herror
+from collections import Counter, namedtuple  # https://docs.python.org/2/library/collections.html#collections.Counter
+from multiprocessing import Pool, TimeoutError
+from multiprocessing.pool import ThreadPool
+from socket import gethostbyaddr, gaierror, herror, inet_ntoa, timeout as socket_timeout
 
-from scapy.all import rdpcap
+from data_flow_graph import PartialAggregate, SpaceSavingCounter, format_values, normalize_counts, write_partial_file
 
 
 logging.basicConfig(
@@ -14,21 +20,324 @@ logging.basicConfig(
 	datefmt="%Y-%m-%d %H:%M:%S"
 )
 
+# @see https://wiki.wireshark.org/Development/LibpcapFileFormat
+# magic number -> (byte order, timestamp resolution)
+PCAP_MAGIC_NUMBERS = {
+	b'\xd4\xc3\xb2\xa1': ('<', 1e-6),
+	b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+	b'\x4d\x3c\xb2\xa1': ('<', 1e-9),
+	b'\xa1\xb2\x3c\x4d': ('>', 1e-9),
+}
+
+PCAP_HEADER_SIZE = 24
+
+# @see http://www.tcpdump.org/linktypes.html
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113  # used by "ngrep -d any"
+LINKTYPE_IPV4 = 228
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = 0x8100
+
+IP_PROTO_TCP = 6
+IP_PROTO_UDP = 17
+
+# set PCAP_TOP_K to keep approximate counts of only that many most frequent entries
+# (bounded memory for high-cardinality entries, e.g. redis keys), see SpaceSavingCounter
+PCAP_TOP_K = int(os.environ.get('PCAP_TOP_K', 0)) or None
+
+# set PCAP_PARTIAL to a file name to store raw counts there (see PartialAggregate) instead of printing the TSV,
+# partial aggregates from many hosts / captures can then be merged with sources/partials/merge-partials.py
+PCAP_PARTIAL = os.environ.get('PCAP_PARTIAL')
+
+# the subset of IP / TCP headers that parsers use
+IPHeader = namedtuple('IPHeader', ['src', 'dst', 'sport', 'dport', 'seq'])
+
+
+def read_pcap_header(fp):
+	"""
+	Returns (byte order, timestamp resolution, link type) tuple read from pcap file global header
+	"""
+	header = fp.read(24)
+
+	if header[:4] not in PCAP_MAGIC_NUMBERS:
+		raise ValueError('Not a pcap file (pcapng is not supported)')
+
+	(byte_order, ts_resolution) = PCAP_MAGIC_NUMBERS[header[:4]]
+	(linktype,) = struct.unpack(byte_order + 'I', header[20:24])
+
+	return byte_order, ts_resolution, linktype
+
+
+def read_pcap_records(fp, start=None, end=None):
+	"""
+	Yield (timestamp, link type, packet data) tuples from a pcap file one by one
+
+	start and end are optional offsets of the first record to read and of the end of the last one.
+	"""
+	(byte_order, ts_resolution, linktype) = read_pcap_header(fp)
+	record_header = struct.Struct(byte_order + 'IIII')
+
+	position = PCAP_HEADER_SIZE
+
+	if start is not None:
+		fp.seek(start)
+		position = start
+
+	while end is None or position < end:
+		record = fp.read(record_header.size)
+
+		if len(record) < record_header.size:
+			return
+
+		(ts_sec, ts_frac, incl_len, _) = record_header.unpack(record)
+		position += record_header.size + incl_len
+
+		yield ts_sec + ts_frac * ts_resolution, linktype, fp.read(incl_len)
+
+
+def split_pcap_file(path, parts):
+	"""
+	Split a given pcap file into up to parts of (path, start, end) byte ranges aligned to records
+	"""
+	size = os.path.getsize(path)
+	part_size = max(1, (size - PCAP_HEADER_SIZE) // parts)
+
+	offsets = [PCAP_HEADER_SIZE]
+
+	with open(path, 'rb') as fp:
+		(byte_order, _, _) = read_pcap_header(fp)
+		record_header = struct.Struct(byte_order + 'IIII')
+
+		position = PCAP_HEADER_SIZE
+
+		# jump from one record header to another
+		while True:
+			fp.seek(position)
+			record = fp.read(record_header.size)
+
+			if len(record) < record_header.size:
+				break
+
+			if position - offsets[-1] >= part_size:
+				offsets.append(position)
+
+			position += record_header.size + record_header.unpack(record)[2]
+
+	offsets.append(position)
+
+	return [(path, start, end) for (start, end) in zip(offsets, offsets[1:]) if start < end]
+
+
+def get_ip_offset(linktype, data):
+	"""
+	Returns the offset of IPv4 header in link-layer frame (or None for other protocols)
+	"""
+	if linktype == LINKTYPE_ETHERNET:
+		offset = 12
+		(ethertype,) = struct.unpack_from('!H', data, offset)
+
+		# 802.1Q tagged frame
+		while ethertype == ETHERTYPE_VLAN:
+			offset += 4
+			(ethertype,) = struct.unpack_from('!H', data, offset)
+
+		return offset + 2 if ethertype == ETHERTYPE_IPV4 else None
+	elif linktype == LINKTYPE_LINUX_SLL:
+		(protocol,) = struct.unpack_from('!H', data, 14)
+		return 16 if protocol == ETHERTYPE_IPV4 else None
+	elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4):
+		return 0
+	elif linktype == LINKTYPE_NULL:
+		return 4
+
+	return None
+
+
+def read_pcap_packets(fp, start=None, end=None):
+	"""
+	Yield (timestamp, IPHeader, payload) tuples for TCP / UDP over IPv4 packets with a payload
+
+	Only the headers that are needed are sliced, no full packets dissection is performed.
+	"""
+	for (ts, linktype, data) in read_pcap_records(fp, start, end):
+		try:
+			offset = get_ip_offset(linktype, data)
+
+			if offset is None:
+				continue
+
+			(version_ihl, _, total_length, _, _, _, proto, _, src, dst) = struct.unpack_from('!BBHHHBBH4s4s', data, offset)
+
+			if version_ihl >> 4 != 4:
+				continue
+
+			transport = offset + (version_ihl & 0x0f) * 4
+			(sport, dport) = struct.unpack_from('!HH', data, transport)
+
+			if proto == IP_PROTO_TCP:
+				(seq, data_offset) = struct.unpack_from('!IxxxxB', data, transport + 4)
+				payload_offset = transport + (data_offset >> 4) * 4
+			elif proto == IP_PROTO_UDP:
+				seq = None
+				payload_offset = transport + 8
+			else:
+				continue
+		except struct.error:
+			# truncated packet
+			continue
+
+		payload = data[payload_offset:offset + total_length]
+
+		if payload:
+			yield ts, IPHeader(inet_ntoa(src), inet_ntoa(dst), sport, dport, seq), payload
+
+
+def payload_to_str(raw):
+	"""
+	Packet payload as a string (bytes are decoded as latin-1, so they are mapped 1:1 to characters)
+	"""
+	if isinstance(raw, bytes) and not isinstance(raw, str):
+		return raw.decode('latin-1')
+
+	return str(raw)
+
+
+class HostResolver(object):
+	"""
+	Resolves IP addresses into host names using reverse DNS
+
+	Lookups of many addresses are made concurrently in a pool of threads. Results (including the negative ones)
+	are kept in an optional on-disk cache, so that the next runs do not start cold.
+	"""
+	def __init__(self, cache_file=None, ttl=86400, negative_ttl=3600, timeout=5, threads=16):
+		self.cache_file = cache_file
+		self.ttl = ttl
+		self.negative_ttl = negative_ttl
+		self.timeout = timeout
+		self.threads = threads
+
+		self.logger = logging.getLogger('resolve_host')
+
+		# ip -> (hostname or None, expires at)
+		self.cache = self.load_cache()
+
+		# IPs which lookups timed out - unresolved for the rest of the run, but not stored in the on-disk cache
+		self.timed_out = set()
+
+	def lookup(self, ip):
+		"""
+		Returns the host name for a given IP or None if it can not be resolved
+		"""
+		try:
+			return gethostbyaddr(ip)[0]
+		except (herror, gaierror, socket_timeout) as e:
+			# socket.herror: [Errno 1] Unknown host
+			self.logger.warning("Unable to resolve %s: %s", ip, e)
+			return None
+
+	def load_cache(self):
+		if self.cache_file is None or not os.path.exists(self.cache_file):
+			return dict()
+
+		now = time.time()
+
+		with open(self.cache_file) as fp:
+			cache = json.load(fp)
+
+		return dict(
+			(ip, (hostname, expires_at))
+			for ip, (hostname, expires_at) in cache.items()
+			if expires_at > now
+		)
+
+	def save_cache(self):
+		if self.cache_file is None:
+			return
+
+		cache_dir = os.path.dirname(self.cache_file)
+		if cache_dir and not os.path.exists(cache_dir):
+			os.makedirs(cache_dir)
+
+		# write atomically
+		with open(self.cache_file + '.tmp', 'w') as fp:
+			json.dump(self.cache, fp)
+
+		os.rename(self.cache_file + '.tmp', self.cache_file)
+
+	def store(self, ip, hostname):
+		self.cache[ip] = (hostname, time.time() + (self.ttl if hostname is not None else self.negative_ttl))
+
+	def resolve_many(self, ips):
+		"""
+		Resolve all given IP addresses that are not cached yet concurrently
+		"""
+		ips = [ip for ip in set(ips) if ip not in self.cache and ip not in self.timed_out]
+
+		if not ips:
+			return
+
+		self.logger.info("Resolving %d IP addresses using %d threads ...", len(ips), self.threads)
+
+		pool = ThreadPool(min(self.threads, len(ips)))
+
+		try:
+			results = [(ip, pool.apply_async(self.lookup, (ip,))) for ip in ips]
+			deadline = time.time() + self.timeout * (1 + len(ips) // self.threads)
+
+			for (ip, result) in results:
+				try:
+					self.store(ip, result.get(max(0, deadline - time.time())))
+				except TimeoutError:
+					# do not keep the result in the on-disk cache, try again next time
+					self.logger.warning("Timeout when resolving %s", ip)
+					self.timed_out.add(ip)
+		finally:
+			# threads of timed out lookups can not be stopped, do not wait for them (join)
+			pool.terminate()
+
+		self.save_cache()
+
+	def resolve(self, ip):
+		"""
+		Returns the host name for a given IP or None if it can not be resolved (or its lookup timed out)
+		"""
+		if ip in self.timed_out:
+			return None
+
+		if ip not in self.cache:
+			self.store(ip, self.lookup(ip))
+
+		return self.cache[ip][0]
+
+
+class StaticResolver(HostResolver):
+	"""
+	Resolves IP addresses using a given dict (e.g. for testing)
+	"""
+	def __init__(self, hosts):
+		super(StaticResolver, self).__init__()
+		self.hosts = hosts
+
+	def lookup(self, ip):
+		return self.hosts.get(ip)
+
+
+resolver = HostResolver(
+	cache_file=os.environ.get('PCAP_DNS_CACHE', os.path.expanduser('~/.cache/pcap-to-data-flow/dns.json')))
+
 hosts_cache = dict()
 
 def normalize_host(ip):
 	def resolve_host(ip):
-		logger = logging.getLogger('resolve_host')
+		hostname = resolver.resolve(ip)
 
-		try:
-			hostname = gethostbyaddr(ip)[0]
-		except herror as e:
-			# socket.herror: [Errno 1] Unknown host
-			logger.error("Unable to resolve %s: %s", ip, e)
+		if hostname is None:
 			return ip
 
 		hostname = hostname.split('.')[0]
-		logger.info("%s is known as %s", ip, hostname)
 
 		if not hostname.startswith('ap-') and not hostname.startswith('task-'):
 			return hostname
@@ -42,36 +351,170 @@ def normalize_host(ip):
 	return hosts_cache[ip]
 
 
-def parse_redis_packet(packet):
-	(ip, raw) = packet
+# @see https://redis.io/topics/protocol
+RESP_LINE_END = b'\r\n'
+RESP_ARRAY = b'*'
+RESP_BULK_STRING = b'$'
 
-	# ['*2\r', '$4\r', 'lpop\r', '$30\r', 'mq::elecena_products::messages']
-	try:
-		(_, _, cmd, _, arg) = str(raw).strip().split('\n')[:5]
-		# print(cmd, arg)
+# do not keep more than that of not parsed data per TCP connection
+RESP_MAX_BUFFER = 1024 * 1024
+
+
+def parse_resp_commands(data):
+	"""
+	Parse RESP-encoded commands (arrays of bulk strings) from given bytes / bytearray
+
+	Only the arguments are sliced, the payload is not decoded nor split. Returns (commands, consumed, partial) tuple,
+	where commands is the list of arguments lists and consumed is the number of bytes parsed. The rest is an incomplete
+	command that continues in the next TCP segment - partial is (arguments count, arguments parsed so far) tuple for it.
+	"""
+	commands = []
+	partial = None
+	size = len(data)
+	position = 0
+
+	while position < size:
+		end = data.find(RESP_LINE_END, position)
+
+		if end < 0:
+			break
+
+		# not a command (e.g. a reply or the capture started in the middle of the command) - skip the line
+		if data[position:position + 1] != RESP_ARRAY:
+			position = end + 2
+			continue
+
+		try:
+			count = int(data[position + 1:end])
+			offset = end + 2
+			args = []
+
+			for _ in range(count):
+				end = data.find(RESP_LINE_END, offset)
+
+				if end < 0:
+					break
+
+				if data[offset:offset + 1] != RESP_BULK_STRING:
+					raise ValueError('Bulk string expected')
+
+				length = int(data[offset + 1:end])
+
+				if end + 2 + length + 2 > size:
+					break
+
+				offset = end + 2
+				args.append(bytes(data[offset:offset + length]))
+				offset += length + 2
+		except ValueError:
+			# malformed command - skip the line
+			position = data.find(RESP_LINE_END, position) + 2
+			continue
+
+		if len(args) < count:
+			# incomplete command
+			partial = (count, args)
+			break
+
+		commands.append(args)
+		position = offset
+
+	return commands, position, partial
+
+
+# command -> (direction, arguments with keys)
+# "pop" - data flows from the key to the host, "push" - from the host to the key
+REDIS_COMMANDS = {
+	'lpop': ('pop', slice(1, 2)),
+	'rpop': ('pop', slice(1, 2)),
+	'blpop': ('pop', slice(1, -1)),  # BLPOP key [key ...] timeout
+	'brpop': ('pop', slice(1, -1)),
+	'rpoplpush': ('pop', slice(1, 2)),
+	'lpush': ('push', slice(1, 2)),
+	'rpush': ('push', slice(1, 2)),
+	'publish': ('push', slice(1, 2)),
+	'xadd': ('push', slice(1, 2)),
+}
 
-		cmd = cmd.strip().lower()
-		arg = arg.lower().strip()
+# (src, sport, dst, dport) -> (not parsed data, was the incomplete command counted, expected TCP sequence number)
+redis_connections = dict()
 
-		if cmd == 'lpop':
+
+def get_redis_entries(host, args, commands):
+	"""
+	Returns the list of entries for a given redis command (empty for commands that are not mapped)
+	"""
+	cmd = payload_to_str(args[0]).lower()
+
+	if cmd not in commands:
+		return []
+
+	(direction, keys) = commands[cmd]
+
+	entries = []
+
+	for key in args[keys]:
+		key = payload_to_str(key).lower().strip()
+
+		if direction == 'pop':
 			# take from the queue
-			return '{source}\t{edge}\t{target}'.format(
-				target=normalize_host(ip.src),
-				edge=cmd,
-				source=arg
-			)
-		elif cmd == 'rpush':
-			# push the queue
-			return '{source}\t{edge}\t{target}'.format(
-				source=normalize_host(ip.src),
-				edge=cmd,
-				target=arg
-			)
+			entries.append('{source}\t{edge}\t{target}'.format(target=host, edge=cmd, source=key))
 		else:
-			return None
+			# push the queue
+			entries.append('{source}\t{edge}\t{target}'.format(source=host, edge=cmd, target=key))
 
-	except ValueError:
-		return None
+	return entries
+
+
+def parse_redis_packet(packet, commands=None):
+	"""
+	Returns the list of entries for all (possibly pipelined) redis commands in a given TCP segment
+
+	Commands that span multiple segments are reassembled per TCP connection. As captures are usually filtered
+	(e.g. by ngrep) commands are counted as soon as their keys are received.
+	"""
+	(ip, raw) = packet
+	commands = commands or REDIS_COMMANDS
+
+	# b'*2\r\n$4\r\nlpop\r\n$30\r\nmq::elecena_products::messages\r\n'
+	connection = (ip.src, ip.sport, ip.dst, ip.dport)
+	(data, counted, seq) = redis_connections.pop(connection, (None, False, None))
+
+	if data is not None and seq == ip.seq:
+		data += raw
+	else:
+		# no data from the previous segments or some segments are missing
+		(data, counted) = (raw, False)
+
+	(parsed, consumed, partial) = parse_resp_commands(data)
+
+	if counted and parsed:
+		# the first command has been already counted when it was incomplete
+		(parsed, counted) = (parsed[1:], False)
+
+	host = normalize_host(ip.src)
+	entries = []
+
+	for args in parsed:
+		entries += get_redis_entries(host, args, commands)
+
+	if partial is not None and not counted:
+		(count, args) = partial
+
+		if args and payload_to_str(args[0]).lower() in commands:
+			(_, keys) = commands[payload_to_str(args[0]).lower()]
+			(_, keys_end, _) = keys.indices(count)
+
+			# all keys have been received
+			if len(args) >= keys_end:
+				entries += get_redis_entries(host, args + [b''] * (count - len(args)), commands)
+				counted = True
+
+	if consumed < len(data) and len(data) - consumed < RESP_MAX_BUFFER:
+		redis_connections[connection] = (
+			bytearray(data[consumed:]), counted, (ip.seq + len(raw)) & 0xffffffff if ip.seq is not None else None)
+
+	return entries
 
 
 def parse_scribe_packet(packet):
@@ -79,10 +522,12 @@ def parse_scribe_packet(packet):
 
 	# \x00\x00\x026\x00\x00\x00\x03Log\x01\x00\x00\x00\x00\x0f\x00\x01\x0c\x00\x00\x00\x01\x0b\x00\x01\x00\x00\x00\x11app_custom_events\x0b\x00\x02\x00\x00
 	try:
-		if '\x03Log\x01\x00' not in str(raw):
+		raw = payload_to_str(raw)
+
+		if '\x03Log\x01\x00' not in raw:
 			return None
 
-		matches = re.search(r"([a-z_]+)\x0b\x00\x02\x00\x00", str(raw))
+		matches = re.search(r"([a-z_]+)\x0b\x00\x02\x00\x00", raw)
 
 		if not matches:
 			# print('Can not parse scribe frame: ' + repr(ip))
@@ -125,48 +570,219 @@ def parse_raw_packet(packet):
 	)
 
 
-def parse(f, proto=None):
-	logger = logging.getLogger('pcap-to-data-flow')
-	logger.info('Reading %s as %s proto ...', repr(f), proto)
+PARSERS = {
+	'redis': parse_redis_packet,
+	'scribe': parse_scribe_packet,
+	None: parse_raw_packet,
+}
 
-	# @see http://kisom.github.io/pypcapfile/
-	# @see https://stackoverflow.com/questions/42963343/reading-pcap-file-with-scapy
-	packets = rdpcap(f)
-	packets_count = len(packets)
 
-	packets_time_diff = packets[-1].time - packets[0].time
+def collect_range_ips(pcap_range):
+	"""
+	Returns the set of all IP addresses from a given (path, start, end) pcap file range
+	"""
+	(path, start, end) = pcap_range
+	ips = set()
 
-	logger.info('Packets read: %d / sniffed in %.2f sec / %s', packets_count, packets_time_diff, repr(packets))
-	# logger.info('First one: %s', repr(packets[0]))
-	# logger.info('Last one: %s', repr(packets[-1]))
+	with open(path, 'rb') as fp:
+		for (_, ip, _) in read_pcap_packets(fp, start, end):
+			ips.add(ip.src)
+			ips.add(ip.dst)
 
-	packets = [
-		(packet['IP'], packet['Raw'])
-		for packet in packets
-	]
+	return ips
+
+
+def parse_range(args):
+	"""
+	Parse packets from a given (path, start, end) pcap file range
+
+	Returns (entries counter, packets count, first packet time, last packet time, heads, leftovers) tuple.
 
-	# print(packets)
+	Redis commands can span TCP segments on both sides of the range start, each range is parsed from the empty
+	reassembly state though. Hence, the first segments of each connection (up to a command boundary) and entries
+	parsed from them are kept - heads is connection -> [packets, entries, got to the boundary] dict. leftovers
+	is the reassembly state at the range end. merge_ranges parses heads again with the state left by the previous range.
+	"""
+	((path, start, end), proto, hosts) = args
+	parser = PARSERS[proto]
+
+	# hosts are resolved upfront by the parent process
+	hosts_cache.update(hosts)
+
+	# the reassembly state is passed between ranges by the parent process (see merge_ranges)
+	redis_connections.clear()
+	heads = dict()
+
+	# packets are read and parsed one by one, only the counter of entries is kept in memory
+	# @see https://wiki.wireshark.org/Development/LibpcapFileFormat
+	stats = SpaceSavingCounter(PCAP_TOP_K) if PCAP_TOP_K else Counter()
+	packets_count = 0
+	first_time = last_time = None
+
+	with open(path, 'rb') as fp:
+		for (ts, ip, raw) in read_pcap_packets(fp, start, end):
+			packets_count += 1
+
+			if first_time is None:
+				first_time = ts
+			last_time = ts
+
+			# remove empty entries (a parser can return a list of entries as well)
+			entries = parser((ip, raw))
+			if not isinstance(entries, list):
+				entries = [entries] if entries is not None else []
+
+			stats.update(entries)
+
+			if parser is parse_redis_packet:
+				connection = (ip.src, ip.sport, ip.dst, ip.dport)
+				head = heads.setdefault(connection, [[], [], False])
+
+				if not head[2]:
+					head[0].append((ip, raw))
+					head[1].extend(entries)
+					head[2] = connection not in redis_connections
+
+	return stats, packets_count, first_time, last_time, heads, dict(redis_connections)
+
+
+def merge_ranges(results):
+	"""
+	Merge (in the order of ranges) results of parse_range into (entries counter, packets count,
+	first packet time, last packet time) tuple - the same as when all packets are parsed in a single pass
+	"""
+	stats = SpaceSavingCounter(PCAP_TOP_K) if PCAP_TOP_K else Counter()
+	packets_count = 0
+	first_time = last_time = None
+
+	# connection -> the reassembly state left by the previous ranges
+	carried = dict()
+
+	for (range_stats, range_packets_count, range_first_time, range_last_time, heads, leftovers) in results:
+		packets_count += range_packets_count
+
+		if range_packets_count:
+			first_time = min(first_time, range_first_time) if first_time is not None else range_first_time
+			last_time = max(last_time, range_last_time) if last_time is not None else range_last_time
+
+		corrections = Counter()
+
+		for (connection, (packets, entries, at_boundary)) in heads.items():
+			state = carried.pop(connection, None)
+
+			if state is None:
+				continue
+
+			# the connection continues a command from the previous range - parse its first segments again
+			redis_connections.clear()
+			redis_connections[connection] = state
+
+			corrections.subtract(entries)
+			for packet in packets:
+				corrections.update(parse_redis_packet(packet))
+
+			if not at_boundary:
+				leftovers.pop(connection, None)
+
+				if connection in redis_connections:
+					leftovers[connection] = redis_connections[connection]
+
+		# entries of the range heads come first (the order of equally counted entries is kept)
+		stats.update(dict((entry, count) for (entry, count) in corrections.items() if count > 0))
+		stats.update(range_stats)
+
+		# approximate counts (see PCAP_TOP_K) can not be decreased
+		for (entry, count) in corrections.items():
+			if count < 0 and isinstance(stats, Counter):
+				stats[entry] += count
+
+				if stats[entry] <= 0:
+					del stats[entry]
+
+		carried.update(leftovers)
+
+	redis_connections.clear()
+
+	return stats, packets_count, first_time, last_time
+
+
+def get_pcap_files(paths):
+	"""
+	Expand directories of (rotated) captures into sorted lists of files
+	"""
+	files = []
+
+	for path in paths:
+		if os.path.isdir(path):
+			files += sorted(
+				os.path.join(path, name) for name in os.listdir(path)
+				if os.path.isfile(os.path.join(path, name))
+			)
+		else:
+			files.append(path)
+
+	return files
+
+
+def parse(f, proto=None, workers=1):
+	logger = logging.getLogger('pcap-to-data-flow')
+	logger.info('Reading %s as %s proto (using %d workers) ...', repr(f), proto, workers)
 
 	# protocol specific handling
-	if proto == 'redis':
-		packets = map(parse_redis_packet, packets)
-	elif proto =='scribe':
-		packets = map(parse_scribe_packet, packets)
-	elif proto is None:
-		packets = map(parse_raw_packet, packets)
-	else:
+	if proto not in PARSERS:
 		raise Exception('Unsupported proto: %s', proto)
 
-	# remove empty entries
-	packets = filter(lambda x: x is not None, packets)
+	# split files into record-aligned ranges processed by workers
+	files = get_pcap_files(f if isinstance(f, list) else [f])
+	ranges = [
+		pcap_range
+		for path in files
+		for pcap_range in (split_pcap_file(path, workers) if workers > 1 else [(path, None, None)])
+	]
+
+	pool = Pool(workers) if workers > 1 else None
+	_map = pool.map if pool is not None else map
+
+	try:
+		# resolve all hosts upfront and concurrently
+		ips = set()
+		for range_ips in _map(collect_range_ips, ranges):
+			ips.update(range_ips)
+
+		resolver.resolve_many(ips)
+		hosts = dict((ip, normalize_host(ip)) for ip in ips)
+
+		# merge per-range counters in the order of ranges, the order of entries is the same as in a single pass then
+		(stats, packets_count, first_time, last_time) = merge_ranges(
+			_map(parse_range, [(pcap_range, proto, hosts) for pcap_range in ranges]))
+	finally:
+		# all results are collected at this point (or an error is raised), do not wait for pending tasks
+		if pool is not None:
+			pool.terminate()
+			pool.join()
+
+	packets_time_diff = last_time - first_time if packets_count else 0
+
+	logger.info('Packets read: %d / sniffed in %.2f sec', packets_count, packets_time_diff)
+
+	if PCAP_PARTIAL:
+		count = write_partial_file(PartialAggregate.from_counts(stats, first_time, last_time), PCAP_PARTIAL)
+		logger.info('Partial aggregate with %d entries stored in %s', count, PCAP_PARTIAL)
+		return
+
+	# weights (the most frequent entry gets 1) and the order starting with the most frequent ones are computed in bulk
+	entries = list(stats)
+	(weights, _, order) = normalize_counts([stats[val] for val in entries])
+	weights = format_values(weights)
 
-	# and sort starting with the most frequent ones
-	stats = Counter(packets)
-	(_, top_freq) = stats.most_common(1)[0]  # the most frequent entry with have edge weight = 1
+	# approximate counts (see PCAP_TOP_K) can be overestimated
+	get_error = stats.error if isinstance(stats, SpaceSavingCounter) else lambda val: 0
 
 	packets = [
-		'{}\t{:.4f}'.format(val, 1. * freq / top_freq)
-		for (val, freq) in stats.most_common()
+		'{}\t{}\t{}'.format(
+			entries[index], weights[index],
+			'(count error: {})'.format(get_error(entries[index])) if get_error(entries[index]) else '').rstrip()
+		for index in order
 	]
 
 	print('# processed {} packets sniffed in {:.2f} sec as {}'.format(packets_count, packets_time_diff, proto))
@@ -180,4 +796,4 @@ if __name__ == "__main__":
 		pcap_file = sys.argv[1]
 		proto = None
 
-	parse(pcap_file, proto)
+	parse(pcap_file, proto, workers=int(os.environ.get('PCAP_WORKERS', 1)))
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""
+This script keeps a data flow graph up to date while consuming an unbounded stream of edges
+
+Each line of the stream is a TSV-formatted edge - source, edge and target - optionally followed
+by a unix timestamp (the time the line was received is used otherwise). Lines can be read from stdin,
+a followed (tail -F like) log file or a local TCP / unix socket.
+
+Per-edge counts are updated as lines arrive, every interval the TSV file is atomically rewritten
+(or only edges that changed since the last refresh are printed).
+"""
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+from heapq import heapify, heappop, heappush
+
+try:
+	from Queue import Queue, Empty  # Python 2
+except ImportError:
+	from queue import Queue, Empty
+
+from data_flow_graph import RollingWindowCounter, write_tsv_file, write_tsv_lines
+
+logging.basicConfig(
+	level=logging.INFO,
+	format='%(asctime)s %(name)-25s %(levelname)-8s %(message)s',
+	datefmt="%Y-%m-%d %H:%M:%S"
+)
+
+logger = logging.getLogger('stream2dataflow')
+
+# marks the end of a finite stream (stdin)
+END_OF_STREAM = None
+
+
+def parse_record(line, now):
+	"""
+	Returns ("source\\tedge\\ttarget", timestamp) tuple for a given line or None for malformed lines and comments
+	"""
+	parts = line.rstrip('\r\n').split('\t')
+
+	if len(parts) < 3 or parts[0].startswith('#'):
+		return None
+
+	try:
+		timestamp = float(parts[3]) if len(parts) > 3 and parts[3] != '' else now
+	except ValueError:
+		return None
+
+	return '\t'.join(parts[:3]), timestamp
+
+
+def read_stream(fp, queue):
+	"""
+	Reads lines from a given file-like object until it's closed
+	"""
+	for line in iter(fp.readline, ''):
+		queue.put(line)
+
+	queue.put(END_OF_STREAM)
+
+
+def follow_file(path, queue, from_start=False, poll_interval=0.5):
+	"""
+	Reads lines appended to a given file, handles its rotation and truncation (just like tail -F)
+
+	The file is read in binary mode, only complete lines are decoded (as UTF-8).
+	"""
+	fp = None
+
+	# a partially written line
+	partial = b''
+
+	while True:
+		if fp is None:
+			try:
+				fp = open(path, 'rb')
+			except IOError:
+				time.sleep(poll_interval)
+				continue
+
+			if not from_start:
+				fp.seek(0, os.SEEK_END)
+
+			# newly created files (after the rotation) are always read from the start
+			from_start = True
+			partial = b''
+			logger.info('Following %s', path)
+
+		line = fp.readline()
+
+		if line.endswith(b'\n'):
+			queue.put((partial + line).decode('utf-8', 'replace'))
+			partial = b''
+			continue
+
+		# keep the beginning of a partially written line and wait for the rest of it
+		partial += line
+		time.sleep(poll_interval)
+
+		try:
+			stat = os.stat(path)
+		except OSError:
+			continue  # rotated, the new file is not there yet
+
+		if stat.st_ino != os.fstat(fp.fileno()).st_ino:
+			logger.info('%s was rotated', path)
+
+			# lines written to the rotated file before it was closed
+			for line in (partial + fp.read()).splitlines(True):
+				queue.put(line.decode('utf-8', 'replace'))
+
+			fp.close()
+			fp = None
+		elif stat.st_size < fp.tell():
+			logger.info('%s was truncated', path)
+			fp.seek(0)
+			partial = b''
+
+
+def listen(address, queue):
+	"""
+	Accepts connections on a given TCP (host:port) or unix socket (path) address and reads lines sent over them
+	"""
+	if ':' in address:
+		(host, port) = address.rsplit(':', 1)
+		server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		server.bind((host, int(port)))
+	else:
+		if os.path.exists(address):
+			os.remove(address)
+
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		server.bind(address)
+
+	server.listen(16)
+	logger.info('Listening on %s', address)
+
+	while True:
+		(connection, _) = server.accept()
+
+		reader = threading.Thread(target=read_connection, args=(connection, queue))
+		reader.daemon = True
+		reader.start()
+
+
+def read_connection(connection, queue):
+	try:
+		for line in iter(connection.makefile('r').readline, ''):
+			queue.put(line)
+	finally:
+		connection.close()
+
+
+class TopCount(object):
+	"""
+	Keeps the count of the most frequent edge up to date, only edges that changed are checked on each refresh
+	"""
+	def __init__(self, total):
+		"""
+		total - returns the current count of a given edge (see RollingWindowCounter.total)
+		"""
+		self.total = total
+
+		# (-count, key) max-heap, entries of edges which counts changed since they were pushed are stale
+		self._heap = []
+		self._size = 0
+
+	def update(self, changed):
+		for key in changed:
+			count = self.total(key)
+
+			if count:
+				heappush(self._heap, (-count, key))
+
+		# drop stale entries once they take most of the heap
+		if len(self._heap) > 2 * self._size + 1000:
+			self._heap = [(-count, key) for (count, key) in set(
+				(-count, key) for (count, key) in self._heap if -count == self.total(key))]
+			heapify(self._heap)
+			self._size = len(self._heap)
+
+	def get(self):
+		while self._heap and -self._heap[0][0] != self.total(self._heap[0][1]):
+			heappop(self._heap)
+
+		return -self._heap[0][0] if self._heap else 0
+
+
+def get_lines(total, keys, top_count, window):
+	"""
+	Yields TSV lines for given keys, values are relative to the most frequent edge (see normalize_counts)
+	"""
+	for key in keys:
+		count = total(key)
+		(source, edge, target) = key.split('\t')
+
+		yield {
+			'source': source,
+			'edge': edge,
+			'target': target,
+			'value': count / float(top_count) if count else 0.,
+			'metadata': 'QPS: {:.4f}'.format(1. * count / window),
+		}
+
+
+def refresh(counter, top_count, args):
+	"""
+	Rewrites the TSV file or prints edges that changed since the last refresh
+	"""
+	counter.advance(time.time())
+
+	changed = counter.pop_changed()
+	top_count.update(changed)
+
+	if args.output:
+		if changed:
+			count = write_tsv_file(get_lines(counter.total, sorted(counter.counts()), top_count.get(), args.window),
+				args.output, atomic=True)
+			logger.info('%s updated with %d edges (%d changed)', args.output, count, len(changed))
+	elif changed:
+		print('# {} changed edges at {}'.format(len(changed), int(time.time())))
+		write_tsv_lines(get_lines(counter.total, sorted(changed), top_count.get(), args.window), sys.stdout)
+		sys.stdout.flush()
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Keeps a data flow graph up to date while consuming a stream of edges')
+	parser.add_argument('--follow', metavar='PATH', help='read lines appended to a given log file')
+	parser.add_argument('--from-start', action='store_true', help='read the followed file from its start')
+	parser.add_argument('--listen', metavar='ADDRESS', help='read lines sent to a given host:port or unix socket path')
+	parser.add_argument('--output', metavar='PATH',
+		help='atomically rewrite a given TSV file (changed edges are printed to stdout otherwise)')
+	parser.add_argument('--interval', type=float, default=5, help='seconds between refreshes (default: %(default)s)')
+	parser.add_argument('--window', type=int, default=86400, help='the time window in seconds (default: %(default)s)')
+	parser.add_argument('--bucket-size', type=int, default=60, help='the time bucket in seconds (default: %(default)s)')
+	args = parser.parse_args()
+
+	queue = Queue(maxsize=100000)
+
+	if args.follow:
+		reader = threading.Thread(target=follow_file, args=(args.follow, queue, args.from_start))
+	elif args.listen:
+		reader = threading.Thread(target=listen, args=(args.listen, queue))
+	else:
+		reader = threading.Thread(target=read_stream, args=(sys.stdin, queue))
+
+	reader.daemon = True
+	reader.start()
+
+	# per-edge counts are updated as lines arrive, so printing changed edges costs as much as new lines and changed edges
+	counter = RollingWindowCounter(bucket_size=args.bucket_size, max_window=args.window, track_changes=True)
+	top_count = TopCount(counter.total)
+	next_refresh = time.time() + args.interval
+
+	while True:
+		try:
+			line = queue.get(timeout=max(0, next_refresh - time.time()))
+		except Empty:
+			line = ''
+
+		if line is END_OF_STREAM:
+			refresh(counter, top_count, args)
+			break
+
+		record = parse_record(line, time.time()) if line else None
+
+		if record is not None:
+			counter.add(*record)
+
+		if time.time() >= next_refresh:
+			refresh(counter, top_count, args)
+			next_refresh = time.time() + args.interval
+
+
+if __name__ == "__main__":
+	try:
+		main()
+	except KeyboardInterrupt:
+		pass
@@ -0,0 +1,87 @@
+"""
+Shared fixtures
+
+Scripts from sources/ directory are not importable by their names, they are loaded from files.
+Tests using them are skipped when the script requirements are not installed.
+"""
+import sys
+
+from os import path
+
+import pytest
+
+ROOT = path.join(path.dirname(path.abspath(__file__)), '..')
+
+
+def load_source(name, source_path):
+    """
+    :type name str
+    :type source_path str
+    :rtype: module
+    """
+    source_path = path.join(ROOT, source_path)
+
+    try:
+        from importlib.util import module_from_spec, spec_from_file_location
+    except ImportError:
+        from imp import load_source as load  # Python 2
+        return load(name, source_path)
+
+    spec = spec_from_file_location(name, source_path)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    # just like imp.load_source does, functions are then picklable (e.g. passed to a pool of workers)
+    sys.modules[name] = module
+
+    return module
+
+
+@pytest.fixture(scope='module')
+def logs2dataflow():
+    for requirement in ('dateutil', 'elasticsearch', 'sqlparse'):
+        pytest.importorskip(requirement)
+
+    return load_source('logs2dataflow', 'sources/elasticsearch/logs2dataflow.py')
+
+
+@pytest.fixture(scope='module')
+def pcap_to_data_flow():
+    return load_source('pcap_to_data_flow', 'sources/pcap/pcap-to-data-flow.py')
+
+
+@pytest.fixture(scope='module')
+def stream2dataflow():
+    return load_source('stream2dataflow', 'sources/stream/stream2dataflow.py')
+
+
+@pytest.fixture
+def graph_lines():
+    """
+    Lines of the graph rendered in examples/graph.gv
+    """
+    return [
+        {
+            'source': 'db:foo:table',
+            'edge': 'select',
+            'target': 'bar',
+        },
+        {
+            'source': 'foo2',
+            'edge': 'select',
+            'target': 'web:bar',
+            'value': 0.5,
+            'metadata': 'test'
+        },
+        {
+            'source': 'web:bar',
+            'edge': 'update',
+            'target': 'foo2',
+            'metadata': 'QPS 4.5'
+        }
+    ]
+
+
+@pytest.fixture(scope='module')
+def merge_partials():
+    return load_source('merge_partials', 'sources/partials/merge-partials.py')
@@ -0,0 +1,21 @@
+from data_flow_graph import LRUCache
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+
+    cache['foo'] = 1
+    cache['bar'] = 2
+
+    assert cache.get('foo') == 1  # foo is now the most recently used one
+    cache['test'] = 3
+
+    assert len(cache) == 2
+    assert 'bar' not in cache
+    assert cache.get('bar') is None
+    assert cache.get('bar', 42) == 42
+    assert cache.get('test') == 3
+
+    assert cache.hits == 2
+    assert cache.misses == 2
+    assert cache.hit_rate == 0.5
@@ -0,0 +1,93 @@
+from data_flow_graph import GraphDiff, diff_graphs, diff_graph_files, diff_sorted_graphs, sort_graph_lines, \
+    graph_diff_to_lines, graph_diff_to_graphviz_lines, format_tsv_lines, format_graphviz_lines, write_tsv_file
+
+
+def _sort_by_key(diff):
+    return sorted(diff, key=lambda item: (item.source, item.edge, item.target))
+
+
+def _get_old_lines():
+    return [
+        ('foo', 'select', 'mysql:bar', 0.5, 'QPS: 1.0'),
+        ('foo', 'update', 'mysql:bar', 0.1, 'QPS: 0.2'),
+        ('cron', 'delete', 'mysql:bar', 0.01),
+        ('foo', 'select', 'redis:queue'),
+    ]
+
+
+def _get_new_lines():
+    return [
+        {'source': 'foo', 'edge': 'select', 'target': 'mysql:bar', 'value': 0.9, 'metadata': 'QPS: 1.8'},
+        {'source': 'foo', 'edge': 'update', 'target': 'mysql:bar', 'value': 0.1, 'metadata': 'QPS: 0.3'},
+        {'source': 'bar', 'edge': 'insert', 'target': 'mysql:bar', 'value': 0.2},
+        {'source': 'foo', 'edge': 'select', 'target': 'redis:queue'},
+    ]
+
+
+def test_diff_graphs():
+    diff = list(diff_graphs(_get_old_lines(), _get_new_lines()))
+
+    assert diff == [
+        GraphDiff('changed', 'foo', 'select', 'mysql:bar', 0.5, 0.9, 'QPS: 1.0', 'QPS: 1.8'),
+        GraphDiff('added', 'bar', 'insert', 'mysql:bar', None, 0.2, None, None),
+        GraphDiff('removed', 'cron', 'delete', 'mysql:bar', 0.01, None, None, None),
+    ]
+
+    # small value changes are skipped, metadata changes can be reported as well
+    assert [item.edge for item in diff_graphs(_get_old_lines(), _get_new_lines(), threshold=0.5)] == \
+        ['insert', 'delete']
+    assert [item.edge for item in diff_graphs(_get_old_lines(), _get_new_lines(), compare_metadata=True)] == \
+        ['select', 'update', 'insert', 'delete']
+
+    assert list(diff_graphs(_get_old_lines(), _get_old_lines())) == []
+
+
+def test_diff_sorted_graphs():
+    expected = _sort_by_key(diff_graphs(_get_old_lines(), _get_new_lines()))
+
+    # several sorted runs are merged
+    diff = diff_sorted_graphs(sort_graph_lines(_get_old_lines(), chunk_size=2),
+                              sort_graph_lines(_get_new_lines(), chunk_size=3))
+
+    assert list(diff) == expected
+
+
+def test_sort_graph_lines():
+    lines = [('b', 'x', 'c', 1.0), ('a', 'x', 'c', 2.0), ('b', 'x', 'c', 3.0), ('a', 'a', 'a')]
+
+    assert list(sort_graph_lines(lines, chunk_size=2)) == [
+        (('a', 'a', 'a'), (None, None)),
+        (('a', 'x', 'c'), (2.0, None)),
+        (('b', 'x', 'c'), (1.0, None)),
+        (('b', 'x', 'c'), (3.0, None)),  # the order of duplicates is kept
+    ]
+
+
+def test_diff_graph_files(tmpdir):
+    old_path = str(tmpdir.join('old.tsv'))
+    new_path = str(tmpdir.join('new.tsv.gz'))
+
+    write_tsv_file(_get_old_lines(), old_path)
+    write_tsv_file(_get_new_lines(), new_path)
+
+    diff = list(diff_graph_files(old_path, new_path))
+    assert diff == list(diff_graphs(_get_old_lines(), _get_new_lines()))
+
+    # files are sorted and merged
+    assert list(diff_graph_files(old_path, new_path, max_memory_size=0)) == _sort_by_key(diff)
+
+
+def test_graph_diff_formatting():
+    diff = list(diff_graphs(_get_old_lines(), _get_new_lines()))
+
+    assert format_tsv_lines(graph_diff_to_lines(diff)) == [
+        'foo\tselect\tmysql:bar\t0.9000\tchanged: value 0.5000 -> 0.9000 (+0.4000), QPS: 1.0 -> QPS: 1.8\n',
+        'bar\tinsert\tmysql:bar\t0.2000\tadded\n',
+        'cron\tdelete\tmysql:bar\t0.0100\tremoved\n',
+    ]
+
+    graph = format_graphviz_lines(list(graph_diff_to_graphviz_lines(diff)))
+
+    assert '\tn1 -> n4 [label="added", color="green3", fontcolor="green4"];' in graph
+    assert '\tn2 -> n4 [label="removed", color="red", fontcolor="red3", style="dashed"];' in graph
+    assert 'color="orange"' in graph
@@ -0,0 +1,162 @@
+import os
+
+import pytest
+
+from data_flow_graph import DataFlowGraph, format_tsv_lines, format_graphviz_lines, write_tsv_file, \
+    write_binary_file, read_binary_file, convert_tsv_to_binary, convert_binary_to_tsv
+
+
+def test_graph():
+    graph = DataFlowGraph()
+    graph.add_edge('foo', 'select', 'bar')
+    graph.add_edge('foo', 'update', 'bar', value=0.5, metadata='test')
+
+    assert len(graph) == 2
+    assert graph.nodes() == {'foo', 'bar'}
+    assert list(graph) == [
+        ('foo', 'select', 'bar', None, None),
+        ('foo', 'update', 'bar', 0.5, 'test'),
+    ]
+
+
+def test_graph_metadata(monkeypatch):
+    graph = DataFlowGraph([('foo', 'select', 'bar', 0.5, 'QPS: 1')] * 3 + [('foo', 'select', 'bar', 0.5, 'QPS: 2')])
+
+    # metadata is packed into a single buffer, repeated entries are stored once
+    assert graph._metadata_data == b'QPS: 1\nQPS: 2\n'
+    assert list(graph._metadata) == [0, 0, 0, 7]
+    assert graph._strings == ['foo', 'select', 'bar']
+
+    # only the recently added entries are indexed
+    monkeypatch.setattr(DataFlowGraph, 'METADATA_INDEX_SIZE', 2)
+    graph = DataFlowGraph(('foo', 'select', 'bar', None, 'QPS: {}'.format(n % 3)) for n in range(6))
+
+    assert len(graph._metadata_index) <= 2
+    assert [metadata for (_, _, _, _, metadata) in graph] == ['QPS: 0', 'QPS: 1', 'QPS: 2'] * 2
+
+    with pytest.raises(ValueError):
+        graph.add_edge('foo', 'select', 'bar', metadata='multi\nline')
+
+
+def test_graph_lines(graph_lines):
+    lines = graph_lines
+    graph = DataFlowGraph(lines)
+
+    assert len(graph) == 3
+    assert list(graph.lines()) == lines
+
+    # tuples can be added as well
+    assert list(DataFlowGraph(graph)) == list(graph)
+
+
+def test_graph_formatting(graph_lines):
+    lines = graph_lines
+    graph = DataFlowGraph(lines)
+
+    assert format_tsv_lines(graph) == format_tsv_lines(lines)
+    assert format_graphviz_lines(graph) == format_graphviz_lines(lines)
+    assert format_graphviz_lines(graph, aggregate='sum') == format_graphviz_lines(lines, aggregate='sum')
+
+    with open('examples/graph.gv') as fp:
+        assert format_graphviz_lines(graph) == fp.read().strip()
+
+
+def test_graph_binary_file(graph_lines, tmpdir):
+    lines = graph_lines
+    path = str(tmpdir.join('graph.bin'))
+
+    assert write_binary_file(lines, path) == 3
+
+    graph = read_binary_file(path)
+
+    assert len(graph) == 3
+    assert list(graph.lines()) == lines
+    assert graph.nodes() == {'db:foo:table', 'bar', 'foo2', 'web:bar'}
+    assert format_tsv_lines(graph) == format_tsv_lines(lines)
+
+    # an empty graph
+    write_binary_file([], path)
+    assert list(read_binary_file(path)) == []
+
+
+def test_graph_binary_file_size(tmpdir):
+    tsv_path = str(tmpdir.join('graph.tsv'))
+    binary_path = str(tmpdir.join('graph.bin'))
+
+    # unique metadata of each edge
+    lines = [
+        ('web:node{}'.format(n % 1000), 'select', 'mysql:node{}'.format(n % 300), (n % 100) / 100.,
+         'QPS: {:.4f}'.format(n / 7.))
+        for n in range(10000)
+    ]
+
+    write_tsv_file(lines, tsv_path)
+    write_binary_file(lines, binary_path)
+
+    graph = read_binary_file(binary_path)
+    assert graph._sources.format == 'h'  # the narrowest integers that fit string ids
+    assert format_tsv_lines(graph) == format_tsv_lines(DataFlowGraph(lines))
+
+    # metadata entries take most of the file
+    assert os.path.getsize(binary_path) < os.path.getsize(tsv_path) * 0.6
+
+
+def test_graph_binary_file_big_endian(graph_lines, tmpdir, monkeypatch):
+    path = str(tmpdir.join('graph.bin'))
+
+    # columns are byte-swapped and copied on big-endian platforms
+    monkeypatch.setattr('sys.byteorder', 'big')
+    write_binary_file(graph_lines, path)
+
+    assert list(read_binary_file(path).lines()) == graph_lines
+
+
+def test_graph_binary_values(tmpdir):
+    path = str(tmpdir.join('graph.bin'))
+
+    # stored as float32 as long as values are rendered the same in TSV
+    write_binary_file([('foo', 'select', 'bar', 0.1234), ('foo', 'select', 'bar', None)], path)
+    assert read_binary_file(path)._values.format == 'f'
+    assert format_tsv_lines(read_binary_file(path)) == ['foo\tselect\tbar\t0.1234\n', 'foo\tselect\tbar\n']
+
+    write_binary_file([('foo', 'select', 'bar', 123456.789)], path)
+    assert read_binary_file(path)._values.format == 'd'
+    assert format_tsv_lines(read_binary_file(path)) == ['foo\tselect\tbar\t123456.7890\n']
+
+
+def test_graph_binary_malformed(graph_lines, tmpdir):
+    path = str(tmpdir.join('graph.bin'))
+
+    tmpdir.join('graph.bin').write('foo\tselect\tbar\n')
+    with pytest.raises(ValueError):
+        read_binary_file(path)
+
+    write_binary_file(graph_lines, path)
+    with open(path, 'rb') as fp:
+        data = fp.read()
+
+    tmpdir.join('graph.bin').write_binary(data[:-1])
+    with pytest.raises(ValueError):
+        read_binary_file(path)
+
+    # new lines separate strings in the table
+    with pytest.raises(ValueError):
+        write_binary_file([('foo', 'select', 'bar', 1.0, 'multi\nline')], path)
+
+
+def test_graph_binary_tsv_conversion(tmpdir):
+    tsv_path = str(tmpdir.join('graph.tsv'))
+    binary_path = str(tmpdir.join('graph.bin'))
+    converted_path = str(tmpdir.join('converted.tsv'))
+
+    with open(tsv_path, 'w') as fp:
+        fp.write('mq/request.php\t_update\tmysql:shops\t0.0148\tQPS: 0.1023\n')
+        fp.write('sphinx:products\tsearch\tElecena\\Services\\Sphinx\t0.0042\n')
+        fp.write('currency.php\t_\tmysql:currencies\n')
+        fp.write('źródło\t_\tcel\t1.0000\tQPS: 0.0008\n')
+
+    assert convert_tsv_to_binary(tsv_path, binary_path) == 4
+    assert convert_binary_to_tsv(binary_path, converted_path) == 4
+
+    with open(tsv_path) as expected, open(converted_path) as converted:
+        assert converted.read() == expected.read()
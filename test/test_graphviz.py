@@ -1,4 +1,8 @@
-from data_flow_graph import format_graphviz_lines
+import re
+from io import StringIO
+
+from data_flow_graph import format_graphviz_lines, write_graphviz_lines, aggregate_graphviz_edges, \
+    collapse_graphviz_groups, DataFlowGraph
 
 
 def test_format():
@@ -57,3 +61,138 @@ def test_escaping_with_groups():
 
     assert 'n1 [label="Bar\\nTest \\"foo\\" 42" group="Bar" colorscheme=pastel28 color=1];' in graph, 'Nodes labels are properly escaped'
     assert 'n2 [label="Foo\\nFoo \\"bar\\" test" group="Foo" colorscheme=pastel28 color=2];' in graph, 'Nodes labels are properly escaped'
+
+
+def test_write_lines(graph_lines):
+    graph = StringIO()
+
+    # edges are provided by a generator, nodes are not known upfront
+    write_graphviz_lines((line for line in graph_lines), graph)
+
+    with open('examples/graph.gv') as fp:
+        assert graph.getvalue() == fp.read()
+
+
+def test_write_lines_with_nodes(graph_lines):
+    graph = StringIO()
+    write_graphviz_lines(iter(graph_lines), graph, nodes=['bar', 'db:foo:table', 'foo2', 'web:bar'])
+
+    with open('examples/graph.gv') as fp:
+        assert graph.getvalue() == fp.read()
+
+
+def test_aggregate():
+    lines = [
+        {'source': 'foo', 'edge': 'select', 'target': 'bar', 'value': 0.5, 'metadata': 'test'},
+        {'source': 'foo', 'edge': 'select', 'target': 'bar', 'value': 0.25, 'metadata': 'test'},
+        {'source': 'foo', 'edge': 'update', 'target': 'bar', 'value': 0.25},
+        {'source': 'bar', 'edge': 'select', 'target': 'foo'},
+    ]
+
+    assert aggregate_graphviz_edges(lines) == [
+        {'source': 'foo', 'edge': 'select', 'target': 'bar', 'value': 0.75, 'metadata': 'test'},
+        {'source': 'foo', 'edge': 'update', 'target': 'bar', 'value': 0.25},
+        {'source': 'bar', 'edge': 'select', 'target': 'foo'},
+    ]
+
+    assert aggregate_graphviz_edges(lines, aggregate='max')[0]['value'] == 0.5
+
+    graph = format_graphviz_lines(lines, aggregate='sum')
+    print(graph)
+
+    assert graph.count('->') == 3
+    assert 'n2 -> n1 [label="test", penwidth=5.00, weight=100];' in graph
+    assert 'n2 -> n1 [penwidth=2.33, weight=34];' in graph
+    assert 'n1 -> n2 [];' in graph
+
+
+def test_clusters(graph_lines):
+    graph = format_graphviz_lines(graph_lines, clusters=True)
+    print(graph)
+
+    assert '\tn1 [label="bar"];\n\tn3 [label="foo2"];\n' in graph, 'Ungrouped nodes are not in clusters'
+    assert '\tsubgraph cluster_1 {\n\t\tlabel="db";' in graph
+    assert '\t\tn2 [label="db\\nfoo:table" group="db" colorscheme=pastel28 color=1];\n\t}' in graph
+    assert '\tsubgraph cluster_2 {\n\t\tlabel="web";' in graph
+    assert '\t\tn4 [label="web\\nbar" group="web" colorscheme=pastel28 color=2];\n\t}' in graph
+    assert 'n3 -> n4 [label="test"];' in graph
+
+    # the default output is not affected
+    with open('examples/graph.gv') as fp:
+        assert format_graphviz_lines(graph_lines, clusters=False) == fp.read().strip()
+
+    # edges within a collapsed group are not rendered as self-loops of its super-node
+    lines = _get_grouped_lines() + [
+        {'source': 'mysql:products', 'edge': 'replicate', 'target': 'mysql:tags', 'value': 0.5},
+        {'source': 'mysql:users', 'edge': 'join', 'target': 'mysql:tags', 'value': 0.1},
+    ]
+
+    for collapsed in (collapse_graphviz_groups(lines, groups=['mysql']),
+                      collapse_graphviz_groups(lines, min_node_value=0.8)):
+        assert [line['source'] for line in collapsed if line['source'] == line['target']] == []
+
+        graph = format_graphviz_lines(collapsed, clusters=True)
+        print(graph)
+
+        assert re.search(r'\b(n\d+) -> \1\b', graph) is None
+        assert graph.count('->') == len(collapsed)
+
+
+def _get_grouped_lines():
+    return [
+        {'source': 'web:index.php', 'edge': 'select', 'target': 'mysql:products', 'value': 1.0, 'metadata': 'QPS: 10'},
+        {'source': 'web:index.php', 'edge': 'select', 'target': 'mysql:users', 'value': 0.25, 'metadata': 'QPS: 2.5'},
+        {'source': 'web:index.php', 'edge': 'select', 'target': 'mysql:tags', 'value': 0.125, 'metadata': 'QPS: 1.2'},
+        {'source': 'cron', 'edge': 'delete', 'target': 'mysql:tags', 'value': 0.0625},
+        {'source': 'cron', 'edge': 'get', 'target': 'redis:foo', 'value': 0.5},
+    ]
+
+
+def test_collapse_groups():
+    lines = _get_grouped_lines()
+
+    # nothing to collapse
+    assert collapse_graphviz_groups(lines) == lines
+
+    assert collapse_graphviz_groups(lines, groups=['mysql']) == [
+        {'source': 'web:index.php', 'edge': 'select', 'target': 'mysql:3 nodes', 'value': 1.375, 'metadata': '3 edges'},
+        {'source': 'cron', 'edge': 'delete', 'target': 'mysql:3 nodes', 'value': 0.0625},
+        {'source': 'cron', 'edge': 'get', 'target': 'redis:foo', 'value': 0.5},
+    ]
+
+    assert collapse_graphviz_groups(DataFlowGraph(lines), groups=True) == [
+        {'source': 'web:1 nodes', 'edge': 'select', 'target': 'mysql:3 nodes', 'value': 1.375, 'metadata': '3 edges'},
+        {'source': 'cron', 'edge': 'delete', 'target': 'mysql:3 nodes', 'value': 0.0625},
+        {'source': 'cron', 'edge': 'get', 'target': 'redis:1 nodes', 'value': 0.5},
+    ]
+
+    # input lines are not modified
+    assert lines == _get_grouped_lines()
+
+
+def test_collapse_low_weight_nodes():
+    lines = _get_grouped_lines()
+
+    # mysql:users and mysql:tags are collapsed, redis:foo is the only low-weight node of its group
+    assert collapse_graphviz_groups(lines, min_node_value=0.6) == [
+        {'source': 'web:index.php', 'edge': 'select', 'target': 'mysql:products', 'value': 1.0, 'metadata': 'QPS: 10'},
+        {'source': 'web:index.php', 'edge': 'select', 'target': 'mysql:2 other nodes', 'value': 0.375,
+         'metadata': '2 edges'},
+        {'source': 'cron', 'edge': 'delete', 'target': 'mysql:2 other nodes', 'value': 0.0625},
+        {'source': 'cron', 'edge': 'get', 'target': 'redis:foo', 'value': 0.5},
+    ]
+
+    # edges are pruned after nodes are collapsed
+    collapsed = collapse_graphviz_groups(lines, min_node_value=0.6, threshold=0.1)
+    assert [(line['source'], line['target']) for line in collapsed] == [
+        ('web:index.php', 'mysql:products'),
+        ('web:index.php', 'mysql:2 other nodes'),
+        ('cron', 'redis:foo'),
+    ]
+
+    graph = format_graphviz_lines(collapsed, aggregate='sum', clusters=True)
+    print(graph)
+
+    assert graph.count('subgraph cluster_') == 3
+    assert 'n2 [label="mysql\\n2 other nodes" group="mysql" colorscheme=pastel28 color=1];' in graph
+    assert 'n5 -> n2 [label="2 edges", penwidth=2.50, weight=38];' in graph
@@ -1,4 +1,5 @@
-from data_flow_graph import logs_map_and_reduce, format_tsv_line
+from data_flow_graph import logs_map_and_reduce, logs_map_and_accumulate, format_tsv_line, Accumulator, \
+    logs_map_and_accumulate_parallel, logs_map_and_accumulate_top, DistinctCountAccumulator
 
 
 def _get_logs():
@@ -62,3 +63,109 @@ def test_logs_grouping():
     assert format_tsv_line(**grouped[0]) == 'web\thttp\tserviceA\t0.7500\t15 requests'
     assert format_tsv_line(**grouped[1]) == 'web\thttp\tserviceB\t1.0000\t20 requests'
     assert format_tsv_line(**grouped[2]) == 'cron\thttp\tserviceA\t0.2500\t5 requests'
+
+
+class HttpRequestsAccumulator(Accumulator):
+    """
+    Keeps just the first entry of each group
+    """
+    def init(self, log):
+        return log
+
+    def update(self, state, log):
+        return state
+
+    def merge(self, state, other):
+        return state
+
+    def finalize(self, state, count):
+        return {
+            'source': state[0],
+            'edge': 'http',
+            'target': str(state[1]).split('/')[2],
+            'metadata': '{} requests'.format(count)
+        }
+
+
+def test_logs_accumulating():
+    # logs can be provided as a generator
+    logs = (log for log in _get_logs())
+
+    grouped = logs_map_and_accumulate(logs, lambda entry: '{}-{}'.format(entry[0], entry[1]),
+                                      HttpRequestsAccumulator())
+    # print(grouped)
+
+    assert len(grouped) == 3
+
+    assert format_tsv_line(**grouped[0]) == 'web\thttp\tserviceA\t0.7500\t15 requests'
+    assert format_tsv_line(**grouped[1]) == 'web\thttp\tserviceB\t1.0000\t20 requests'
+    assert format_tsv_line(**grouped[2]) == 'cron\thttp\tserviceA\t0.2500\t5 requests'
+
+
+def test_logs_accumulating_empty():
+    assert logs_map_and_accumulate([], str, HttpRequestsAccumulator()) == []
+
+
+def _map_source_and_url(entry):
+    return '{}-{}'.format(entry[0], entry[1])
+
+
+def test_logs_accumulating_parallel():
+    logs = _get_logs()
+    expected = logs_map_and_accumulate(logs, _map_source_and_url, HttpRequestsAccumulator())
+
+    # small chunks to make several workers process the logs
+    grouped = logs_map_and_accumulate_parallel(logs, _map_source_and_url, HttpRequestsAccumulator(),
+                                               workers=2, chunk_size=4)
+    assert grouped == expected
+
+    # serial fallback
+    grouped = logs_map_and_accumulate_parallel(logs, _map_source_and_url, HttpRequestsAccumulator(),
+                                               workers=2)
+    assert grouped == expected
+
+
+def test_logs_accumulating_top():
+    logs = _get_logs()
+
+    # enough room for all keys - exact counts, the most frequent items first
+    grouped = logs_map_and_accumulate_top(logs, _map_source_and_url, HttpRequestsAccumulator(), capacity=10)
+
+    assert [format_tsv_line(**item) for item in grouped] == [
+        'web\thttp\tserviceB\t1.0000\t20 requests',
+        'web\thttp\tserviceA\t0.7500\t15 requests',
+        'cron\thttp\tserviceA\t0.2500\t5 requests',
+    ]
+
+    # cron entries take the place of the least frequent key and inherit its count
+    grouped = logs_map_and_accumulate_top(logs, _map_source_and_url, HttpRequestsAccumulator(), capacity=2,
+                                          other=lambda log: log[0])
+
+    assert [format_tsv_line(**item) for item in grouped] == [
+        'web\thttp\tserviceB\t1.0000\t20 requests',
+        'cron\thttp\tserviceA\t1.0000\t20 requests (count error: 15)',
+        'web\tother\tother\t0.7500\t15 other entries',
+    ]
+
+    assert logs_map_and_accumulate_top([], str, HttpRequestsAccumulator()) == []
+
+
+def _get_user_agent(entry):
+    return entry[2]
+
+
+def test_logs_accumulating_distinct():
+    logs = _get_logs()
+    accumulator = DistinctCountAccumulator(HttpRequestsAccumulator(), _get_user_agent, 'user agents')
+
+    grouped = logs_map_and_accumulate(logs, _map_source_and_url, accumulator)
+
+    assert [format_tsv_line(**item) for item in grouped] == [
+        u'web\thttp\tserviceA\t0.7500\t15 requests, \u22482 distinct user agents',
+        u'web\thttp\tserviceB\t1.0000\t20 requests, \u22481 distinct user agents',
+        u'cron\thttp\tserviceA\t0.2500\t5 requests, \u22481 distinct user agents',
+    ]
+
+    # sketches are merged when logs are processed by several workers
+    assert logs_map_and_accumulate_parallel(logs, _map_source_and_url, accumulator,
+                                            workers=2, chunk_size=4) == grouped
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import pickle
+
+import pytest
+
+from data_flow_graph import HyperLogLog, format_distinct_count
+
+
+def test_hyperloglog():
+    sketch = HyperLogLog()
+
+    assert sketch.count() == 0
+
+    # duplicates are not counted
+    for _ in range(3):
+        sketch.update(['foo', 'bar', u'źródło', 42])
+
+    assert sketch.count() == 4
+
+
+def test_hyperloglog_error():
+    sketch = HyperLogLog(precision=12)
+    sketch.update('host-{}'.format(n) for n in range(50000))
+
+    # the standard error is 1.6% for this precision
+    assert abs(sketch.count() - 50000) < 50000 * 0.05
+
+
+def test_hyperloglog_merge():
+    first, second = HyperLogLog(), HyperLogLog()
+    first.update(range(0, 6000))
+    second.update(range(4000, 10000))
+
+    expected = HyperLogLog()
+    expected.update(range(0, 10000))
+
+    first.merge(second)
+    assert first.count() == expected.count()
+
+    with pytest.raises(ValueError):
+        first.merge(HyperLogLog(precision=12))
+
+
+def test_hyperloglog_serialization():
+    sketch = HyperLogLog(precision=8)
+    sketch.update(range(1000))
+
+    data = sketch.to_bytes()
+    assert len(data) == 257
+
+    assert HyperLogLog.from_bytes(data).count() == sketch.count()
+    assert HyperLogLog.from_bytes(data).precision == 8
+    assert pickle.loads(pickle.dumps(sketch)).count() == sketch.count()
+
+    with pytest.raises(ValueError):
+        HyperLogLog.from_bytes(data[:-1])
+
+    with pytest.raises(ValueError):
+        HyperLogLog(precision=20)
+
+
+def test_format_distinct_count():
+    assert format_distinct_count(42, 'hosts') == u'≈42 distinct hosts'
@@ -0,0 +1,58 @@
+import json
+
+from data_flow_graph import Instrumentation, LRUCache
+
+
+def test_instrumentation():
+    instrumentation = Instrumentation()
+
+    @instrumentation.timed('parse')
+    def parse(item):
+        return item if item % 2 else None
+
+    items = instrumentation.iterate('fetch', range(10))
+    parsed = [item for item in map(parse, items) if item is not None]
+
+    with instrumentation.stage('output') as stage:
+        stage.records_in += len(parsed)
+        stage.records_out += 1
+
+    cache = LRUCache()
+    cache.get('foo')
+    instrumentation.add_cache('metadata', cache)
+
+    summary = instrumentation.summary()
+    stages = dict((stage['stage'], stage) for stage in summary['stages'])
+
+    assert list(stages.keys()) == ['fetch', 'parse', 'output']
+    assert stages['fetch']['records_out'] == 10
+    assert stages['parse']['calls'] == 10
+    assert stages['parse']['records_in'] == 10
+    assert stages['parse']['records_out'] == 5
+    assert stages['output']['records_in'] == 5
+
+    assert summary['caches'][0]['misses'] == 1
+    assert summary['peak_rss'] > 0
+
+    assert json.loads(instrumentation.format_json())['stages'][0]['stage'] == 'fetch'
+
+    comments = instrumentation.format_tsv_comments()
+    assert comments[0].startswith('# stage fetch: ')
+    assert comments[3] == '# cache metadata: 0 hits, 1 misses, 0.00% hit rate\n'
+
+
+def test_instrumentation_disabled():
+    instrumentation = Instrumentation(enabled=False)
+
+    @instrumentation.timed('parse')
+    def parse(item):
+        return item
+
+    items = range(10)
+    assert instrumentation.iterate('fetch', items) is items
+    assert [parse(item) for item in items] == list(items)
+
+    with instrumentation.stage('output') as stage:
+        stage.records_out += 1
+
+    assert instrumentation.summary()['stages'] == []
@@ -0,0 +1,453 @@
+import calendar
+import json
+import threading
+import time
+
+
+def test_query_fingerprint(logs2dataflow):
+    get_query_fingerprint = logs2dataflow.get_query_fingerprint
+
+    assert get_query_fingerprint("SELECT * FROM products WHERE id IN (1, 2, 3) AND name = 'foo'") == \
+        'SELECT * FROM products WHERE id IN (?) AND name = ?'
+    assert get_query_fingerprint("SELECT  *\nFROM t1 WHERE x in ('a', \"b\") AND y = 'it\\'s' LIMIT 10") == \
+        'SELECT * FROM t1 WHERE x IN (?) AND y = ? LIMIT ?'
+    assert get_query_fingerprint('INSERT INTO prices (id, price) VALUES (12, 3.99)') == \
+        'INSERT INTO prices (id, price) VALUES (?, ?)'
+
+
+def test_query_key(logs2dataflow):
+    get_query_key = logs2dataflow.get_query_key
+
+    # queries differing with literals only share the key
+    assert get_query_key("SELECT * FROM products WHERE id = 1 AND name = 'foo'") == \
+        get_query_key("SELECT * FROM products WHERE id = 123456 AND name = 'bar baz'")
+    assert get_query_key('SELECT * FROM products LIMIT 5') == get_query_key('SELECT * FROM products LIMIT 50')
+
+    assert get_query_key('SELECT * FROM products') != get_query_key('SELECT * FROM shops')
+    assert get_query_key('SELECT * FROM products') != get_query_key('SELECT * FROM products1')
+
+    # literals can not be skipped with string methods
+    assert get_query_key("SELECT * FROM products WHERE name = 'it\\'s'") is None
+    assert get_query_key('SELECT * FROM products WHERE name = "foo"') is None
+
+
+def test_parse_query_metadata(logs2dataflow):
+    parse_query_metadata = logs2dataflow.parse_query_metadata
+
+    assert parse_query_metadata('SELECT * FROM products WHERE id = ?') == ('SELECT', ('products',))
+    assert parse_query_metadata('DESCRIBE products') == ('DESCRIBE', ('products',))
+    assert parse_query_metadata('SET NAMES utf8') is None
+
+    # multi-table
+    assert parse_query_metadata('SELECT * FROM products AS p, `shops` s WHERE p.shop_id = s.id') == \
+        ('SELECT', ('products', 'shops'))
+    assert parse_query_metadata('SELECT * FROM products p LEFT JOIN shops USING (shop_id) JOIN prices ON 1') == \
+        ('SELECT', ('products', 'shops', 'prices'))
+    assert parse_query_metadata('SELECT * FROM products WHERE id IN (SELECT id FROM prices)') == \
+        ('SELECT', ('products', 'prices'))
+
+    # the table that is written to goes first
+    assert parse_query_metadata('INSERT INTO archive (id) SELECT id FROM products JOIN shops ON 1') == \
+        ('INSERT', ('archive', 'products', 'shops'))
+    assert parse_query_metadata('UPDATE products p JOIN shops s ON s.id = p.shop_id SET p.price = ?') == \
+        ('UPDATE', ('products', 'shops'))
+    assert parse_query_metadata('UPDATE products SET price = ? WHERE id = ?') == ('UPDATE', ('products',))
+    assert parse_query_metadata('INSERT INTO prices (id, price) VALUES (?, ?) ON DUPLICATE KEY UPDATE price = ?') == \
+        ('INSERT', ('prices',))
+
+
+def test_query_metadata(logs2dataflow):
+    get_query_metadata = logs2dataflow.get_query_metadata
+
+    # literals are not parsed
+    assert get_query_metadata("SELECT * FROM products WHERE name = 'FROM shops'") == ('SELECT', ('products',))
+    assert get_query_metadata('SELECT * FROM products WHERE name = "FROM shops"') == ('SELECT', ('products',))
+
+    # the key is shared with products_2 table, but such results are not cached
+    assert get_query_metadata('SELECT * FROM products_1 WHERE id = 1') == ('SELECT', ('products_1',))
+    assert get_query_metadata('SELECT * FROM products_2 WHERE id = 2') == ('SELECT', ('products_2',))
+
+    hits = logs2dataflow.QUERY_METADATA_CACHE.hits
+    assert get_query_metadata("SELECT * FROM products WHERE name = 'foo'") == ('SELECT', ('products',))
+    assert logs2dataflow.QUERY_METADATA_CACHE.hits == hits + 1
+
+
+def _get_meta(kind, tables):
+    return dict(db='mysql', kind=kind, tables=tables, method='mq/request.php::_{}'.format(kind.lower()))
+
+
+def test_build_flow_entries(logs2dataflow):
+    build_flow_entries = logs2dataflow.build_flow_entries
+
+    assert build_flow_entries(_get_meta('SELECT', ('products', 'shops'))) == [
+        'mysql:products\t_select\tmq/request.php',
+        'mysql:shops\t_select\tmq/request.php',
+    ]
+
+    # INSERT ... SELECT and UPDATE ... JOIN write to the first table and read from the others
+    assert build_flow_entries(_get_meta('INSERT', ('archive', 'products'))) == [
+        'mq/request.php\t_insert\tmysql:archive',
+        'mysql:products\t_insert\tmq/request.php',
+    ]
+    assert build_flow_entries(_get_meta('UPDATE', ('products', 'shops'))) == [
+        'mq/request.php\t_update\tmysql:products',
+        'mysql:shops\t_update\tmq/request.php',
+    ]
+
+    # ON DUPLICATE KEY UPDATE
+    meta = logs2dataflow.get_query_metadata('INSERT INTO prices (id) VALUES (1) ON DUPLICATE KEY UPDATE id = 2')
+    assert build_flow_entries(_get_meta(*meta)) == ['mq/request.php\t_insert\tmysql:prices']
+
+
+class FakeElasticsearch(object):
+    """
+    Serves search (point-in-time, search_after, slices and legacy "@timestamp gt" paging)
+    and composite aggregations of given documents over HTTP
+    """
+    def __init__(self, docs):
+        # documents are sorted by @timestamp, the position is used as _shard_doc
+        self.docs = docs
+        self.searches = []
+        self.pits = set()
+        self.closed_pits = []
+        self.server = None
+
+    def search(self, body):
+        since = body.get('filter', body.get('query', {}).get('bool', {}).get('filter', {}))['range']['@timestamp']['gt']
+        hits = [(doc['@timestamp'], n) for (n, doc) in enumerate(self.docs) if doc['@timestamp'] > since]
+
+        if 'pit' in body:
+            assert body['pit']['id'] in self.pits, 'The point-in-time is open'
+
+        if 'slice' in body:
+            hits = [hit for hit in hits if hit[1] % body['slice']['max'] == body['slice']['id']]
+
+        if 'search_after' in body:
+            hits = [hit for hit in hits if hit > tuple(body['search_after'])]
+
+        self.searches.append(body)
+
+        if 'aggregations' in body:
+            return self.aggregate([self.docs[n] for (_, n) in hits], body['aggregations']['edges'])
+
+        return {
+            'hits': {
+                'hits': [{'_source': self.docs[n], 'sort': [ts, n]} for (ts, n) in hits[:body['size']]],
+            }
+        }
+
+    @staticmethod
+    def aggregate(docs, aggregation):
+        composite = aggregation['composite']
+        buckets = dict()
+
+        for doc in docs:
+            key = []
+
+            for source in composite['sources']:
+                ((name, source),) = source.items()
+
+                if 'terms' in source:
+                    key.append((name, doc[source['terms']['field']]))
+                else:
+                    interval = int(source['date_histogram']['fixed_interval'].rstrip('s'))
+                    ts = doc[source['date_histogram']['field']][:19]
+                    ts = calendar.timegm(time.strptime(ts, '%Y-%m-%dT%H:%M:%S'))
+                    key.append((name, ts // interval * interval * 1000))
+
+            bucket = buckets.setdefault(tuple(key), {'key': dict(key), 'doc_count': 0, 'sum': {'value': 0.}})
+            bucket['doc_count'] += 1
+
+            if 'aggregations' in aggregation:
+                bucket['sum']['value'] += doc[aggregation['aggregations']['sum']['sum']['field']]
+
+        # buckets are sorted by their keys, pages start after the last key of the previous one
+        keys = sorted(buckets)
+
+        if 'after' in composite:
+            after = tuple((name, composite['after'][name]) for (name, _) in keys[0]) if keys else ()
+            keys = [key for key in keys if key > after]
+
+        page = [buckets[key] for key in keys[:composite['size']]]
+        result = {'buckets': page}
+
+        if page:
+            result['after_key'] = page[-1]['key']
+
+        return {'aggregations': {'edges': result}}
+
+    def handle(self, method, path, body):
+        if method == 'POST' and path.split('?')[0].endswith('/_pit'):
+            pit_id = 'pit-{}'.format(len(self.pits) + len(self.closed_pits))
+            self.pits.add(pit_id)
+            return {'id': pit_id}
+
+        if method == 'DELETE' and path == '/_pit':
+            self.pits.remove(body['id'])
+            self.closed_pits.append(body['id'])
+            return {'succeeded': True}
+
+        if path.split('?')[0].endswith('/_search'):
+            return self.search(body)
+
+        raise ValueError('Unexpected request: {} {}'.format(method, path))
+
+    def __enter__(self):
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # Python 2
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def respond(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+                response = json.dumps(fake.handle(self.command, self.path, body)).encode('utf-8')
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            do_GET = do_POST = do_DELETE = respond
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+
+NOW = 1528812231
+
+
+def _get_docs(logs2dataflow, count=25):
+    # three log messages are logged within each second
+    return [
+        {'@timestamp': logs2dataflow.format_timestamp(NOW - 3600 + n // 3), '@message': 'SQL SELECT {}'.format(n)}
+        for n in range(count)
+    ]
+
+
+def _get_es(logs2dataflow, fake):
+    return logs2dataflow.Elasticsearch(host='127.0.0.1', port=fake.port)
+
+
+def test_get_log_messages_pit(logs2dataflow):
+    docs = _get_docs(logs2dataflow)
+
+    with FakeElasticsearch(docs) as fake:
+        # pages end in the middle of messages logged within the same second
+        messages = list(logs2dataflow.get_log_messages_pit('@message: SQL', now=NOW, batch=4, es=_get_es(logs2dataflow, fake)))
+
+    assert messages == docs
+    assert len(fake.searches) == 8  # the last one is empty
+    assert fake.searches[-1]['search_after'] == [docs[-1]['@timestamp'], len(docs) - 1]
+    assert fake.closed_pits == ['pit-0']
+
+
+def test_get_log_messages_sliced(logs2dataflow):
+    docs = _get_docs(logs2dataflow)
+
+    with FakeElasticsearch(docs) as fake:
+        messages = list(logs2dataflow.get_log_messages_pit('@message: SQL', now=NOW, batch=2, slices=3,
+                                                           es=_get_es(logs2dataflow, fake)))
+
+    # each slice is paged through separately, the order of merged messages is not kept
+    assert sorted(messages, key=docs.index) == docs
+    assert sorted(set(search['slice']['id'] for search in fake.searches)) == [0, 1, 2]
+    assert fake.closed_pits == ['pit-0']
+
+
+def test_get_log_messages_sliced_closed_early(logs2dataflow):
+    docs = _get_docs(logs2dataflow, count=500)
+
+    with FakeElasticsearch(docs) as fake:
+        threads = threading.active_count()
+        messages = logs2dataflow.get_log_messages_pit('@message: SQL', now=NOW, batch=2, slices=3,
+                                                      es=_get_es(logs2dataflow, fake))
+
+        assert next(messages) in docs
+        assert threading.active_count() == threads + 3
+
+        # fetching threads blocked on the full queue stop before the point-in-time is closed
+        messages.close()
+
+        assert threading.active_count() == threads
+        assert fake.closed_pits == ['pit-0']
+        assert len(fake.searches) < len(docs) / 2
+
+
+def test_get_log_messages_legacy(logs2dataflow, monkeypatch):
+    with FakeElasticsearch(_get_docs(logs2dataflow)) as fake:
+        monkeypatch.setattr(logs2dataflow, 'ES_PORT', fake.port)
+        monkeypatch.setattr(logs2dataflow, 'ES_HOST', '127.0.0.1')
+
+        docs = fake.docs = fake.docs[::3]  # a single message per second
+        assert list(logs2dataflow.get_log_messages('@message: SQL', now=NOW, batch=4, limit=None)) == docs
+
+        # "@timestamp gt" paging skips messages logged within the last second of each page
+        fake.docs = _get_docs(logs2dataflow)
+        assert len(list(logs2dataflow.get_log_messages('@message: SQL', now=NOW, batch=4, limit=None))) < 25
+
+
+def test_edges_to_lines_partial(logs2dataflow, monkeypatch, tmpdir):
+    from data_flow_graph import read_partial_file
+
+    monkeypatch.setattr(logs2dataflow, 'PARTIALS_DIR', str(tmpdir))
+    edges = [('redis:products', 'pop', 'mq/request.php', 30, None, 0.1),
+             ('bots:s1', 'push', 'redis:products', 60, 1024., 0.2)]
+
+    assert logs2dataflow.edges_to_lines(lambda count, _, peak: count, edges, name='redis') == [
+        ('bots:s1', 'push', 'redis:products', 1.0, 60),
+        ('redis:products', 'pop', 'mq/request.php', 0.5, 30),
+    ]
+
+    # aggregates pushed down to Elasticsearch are stored as partials too
+    partial = read_partial_file(str(tmpdir.join('redis.partial.tsv')))
+
+    assert list(partial.items()) == [
+        ('redis:products', 'pop', 'mq/request.php', 30, 0., None, None),
+        ('bots:s1', 'push', 'redis:products', 60, 1024., None, None),
+    ]
+    assert round(partial.end - partial.start) == logs2dataflow.WINDOW
+
+
+def test_merge_partials(logs2dataflow, merge_partials, monkeypatch, tmpdir, capsys):
+    monkeypatch.setattr(logs2dataflow, 'PARTIALS_DIR', str(tmpdir))
+    now = time.time()
+
+    # entries logged by two hosts, the least frequent one is below the floor
+    hosts = [
+        [('web\tselect\tproducts', now - n) for n in range(18000)] + [('cron\tdelete\tproducts', now - 5)],
+        [('web\tselect\tproducts', now - n) for n in range(12000)] + [('web\tselect\tusers', now - n) for n in range(60)],
+    ]
+
+    def fn(entry, qps, peak):
+        return 'QPS: {:.4f}'.format(qps)
+
+    for (index, entries) in enumerate(hosts):
+        logs2dataflow.unique(fn, logs2dataflow.count_in_window(entries), name='sql-{}'.format(index))
+
+    single_run = logs2dataflow.unique(fn, logs2dataflow.count_in_window(hosts[0] + hosts[1]))
+    assert 'cron\tdelete\tproducts\t0.0001\tQPS: 0.0000' in single_run
+
+    monkeypatch.setattr('sys.argv', ['merge-partials.py', '--window', str(logs2dataflow.WINDOW), '--workers', '1',
+                                     str(tmpdir.join('sql-0.partial.tsv')), str(tmpdir.join('sql-1.partial.tsv'))])
+    merge_partials.main()
+
+    assert sorted(capsys.readouterr().out.strip().split('\n')) == single_run
+
+
+def _get_bots_docs(logs2dataflow, now):
+    # bots are sending messages with a growing rate, hosts of two bots map to the same edge
+    return [
+        {'@timestamp': logs2dataflow.format_timestamp(now // 60 * 60 - 600 + 60 * minute + n % 60),
+         '@source_host': 'bot{}.local'.format(1 + n % 3), 'program': 'bots', 'size': 2 * n}
+        for minute in range(5)
+        for n in range(10 * (minute + 1))
+    ]
+
+
+def test_get_log_composite_aggregate(logs2dataflow):
+    now = int(time.time())
+
+    docs = _get_bots_docs(logs2dataflow, now)
+
+    with FakeElasticsearch(docs) as fake:
+        buckets = list(logs2dataflow.get_log_composite_aggregate(
+            '@message: bot', [('host', '@source_host')], sum_field='size', now=now, batch=2,
+            es=_get_es(logs2dataflow, fake)))
+
+    assert buckets == [
+        ({'host': host}, len([doc for doc in docs if doc['@source_host'] == host]),
+         sum(doc['size'] for doc in docs if doc['@source_host'] == host))
+        for host in ('bot1.local', 'bot2.local', 'bot3.local')
+    ]
+
+    # two pages and the final empty one
+    assert len(fake.searches) == 3
+    assert [search['aggregations']['edges']['composite'].get('after') for search in fake.searches] == [
+        None, {'host': 'bot2.local'}, {'host': 'bot3.local'}]
+
+
+def test_get_edges_aggregate(logs2dataflow, monkeypatch):
+    from data_flow_graph import format_tsv_line
+
+    now = int(time.time())
+    docs = _get_bots_docs(logs2dataflow, now)
+
+    def get_target(host):
+        return 'redis:{}'.format('bot3' if host == 'bot3.local' else 'other')
+
+    with FakeElasticsearch(docs) as fake:
+        monkeypatch.setattr(logs2dataflow, 'ES_PORT', fake.port)
+        monkeypatch.setattr(logs2dataflow, 'ES_HOST', '127.0.0.1')
+
+        edges = list(logs2dataflow.get_edges_aggregate(
+            '@message: bot', [('host', '@source_host')], sum_field='size', batch=4,
+            to_edge=lambda key: ('bots', 'push', get_target(key['host']))))
+
+    # buckets of two bots are combined, 50 messages were sent in the busiest (the last) minute
+    other = [doc for doc in docs if doc['@source_host'] != 'bot3.local']
+    bot3 = [doc for doc in docs if doc['@source_host'] == 'bot3.local']
+
+    assert edges == [
+        ('bots', 'push', 'redis:other', len(other), sum(doc['size'] for doc in other), 34. / 60),
+        ('bots', 'push', 'redis:bot3', len(bot3), sum(doc['size'] for doc in bot3), 16. / 60),
+    ]
+
+    # host and time buckets are fetched in pages of four
+    assert len(fake.searches) == 5
+
+    # the same metadata as when messages are counted by the script
+    counter = logs2dataflow.count_in_window(
+        ('bots\tpush\t' + get_target(doc['@source_host']), logs2dataflow.parse_timestamp(doc['@timestamp']))
+        for doc in docs)
+
+    def fn(count, _, peak):
+        rate = 3600. * count / logs2dataflow.WINDOW
+        return '{:.1f} messages/hour, peak {:.1f} messages/hour'.format(rate, 3600. * peak)
+
+    assert sorted(format_tsv_line(*line) for line in logs2dataflow.edges_to_lines(fn, edges)) == \
+        sorted(logs2dataflow.unique(
+            lambda entry, rate, peak: '{:.1f} messages/hour, peak {:.1f} messages/hour'.format(rate, peak),
+            counter, per=3600.))
+
+
+def test_main_stats_header(logs2dataflow, monkeypatch, capsys):
+    from data_flow_graph import Instrumentation
+
+    instrumentation = Instrumentation(enabled=True)
+
+    def print_graph():
+        with instrumentation.stage('output') as stage:
+            print('# SQL log entries analyzed: 1')
+            print('foo\tselect\tmysql:bar\t1.0000')
+            stage.records_out += 1
+
+    monkeypatch.setattr(logs2dataflow, 'instrumentation', instrumentation)
+    monkeypatch.setattr(logs2dataflow, 'print_graph', print_graph)
+
+    logs2dataflow.main()
+    lines = capsys.readouterr().out.split('\n')
+
+    # the stats are a comment header of the TSV output
+    assert lines[0].startswith('# stage output: ')
+    assert lines[-3:] == ['# SQL log entries analyzed: 1', 'foo\tselect\tmysql:bar\t1.0000', '']
@@ -0,0 +1,38 @@
+import random
+
+import pytest
+
+import data_flow_graph
+from data_flow_graph import normalize_counts, format_values
+
+
+def test_normalize_counts():
+    (values, rates, order) = normalize_counts([5, 20, 1, 20], floor=0.1, window=10)
+
+    assert values == [0.25, 1.0, 0.1, 1.0]
+    assert rates == [0.5, 2.0, 0.1, 2.0]
+    assert order == [1, 3, 0, 2]  # equal counts keep their order
+
+    (_, rates, _) = normalize_counts([5, 20], window=7200, per=3600)
+    assert rates == [2.5, 10.0]
+
+    assert normalize_counts([5, 20])[1] is None
+    assert normalize_counts([]) == ([], None, [])
+
+
+def test_normalize_counts_fallback(monkeypatch):
+    pytest.importorskip('numpy')
+
+    random.seed(42)
+    counts = [random.randint(1, 100000) for _ in range(10000)]
+
+    expected = normalize_counts(counts, floor=0.0001, window=86400, per=3600.)
+
+    # pure Python implementation gives exactly the same results
+    monkeypatch.setattr(data_flow_graph, 'numpy', None)
+    assert normalize_counts(counts, floor=0.0001, window=86400, per=3600.) == expected
+
+
+def test_format_values():
+    assert format_values([1.0, 0.00005, 0.123456]) == ['1.0000', '0.0001', '0.1235']
+    assert format_values([2.25], precision=1) == ['2.2']
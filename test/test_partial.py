@@ -0,0 +1,111 @@
+from data_flow_graph import PartialAggregate, logs_to_partial_aggregate, write_partial_file, read_partial_file, \
+    merge_partial_files, logs_map_and_accumulate, format_tsv_lines, Accumulator
+
+
+def _get_logs():
+    # (timestamp, host, url, response size)
+    return [
+        (3600 * hour + n, 'web{}'.format(hour % 3), 'http://service{}/foo'.format(n % 4), n)
+        for hour in range(6)
+        for n in range(100 * (hour + 1))
+    ]
+
+
+def _get_edge(log):
+    return 'web', 'http', log[2].split('/')[2]
+
+
+def _get_timestamp(log):
+    return log[0]
+
+
+def _get_size(log):
+    return log[3]
+
+
+def _format_metadata(count, size, rate):
+    return '{} requests, {:.0f} bytes, {:.1f} requests/hour'.format(count, size, rate)
+
+
+def test_partial_aggregate_from_counts():
+    aggregate = PartialAggregate.from_counts({'foo\tselect\tbar': 4, ('foo', 'update', 'bar'): 2}, start=0, end=3600)
+
+    assert sorted(aggregate._edges.items()) == [
+        (('foo', 'select', 'bar'), [4, 0., None, None]),
+        (('foo', 'update', 'bar'), [2, 0., None, None]),
+    ]
+    assert (aggregate.start, aggregate.end) == (0, 3600)
+
+
+def test_partial_aggregate():
+    aggregate = PartialAggregate(start=0, end=7200)
+    aggregate.add('foo', 'select', 'bar', timestamp=10)
+    aggregate.add('foo', 'select', 'bar', count=3, value=2.5, timestamp=5)
+    aggregate.add('foo', 'update', 'bar', count=2)
+
+    assert len(aggregate) == 2
+    assert format_tsv_lines(aggregate.lines(_format_metadata, per=3600)) == [
+        'foo\tselect\tbar\t1.0000\t4 requests, 2 bytes, 2.0 requests/hour\n',
+        'foo\tupdate\tbar\t0.5000\t2 requests, 0 bytes, 1.0 requests/hour\n',
+    ]
+
+    # many occurrences added at once, between the given timestamps
+    aggregate.add('foo', 'select', 'bar', count=2, timestamp=20, last=30)
+    assert list(aggregate.items()) == [
+        ('foo', 'select', 'bar', 6, 2.5, 5, 30),
+        ('foo', 'update', 'bar', 2, 0., None, None),
+    ]
+
+    # no time span - no rates
+    aggregate = PartialAggregate()
+    aggregate.add('foo', 'select', 'bar')
+    assert list(aggregate.lines(lambda count, _, rate: rate)) == [
+        {'source': 'foo', 'edge': 'select', 'target': 'bar', 'value': 1.0, 'metadata': None}]
+
+
+def test_partial_aggregate_file(tmpdir):
+    aggregate = logs_to_partial_aggregate(_get_logs(), _get_edge, _get_timestamp, _get_size)
+    path = str(tmpdir.join('web.partial.tsv.gz'))
+
+    assert write_partial_file(aggregate, path) == 4
+
+    read = read_partial_file(path)
+
+    assert (read.start, read.end) == (0, 5 * 3600 + 599)
+    assert read._edges == aggregate._edges
+
+
+def test_partial_aggregate_merge(tmpdir):
+    logs = _get_logs()
+    single_run = logs_to_partial_aggregate(logs, _get_edge, _get_timestamp, _get_size)
+
+    # hourly partials
+    paths = []
+
+    for hour in range(6):
+        path = str(tmpdir.join('{}.partial.tsv'.format(hour)))
+        write_partial_file(logs_to_partial_aggregate(
+            [log for log in logs if log[0] // 3600 == hour], _get_edge, _get_timestamp, _get_size), path)
+
+        paths.append(path)
+
+    for workers in (1, 2, 4):
+        merged = merge_partial_files(paths, workers=workers)
+
+        assert (merged.start, merged.end) == (single_run.start, single_run.end)
+        assert list(merged.lines(_format_metadata, per=3600)) == list(single_run.lines(_format_metadata, per=3600))
+
+    # values are the same as the ones of logs_map_and_accumulate
+    assert [line['value'] for line in single_run.lines()] == \
+        [line['value'] for line in logs_map_and_accumulate(logs, _get_edge, CountingAccumulator())]
+
+
+class CountingAccumulator(Accumulator):
+    def init(self, log):
+        return None
+
+    def update(self, state, log):
+        return None
+
+    def finalize(self, state, count):
+        return {}
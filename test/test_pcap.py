@@ -0,0 +1,277 @@
+import os
+import struct
+import threading
+import time
+
+from socket import inet_aton
+
+import pytest
+
+
+def test_static_resolver(pcap_to_data_flow, tmpdir):
+    cache_file = str(tmpdir.join('dns.json'))
+
+    resolver = pcap_to_data_flow.StaticResolver({'10.0.0.1': 'ap-s200.example.net'})
+    resolver.cache_file = cache_file
+    resolver.resolve_many(['10.0.0.1', '10.0.0.2'])
+
+    assert resolver.resolve('10.0.0.1') == 'ap-s200.example.net'
+    assert resolver.resolve('10.0.0.2') is None
+
+    # results (including the negative ones) are kept in the on-disk cache
+    assert sorted(pcap_to_data_flow.HostResolver(cache_file=cache_file).cache) == ['10.0.0.1', '10.0.0.2']
+
+
+def _get_slow_resolver(pcap_to_data_flow, hosts, slow, **kwargs):
+    """
+    Returns a resolver which lookups of slow IPs block until it is released
+    """
+    class SlowResolver(pcap_to_data_flow.HostResolver):
+        def __init__(self):
+            super(SlowResolver, self).__init__(**kwargs)
+            self.lookups = []
+            self.released = threading.Event()
+
+        def lookup(self, ip):
+            self.lookups.append(ip)
+
+            if ip in slow:
+                self.released.wait(5)
+
+            return hosts.get(ip)
+
+    return SlowResolver()
+
+
+def test_resolver_timeout(pcap_to_data_flow, tmpdir):
+    cache_file = str(tmpdir.join('dns.json'))
+    resolver = _get_slow_resolver(pcap_to_data_flow, {'10.0.0.1': 'web1', '10.0.0.2': 'web2'}, slow=['10.0.0.2'],
+                                  cache_file=cache_file, timeout=0.2, threads=4)
+
+    try:
+        start = time.time()
+        resolver.resolve_many(['10.0.0.1', '10.0.0.2'])
+        assert time.time() - start < 1
+
+        assert resolver.resolve('10.0.0.1') == 'web1'
+
+        # the timed out IP is not looked up again
+        start = time.time()
+        assert resolver.resolve('10.0.0.2') is None
+        resolver.resolve_many(['10.0.0.2'])
+        assert time.time() - start < 0.1
+        assert sorted(resolver.lookups) == ['10.0.0.1', '10.0.0.2']
+    finally:
+        resolver.released.set()
+
+    # and it is not stored in the on-disk cache - try again next time
+    assert sorted(pcap_to_data_flow.HostResolver(cache_file=cache_file).cache) == ['10.0.0.1']
+
+
+def _get_tcp_frame(payload, seq=0, src='10.0.0.1', dst='10.0.0.2', sport=41000, dport=6379):
+    """
+    Returns an Ethernet frame with a TCP over IPv4 segment carrying a given payload
+    """
+    tcp = struct.pack('!HHIIBBHHH', sport, dport, seq, 0, 5 << 4, 0x18, 1024, 0, 0)
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp) + len(payload), 0, 0, 64, 6, 0,
+                     inet_aton(src), inet_aton(dst))
+
+    return b'\x00' * 12 + b'\x08\x00' + ip + tcp + payload
+
+
+def _write_pcap_file(path, frames, byte_order='<'):
+    with open(path, 'wb') as fp:
+        fp.write(struct.pack(byte_order + 'IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))  # LINKTYPE_ETHERNET
+
+        for (n, frame) in enumerate(frames):
+            fp.write(struct.pack(byte_order + 'IIII', 1528812231 + n, 500000, len(frame), len(frame)))
+            fp.write(frame)
+
+
+def test_read_pcap_records(pcap_to_data_flow, tmpdir):
+    path = str(tmpdir.join('test.pcap'))
+    frames = [_get_tcp_frame(b'foo'), _get_tcp_frame(b'', seq=3), _get_tcp_frame(b'bar', seq=3)]
+
+    for byte_order in '<>':
+        _write_pcap_file(path, frames, byte_order)
+
+        with open(path, 'rb') as fp:
+            assert list(pcap_to_data_flow.read_pcap_records(fp)) == [
+                (1528812231.5, 1, frames[0]), (1528812232.5, 1, frames[1]), (1528812233.5, 1, frames[2])]
+
+        # segments without a payload are skipped
+        with open(path, 'rb') as fp:
+            assert [(ts, ip.seq, payload) for (ts, ip, payload) in pcap_to_data_flow.read_pcap_packets(fp)] == [
+                (1528812231.5, 0, b'foo'), (1528812233.5, 3, b'bar')]
+
+    with open(path, 'rb') as fp:
+        (_, ip, _) = next(pcap_to_data_flow.read_pcap_packets(fp))
+        assert ip == ('10.0.0.1', '10.0.0.2', 41000, 6379, 0)
+
+    tmpdir.join('test.pcap').write_binary(b'\x0a\x0d\x0d\x0a' + b'\x00' * 20)
+    with open(path, 'rb') as fp:
+        with pytest.raises(ValueError):
+            list(pcap_to_data_flow.read_pcap_records(fp))
+
+
+def test_split_pcap_file(pcap_to_data_flow, tmpdir):
+    def read_ranges(ranges):
+        records = []
+
+        for (path, start, end) in ranges:
+            with open(path, 'rb') as fp:
+                records += pcap_to_data_flow.read_pcap_records(fp, start, end)
+
+        return records
+
+    path = str(tmpdir.join('test.pcap'))
+    _write_pcap_file(path, [_get_tcp_frame(b'x' * n) for n in range(10)])
+
+    with open(path, 'rb') as fp:
+        records = list(pcap_to_data_flow.read_pcap_records(fp))
+
+    for parts in (1, 2, 3, 10, 50):
+        ranges = pcap_to_data_flow.split_pcap_file(path, parts)
+
+        # adjacent ranges that cover all records, each of them read exactly once
+        assert 1 <= len(ranges) <= min(parts, 10)
+        assert ranges[0][1] == 24
+        assert ranges[-1][2] == os.path.getsize(path)
+        assert [start for (_, start, _) in ranges[1:]] == [end for (_, _, end) in ranges[:-1]]
+        assert read_ranges(ranges) == records
+
+    # the capture shipped with the script
+    path = os.path.join(os.path.dirname(__file__), '..', 'sources', 'pcap', 'redis.pcap')
+
+    with open(path, 'rb') as fp:
+        records = list(pcap_to_data_flow.read_pcap_records(fp))
+
+    assert len(pcap_to_data_flow.split_pcap_file(path, 4)) == 4
+    assert read_ranges(pcap_to_data_flow.split_pcap_file(path, 4)) == records
+
+    # an empty capture
+    _write_pcap_file(path=str(tmpdir.join('empty.pcap')), frames=[])
+    assert pcap_to_data_flow.split_pcap_file(str(tmpdir.join('empty.pcap')), 4) == []
+
+
+def _resp(*args):
+    return b'*' + str(len(args)).encode() + b'\r\n' + b''.join(
+        b'$' + str(len(arg)).encode() + b'\r\n' + arg + b'\r\n' for arg in args)
+
+
+def test_parse_resp_commands(pcap_to_data_flow):
+    parse_resp_commands = pcap_to_data_flow.parse_resp_commands
+
+    data = _resp(b'LPOP', b'queue') + _resp(b'GET', b'foo')
+    assert parse_resp_commands(data) == ([[b'LPOP', b'queue'], [b'GET', b'foo']], len(data), None)
+
+    # replies and malformed lines are skipped
+    data = b'+OK\r\n*2\r\n:1\r\n' + _resp(b'GET', b'foo')
+    assert parse_resp_commands(data) == ([[b'GET', b'foo']], len(data), None)
+
+    # an incomplete command - only the complete arguments are returned
+    data = _resp(b'GET', b'foo') + _resp(b'RPUSH', b'queue', b'message')
+    assert parse_resp_commands(data[:-5]) == \
+        ([[b'GET', b'foo']], len(_resp(b'GET', b'foo')), (3, [b'RPUSH', b'queue']))
+
+
+@pytest.fixture
+def redis(pcap_to_data_flow, monkeypatch):
+    """
+    Returns a function parsing given (seq, payload) TCP segments of a single connection to redis entries
+    """
+    monkeypatch.setattr(pcap_to_data_flow, 'resolver', pcap_to_data_flow.StaticResolver({'10.0.0.1': 'ap-s10.local'}))
+    monkeypatch.setattr(pcap_to_data_flow, 'hosts_cache', dict())
+    monkeypatch.setattr(pcap_to_data_flow, 'redis_connections', dict())
+
+    def parse(*segments):
+        return [
+            pcap_to_data_flow.parse_redis_packet((pcap_to_data_flow.IPHeader('10.0.0.1', '10.0.0.2', 41000, 6379, seq),
+                                                 payload))
+            for (seq, payload) in segments
+        ]
+
+    return parse
+
+
+def test_redis_pipelined(redis):
+    data = _resp(b'LPOP', b'Queue') + _resp(b'GET', b'foo') + _resp(b'RPUSH', b'jobs', b'{}')
+
+    assert redis((0, data)) == [['queue\tlpop\tap-s*', 'ap-s*\trpush\tjobs']]
+
+
+def test_redis_split_command(redis):
+    data = _resp(b'GET', b'foo') + _resp(b'XADD', b'events', b'*', b'field', b'value') + _resp(b'LPOP', b'queue')
+
+    # split in the middle of the key - the command is counted once its key is complete
+    assert redis((0, data[:20]), (20, data[20:])) == [[], ['ap-s*\txadd\tevents', 'queue\tlpop\tap-s*']]
+
+    # the same in three segments
+    assert redis((100, data[:10]), (110, data[10:30]), (130, data[30:])) == \
+        [[], [], ['ap-s*\txadd\tevents', 'queue\tlpop\tap-s*']]
+
+
+def test_redis_counted_incomplete(redis):
+    data = _resp(b'RPUSH', b'jobs', b'x' * 100) + _resp(b'LPOP', b'queue')
+
+    # RPUSH is counted when its key arrives, not again when the rest of the message does
+    assert redis((0, data[:40]), (40, data[40:80]), (80, data[80:])) == \
+        [['ap-s*\trpush\tjobs'], [], ['queue\tlpop\tap-s*']]
+
+
+def test_redis_sequence_gap(redis):
+    data = _resp(b'LPOP', b'queue') + _resp(b'RPUSH', b'jobs', b'message')
+
+    # a segment is missing - the buffered data is dropped, the next command is not glued to it
+    assert redis((0, data[:10]), (50, data[30:]), (1000, _resp(b'LPOP', b'other'))) == \
+        [[], [], ['other\tlpop\tap-s*']]
+
+    # retransmitted / out of order segments are not appended either
+    assert redis((2000, data[:10]), (2000, data[:10]), (2010, data[10:])) == \
+        [[], [], ['queue\tlpop\tap-s*', 'ap-s*\trpush\tjobs']]
+
+
+def test_parse_split_commands(pcap_to_data_flow, monkeypatch, tmpdir, capsys):
+    monkeypatch.setattr(pcap_to_data_flow, 'resolver', pcap_to_data_flow.StaticResolver({}))
+    monkeypatch.setattr(pcap_to_data_flow, 'hosts_cache', dict())
+    monkeypatch.setattr(pcap_to_data_flow, 'redis_connections', dict())
+
+    rpush = _resp(b'RPUSH', b'jobs', b'x' * 40)
+    xadd = _resp(b'XADD', b'events', b'*', b'field', b'value') + _resp(b'LPOP', b'queue')
+
+    # commands of two connections split into segments that fall into different ranges,
+    # the key of XADD is received in the first segment, the rest of it comes with LPOP
+    path = str(tmpdir.join('split.pcap'))
+    _write_pcap_file(path, [
+        _get_tcp_frame(rpush[:18], seq=100),
+        _get_tcp_frame(xadd[:24], seq=500, sport=42000),
+        _get_tcp_frame(rpush[18:40], seq=118),
+        _get_tcp_frame(rpush[40:], seq=140),
+        _get_tcp_frame(xadd[24:], seq=524, sport=42000),
+        _get_tcp_frame(_resp(b'LPOP', b'queue'), seq=100, sport=43000),
+    ])
+
+    pcap_to_data_flow.parse(path, 'redis', workers=1)
+    serial = capsys.readouterr().out
+
+    assert serial.split('\n')[1:] == [
+        'queue\tlpop\t10.0.0.1\t1.0000',
+        '10.0.0.1\trpush\tjobs\t0.5000',
+        '10.0.0.1\txadd\tevents\t0.5000',
+        '',
+    ]
+
+    for workers in (2, 3):
+        pcap_to_data_flow.parse(path, 'redis', workers=workers)
+        assert capsys.readouterr().out == serial
+
+    # each segment in its own range
+    ranges = pcap_to_data_flow.split_pcap_file(path, 100)
+    assert len(ranges) == 6
+
+    (stats, packets_count, _, _) = pcap_to_data_flow.merge_ranges(
+        map(pcap_to_data_flow.parse_range, [(pcap_range, 'redis', {}) for pcap_range in ranges]))
+
+    assert packets_count == 6
+    assert list(stats.items()) == [
+        ('10.0.0.1\trpush\tjobs', 1), ('10.0.0.1\txadd\tevents', 1), ('queue\tlpop\t10.0.0.1', 2)]
@@ -0,0 +1,106 @@
+import os
+import threading
+import time
+
+try:
+    from Queue import Queue  # Python 2
+except ImportError:
+    from queue import Queue
+
+from data_flow_graph import RollingWindowCounter
+
+
+def test_get_lines(stream2dataflow):
+    counts = {'foo\tselect\tbar': 30, 'foo\tupdate\tbar': 6}
+    total = lambda key: counts.get(key, 0)
+
+    assert list(stream2dataflow.get_lines(total, sorted(counts) + ['foo\tdelete\tbar'], 30, window=60)) == [
+        {'source': 'foo', 'edge': 'select', 'target': 'bar', 'value': 1.0, 'metadata': 'QPS: 0.5000'},
+        {'source': 'foo', 'edge': 'update', 'target': 'bar', 'value': 0.2, 'metadata': 'QPS: 0.1000'},
+        # no longer counted
+        {'source': 'foo', 'edge': 'delete', 'target': 'bar', 'value': 0., 'metadata': 'QPS: 0.0000'},
+    ]
+
+    assert list(stream2dataflow.get_lines(total, [], 0, window=60)) == []
+
+
+def test_top_count(stream2dataflow):
+    counter = RollingWindowCounter(bucket_size=60, max_window=600, track_changes=True)
+    top_count = stream2dataflow.TopCount(counter.total)
+
+    counter.add('foo', 0, count=5)
+    counter.add('bar', 120, count=3)
+    top_count.update(counter.pop_changed())
+    assert top_count.get() == 5
+
+    # only changed edges are checked
+    counter.add('bar', 180, count=3)
+    top_count.update(counter.pop_changed())
+    assert top_count.get() == 6
+
+    # foo is evicted, bar is the top one
+    counter.advance(660)
+    top_count.update(counter.pop_changed())
+    assert top_count.get() == 6
+
+    counter.advance(900)
+    top_count.update(counter.pop_changed())
+    assert top_count.get() == 0
+
+    # the heap of a long running stream is bounded
+    for timestamp in range(1000, 5000):
+        counter.add('foo', timestamp)
+        top_count.update(counter.pop_changed())
+
+    assert top_count.get() == counter.counts().most_common(1)[0][1]
+    assert len(top_count._heap) <= 2 * top_count._size + 1000
+
+
+def _get_follower(stream2dataflow, path):
+    queue = Queue()
+
+    follower = threading.Thread(target=stream2dataflow.follow_file, args=(path, queue, True, 0.01))
+    follower.daemon = True
+    follower.start()
+
+    return queue
+
+
+def test_follow_file(stream2dataflow, tmpdir):
+    path = str(tmpdir.join('edges.tsv'))
+    line = u'f\u00f3o\tselect\tb\u0105r\n'.encode('utf-8')
+
+    with open(path, 'wb') as fp:
+        fp.write(line)
+
+    queue = _get_follower(stream2dataflow, path)
+    assert queue.get(timeout=1) == u'f\u00f3o\tselect\tb\u0105r\n'
+
+    # a line written in parts - split in the middle of a multi-byte character
+    with open(path, 'ab') as fp:
+        for part in (line[:14], line[14:]):
+            fp.write(part)
+            fp.flush()
+            time.sleep(0.05)
+
+    assert queue.get(timeout=1) == u'f\u00f3o\tselect\tb\u0105r\n'
+
+    # truncated
+    with open(path, 'wb') as fp:
+        fp.write(b'foo\tupdate\tbar\n')
+
+    assert queue.get(timeout=1) == u'foo\tupdate\tbar\n'
+
+    # rotated - the end of the old file and the new one are read
+    with open(path, 'ab') as fp:
+        fp.write(b'foo\tdelete')
+
+    os.rename(path, path + '.1')
+    time.sleep(0.05)
+
+    with open(path, 'wb') as fp:
+        fp.write(b'foo\tinsert\tbar\n')
+
+    assert queue.get(timeout=1) == u'foo\tdelete'
+    assert queue.get(timeout=1) == u'foo\tinsert\tbar\n'
+    assert queue.empty()
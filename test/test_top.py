@@ -0,0 +1,80 @@
+from collections import Counter
+
+from data_flow_graph import SpaceSavingCounter, RollingWindowCounter
+
+
+def _get_keys():
+    # Zipf-like distribution: key N is seen 1000 / N times
+    keys = []
+
+    for n in range(1, 201):
+        keys += ['key{}'.format(n)] * (1000 // n)
+
+    return keys
+
+
+def test_space_saving_counter():
+    counter = SpaceSavingCounter(capacity=10)
+    counter.update(['foo', 'bar', 'foo'])
+    counter.add('test', count=5)
+
+    assert len(counter) == 3
+    assert counter.total == 8
+    assert counter['foo'] == 2
+    assert counter['not-there'] == 0
+    assert counter.error('foo') == 0
+    assert counter.most_common() == [('test', 5), ('foo', 2), ('bar', 1)]
+    assert counter.most_common(1) == [('test', 5)]
+
+
+def test_space_saving_counter_bounded():
+    keys = _get_keys()
+    exact = Counter(keys)
+
+    counter = SpaceSavingCounter(capacity=50)
+    counter.update(keys)
+
+    assert len(counter) == 50
+    assert counter.total == len(keys)
+
+    # the heaviest hitters are always tracked and true counts are within the error bounds
+    assert [key for (key, _) in counter.most_common(5)] == ['key1', 'key2', 'key3', 'key4', 'key5']
+
+    for key, count in counter.items():
+        assert count - counter.error(key) <= exact[key] <= count
+
+
+def test_space_saving_counter_merge():
+    keys = _get_keys()
+    exact = Counter(keys)
+
+    first, second = SpaceSavingCounter(capacity=50), SpaceSavingCounter(capacity=50)
+    first.update(keys[::2])
+    second.update(keys[1::2])
+
+    first.update(second)
+
+    assert len(first) == 50
+    assert first.total == len(keys)
+    assert [key for (key, _) in first.most_common(5)] == ['key1', 'key2', 'key3', 'key4', 'key5']
+
+    for key, count in first.items():
+        assert count - first.error(key) <= exact[key] <= count
+
+
+def test_rolling_window_capacity():
+    counter = RollingWindowCounter(bucket_size=60, max_window=3600, capacity=2)
+
+    for ts in range(0, 600):
+        counter.add('foo', ts)
+        counter.add('bar', ts, count=2)
+
+    for ts in range(0, 600, 60):
+        counter.add('test', ts)
+
+    counts = counter.counts()
+
+    assert isinstance(counts, SpaceSavingCounter)
+    assert counts.most_common(1) == [('bar', 1200)]
+    assert counts['bar'] - counts.error('bar') <= 1200
+    assert len(counts) == 2
@@ -1,4 +1,9 @@
-from data_flow_graph import format_tsv_line, format_tsv_lines
+import gzip
+
+from io import StringIO
+
+from data_flow_graph import format_tsv_line, format_tsv_lines, format_tsv_tuple, write_tsv_lines, write_tsv_file, \
+    parse_tsv_line, read_tsv_lines, read_tsv_file
 
 
 def test_format():
@@ -27,3 +32,88 @@ def test_format_lines():
     ]
 
     assert ''.join(format_tsv_lines(lines)) == 'foo\tselect\tbar\nfoo2\tselect\tbar\t0.5000\ttest\n'
+
+
+def test_format_tuple():
+    assert format_tsv_tuple(('foo', 'select', 'bar')) == 'foo\tselect\tbar'
+    assert format_tsv_tuple(('foo', 'select', 'bar', 0.12)) == 'foo\tselect\tbar\t0.1200'
+    assert format_tsv_tuple(('foo', 'select', 'bar', None, 'test')) == 'foo\tselect\tbar\t\ttest'
+    assert format_tsv_tuple(('foo', 'select', 'bar', 0.12, 'QPS: 1234')) == 'foo\tselect\tbar\t0.1200\tQPS: 1234'
+
+
+def test_write_lines():
+    lines = [
+        {
+            'source': 'foo',
+            'edge': 'select',
+            'target': 'bar',
+        },
+        ('foo2', 'select', 'bar', 0.5, 'test'),
+        ('foo3', 'select', 'bar', None, ''),
+    ]
+
+    fp = StringIO()
+    assert write_tsv_lines(iter(lines), fp, chunk_size=2) == 3
+    assert fp.getvalue() == 'foo\tselect\tbar\nfoo2\tselect\tbar\t0.5000\ttest\nfoo3\tselect\tbar\n'
+
+
+def test_write_file(tmpdir):
+    lines = [('foo', 'select', 'bar', 0.5, 'test')] * 3
+
+    path = str(tmpdir.join('dataflow.tsv.gz'))
+    assert write_tsv_file(lines, path) == 3
+
+    with gzip.open(path, 'rt') as fp:
+        assert fp.read() == 'foo\tselect\tbar\t0.5000\ttest\n' * 3
+
+
+def test_write_file_atomic(tmpdir):
+    path = str(tmpdir.join('dataflow.tsv'))
+
+    write_tsv_file([('foo', 'select', 'bar')], path)
+    assert write_tsv_file([('foo', 'update', 'bar')] * 2, path, atomic=True) == 2
+
+    with open(path) as fp:
+        assert fp.read() == 'foo\tupdate\tbar\n' * 2
+
+    # no temporary files are left
+    assert tmpdir.listdir() == [tmpdir.join('dataflow.tsv')]
+
+
+def test_parse_line():
+    assert parse_tsv_line('# comment') is None
+    assert parse_tsv_line('\n') is None
+
+    assert parse_tsv_line('foo\tselect\tbar\n') == {'source': 'foo', 'edge': 'select', 'target': 'bar'}
+    assert parse_tsv_line('foo\tselect\tbar\t0.5000\ttest') == \
+        {'source': 'foo', 'edge': 'select', 'target': 'bar', 'value': 0.5, 'metadata': 'test'}
+    assert parse_tsv_line('foo\tselect\tbar\t\ttest', as_tuple=True) == ('foo', 'select', 'bar', None, 'test')
+
+
+def test_read_lines_round_trip():
+    tsv = '# a comment\n' \
+        'foo\tselect\tbar\n' \
+        'foo2\tselect\tbar\t0.5000\ttest\n' \
+        'foo2\tupdate\tbar\t\tQPS: 0.1234\n' \
+        'foo3\tselect\tbar\t0.0001\n'
+
+    lines = list(read_tsv_lines(StringIO(tsv)))
+    assert len(lines) == 4
+    # repeated node names are interned
+    assert lines[1]['source'] is lines[2]['source']
+    assert lines[0]['target'] is lines[3]['target']
+
+    assert ''.join(format_tsv_lines(lines)) == tsv.split('\n', 1)[1]
+
+    fp = StringIO()
+    write_tsv_lines(read_tsv_lines(StringIO(tsv), as_tuples=True), fp)
+    assert fp.getvalue() == tsv.split('\n', 1)[1]
+
+
+def test_read_file(tmpdir):
+    lines = [('foo', 'select', 'bar', 0.5, 'test')] * 3
+
+    path = str(tmpdir.join('dataflow.tsv.gz'))
+    write_tsv_file(lines, path)
+
+    assert list(read_tsv_file(path, as_tuples=True)) == lines
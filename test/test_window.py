@@ -0,0 +1,61 @@
+from data_flow_graph import RollingWindowCounter
+
+
+def test_rolling_window():
+    counter = RollingWindowCounter(bucket_size=60, max_window=3600)
+
+    # 10 minutes of traffic, one entry per second (plus a burst in the last minute)
+    for ts in range(0, 600):
+        counter.add('foo\tselect\tbar', ts)
+
+    for ts in range(540, 600):
+        counter.add('foo\tupdate\tbar', ts, count=2)
+
+    assert counter.counts() == {'foo\tselect\tbar': 600, 'foo\tupdate\tbar': 120}
+    assert counter.counts(window=300) == {'foo\tselect\tbar': 300, 'foo\tupdate\tbar': 120}
+    assert counter.counts(window=60, now=300) == {'foo\tselect\tbar': 60}
+
+    assert counter.rates(window=60) == {'foo\tselect\tbar': 1.0, 'foo\tupdate\tbar': 2.0}
+    assert counter.peak_rates() == {'foo\tselect\tbar': 1.0, 'foo\tupdate\tbar': 2.0}
+    assert counter.rates()['foo\tupdate\tbar'] == 120. / 3600
+
+
+def test_rolling_window_eviction():
+    counter = RollingWindowCounter(bucket_size=60, max_window=3600)
+
+    for ts in range(0, 7200, 10):
+        counter.add('foo', ts)
+
+    # only the last hour is kept
+    assert len(counter._buckets) == 60
+    assert counter.counts() == {'foo': 360}
+
+    # too old entries are ignored
+    counter.add('foo', 0)
+    assert counter.counts() == {'foo': 360}
+
+
+def test_rolling_window_changes():
+    counter = RollingWindowCounter(bucket_size=60, max_window=600, track_changes=True)
+
+    counter.add('foo', 0)
+    counter.add('bar', 30, count=2)
+    counter.add('foo', 120)
+
+    assert counter.pop_changed() == {'foo', 'bar'}
+    assert counter.pop_changed() == set()
+
+    counter.add('foo', 300)
+    assert counter.pop_changed() == {'foo'}
+    assert counter.counts() == {'foo': 3, 'bar': 2}
+
+    # the first bucket leaves the window
+    counter.advance(650)
+    assert counter.pop_changed() == {'foo', 'bar'}
+    assert counter.counts() == {'foo': 2}
+    assert counter.counts() == counter.counts(window=600, now=650)
+    assert (counter.total('foo'), counter.total('bar')) == (2, 0)
+
+    counter.advance(10000)
+    assert counter.pop_changed() == {'foo'}
+    assert counter.counts() == {}